@@ -0,0 +1,150 @@
+"""
+Controle de admissão das extrações feitas dentro da requisição (/upload e /upload/stream).
+
+Cada worker executa no máximo `simultaneas` extrações ao mesmo tempo e deixa até
+`profundidade` requisições esperando por uma vaga. Uma requisição que chega com a fila
+cheia, ou que espera mais que `espera_maxima` segundos, é recusada imediatamente com
+503 e um Retry-After estimado pela duração média das extrações, em vez de ficar presa
+até o timeout do gunicorn.
+
+A fila só tem efeito com workers que aceitam mais de uma requisição ao mesmo tempo
+(workers gthread, ver gunicorn.conf.py).
+"""
+
+import math
+import time
+import threading
+
+from metricas import metricas
+
+# Duração presumida de uma extração (em segundos) antes da primeira medição
+DURACAO_INICIAL = 5.0
+
+
+class FilaCheia(Exception):
+    """
+    A requisição não foi admitida
+
+    Args:
+        motivo: "fila_cheia" ou "espera_maxima"
+        retry_after: Segundos sugeridos até uma nova tentativa
+    """
+
+    def __init__(self, motivo, retry_after):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.retry_after = retry_after
+
+
+class FilaExtracao:
+    """
+    Fila limitada de extrações de um worker.
+
+    Args:
+        simultaneas: Extrações executadas ao mesmo tempo
+        profundidade: Requisições que podem esperar por uma vaga
+        espera_maxima: Tempo máximo (em segundos) de espera na fila
+    """
+
+    def __init__(self, simultaneas=1, profundidade=2, espera_maxima=20.0):
+        self.simultaneas = max(simultaneas, 1)
+        self.profundidade = max(profundidade, 0)
+        self.espera_maxima = espera_maxima
+        self.em_execucao = 0
+        self.na_fila = 0
+        self.recusadas = 0
+        self._duracao_media = None
+        self._condicao = threading.Condition()
+
+    def _publicar(self):
+        metricas.definir("sisreg_fila_extracao", self.em_execucao, estado="em_execucao")
+        metricas.definir("sisreg_fila_extracao", self.na_fila, estado="na_fila")
+
+    def _retry_after(self):
+        # Tempo para esvaziar a fila atual, pela duração média das extrações
+        duracao = self._duracao_media if self._duracao_media is not None else DURACAO_INICIAL
+        return min(max(math.ceil(duracao * (self.na_fila + 1) / self.simultaneas), 1), 120)
+
+    def _recusar(self, motivo):
+        self.recusadas += 1
+        metricas.incrementar("sisreg_fila_recusas_total", motivo=motivo)
+        return FilaCheia(motivo, self._retry_after())
+
+    def admitir(self):
+        """
+        Espera por uma vaga de extração
+
+        Returns:
+            Vaga: objeto a ser liberado com `liberar` ao fim da extração
+
+        Raises:
+            FilaCheia: Se a fila estiver cheia ou a espera passar de `espera_maxima`
+        """
+        chegada = time.monotonic()
+        with self._condicao:
+            if self.em_execucao >= self.simultaneas:
+                if self.na_fila >= self.profundidade:
+                    raise self._recusar("fila_cheia")
+                self.na_fila += 1
+                self._publicar()
+                try:
+                    while self.em_execucao >= self.simultaneas:
+                        restante = self.espera_maxima - (time.monotonic() - chegada)
+                        if restante <= 0:
+                            raise self._recusar("espera_maxima")
+                        self._condicao.wait(restante)
+                finally:
+                    self.na_fila -= 1
+            self.em_execucao += 1
+            self._publicar()
+        inicio = time.monotonic()
+        metricas.observar("sisreg_fila_espera_segundos", inicio - chegada)
+        return Vaga(self, inicio)
+
+    def liberar(self, vaga):
+        """Libera a vaga e atualiza a duração média das extrações (uma vez por vaga)"""
+        with self._condicao:
+            if vaga.liberada:
+                return
+            vaga.liberada = True
+            duracao = time.monotonic() - vaga.inicio
+            if self._duracao_media is None:
+                self._duracao_media = duracao
+            else:
+                self._duracao_media = 0.8 * self._duracao_media + 0.2 * duracao
+            self.em_execucao -= 1
+            self._publicar()
+            self._condicao.notify()
+
+    def estado(self):
+        """Ocupação atual da fila (rota /fila)"""
+        with self._condicao:
+            return {
+                "em_execucao": self.em_execucao,
+                "na_fila": self.na_fila,
+                "simultaneas": self.simultaneas,
+                "profundidade": self.profundidade,
+                "espera_maxima": self.espera_maxima,
+                "recusadas": self.recusadas,
+                "duracao_media": round(self._duracao_media, 3) if self._duracao_media is not None else None
+            }
+
+
+class Vaga:
+    """Vaga de extração obtida com `FilaExtracao.admitir` (também usada com `with`)"""
+
+    __slots__ = ("fila", "inicio", "liberada")
+
+    def __init__(self, fila, inicio):
+        self.fila = fila
+        self.inicio = inicio
+        self.liberada = False
+
+    def liberar(self):
+        self.fila.liberar(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excecao):
+        self.liberar()
@@ -0,0 +1,193 @@
+"""
+Base local (SQLite) dos registros extraídos.
+
+Cada PDF extraído com sucesso é gravado com a chave do seu conteúdo (SHA-256), de modo
+que reenvios do mesmo arquivo atualizam o registro em vez de duplicá-lo. Os índices
+sobre código de solicitação, CNS, data do exame e unidade solicitante permitem
+responder localmente, em milissegundos, se uma guia já foi processada e reexportar um
+período sem reenviar os PDFs nem ler a planilha inteira.
+
+O banco usa WAL: as consultas não bloqueiam as gravações dos workers do gunicorn nem
+dos processos de processar_lote.py.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from extrator_sisreg import CAMPOS, VERSAO_EXTRATOR
+
+# Filtros de igualdade aceitos por `buscar`
+FILTROS = ("codigo_solicitacao", "cns", "unidade_solicitante", "unidade_executante")
+LIMITE_MAXIMO = 1000
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS resultados (
+    sha256 TEXT PRIMARY KEY,
+    versao_extrator TEXT NOT NULL,
+    arquivo TEXT,
+    codigo_solicitacao TEXT,
+    cns TEXT,
+    data_exame TEXT,
+    data_exame_iso TEXT,
+    unidade_solicitante TEXT,
+    unidade_executante TEXT,
+    procedimento TEXT,
+    processado_em REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resultados_codigo ON resultados (codigo_solicitacao);
+CREATE INDEX IF NOT EXISTS resultados_cns ON resultados (cns);
+CREATE INDEX IF NOT EXISTS resultados_data ON resultados (data_exame_iso);
+CREATE INDEX IF NOT EXISTS resultados_unidade ON resultados (unidade_solicitante, data_exame_iso);
+"""
+
+
+def data_iso(data):
+    """
+    Converte DD/MM/AAAA para AAAA-MM-DD (formato que ordena como texto)
+
+    Returns:
+        Data no formato ISO, ou None se `data` não estiver no formato DD/MM/AAAA
+    """
+    if not data or len(data) != 10 or data[2] != "/" or data[5] != "/":
+        return None
+    dia, mes, ano = data[:2], data[3:5], data[6:]
+    if not (dia + mes + ano).isdigit():
+        return None
+    return f"{ano}-{mes}-{dia}"
+
+
+def _filtrar(filtros, data_inicio, data_fim):
+    """
+    Monta a cláusula WHERE dos filtros de `buscar` e `contar`
+
+    Returns:
+        Tupla (where, parametros), com where vazio se não houver filtros
+    """
+    condicoes, parametros = [], []
+    for campo, valor in (filtros or {}).items():
+        if campo not in FILTROS:
+            raise ValueError(f"Filtro inválido: {campo}")
+        condicoes.append(f"{campo} = ?")
+        parametros.append(valor)
+    for data, operador in ((data_inicio, ">="), (data_fim, "<=")):
+        if data:
+            iso = data_iso(data)
+            if iso is None:
+                raise ValueError(f"Data inválida (use DD/MM/AAAA): {data}")
+            condicoes.append(f"data_exame_iso {operador} ?")
+            parametros.append(iso)
+    return (" WHERE " + " AND ".join(condicoes) if condicoes else ""), parametros
+
+
+class BaseResultados:
+    """
+    Registros extraídos gravados em SQLite.
+
+    Args:
+        caminho: Arquivo do banco SQLite
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._local = threading.local()
+        self._iniciado = False
+        self._lock = threading.Lock()
+
+    def _conexao(self):
+        # Uma conexão por thread (e por processo: as conexões não sobrevivem ao fork)
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is None or self._local.pid != os.getpid():
+            diretorio = os.path.dirname(self.caminho)
+            if diretorio:
+                os.makedirs(diretorio, exist_ok=True)
+            conexao = sqlite3.connect(self.caminho, timeout=30, isolation_level=None)
+            conexao.row_factory = sqlite3.Row
+            # Com WAL, NORMAL só perde as últimas transações em uma queda de energia
+            conexao.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexao = conexao
+            self._local.pid = os.getpid()
+        if not self._iniciado:
+            with self._lock:
+                if not self._iniciado:
+                    conexao.execute("PRAGMA journal_mode=WAL")
+                    conexao.executescript(_ESQUEMA)
+                    self._iniciado = True
+        return conexao
+
+    def guardar(self, sha256, resultado):
+        """
+        Grava (ou atualiza) o registro extraído de um PDF
+
+        Args:
+            sha256: SHA-256 do conteúdo do PDF
+            resultado: Dicionário retornado pela extração (sem a chave "erro")
+        """
+        self._conexao().execute(
+            f"""INSERT INTO resultados (sha256, versao_extrator, arquivo, {', '.join(CAMPOS)},
+                                        data_exame_iso, processado_em)
+                VALUES (?, ?, ?, {', '.join('?' for _ in CAMPOS)}, ?, ?)
+                ON CONFLICT (sha256) DO UPDATE SET
+                    versao_extrator = excluded.versao_extrator, arquivo = excluded.arquivo,
+                    {', '.join(f'{campo} = excluded.{campo}' for campo in CAMPOS)},
+                    data_exame_iso = excluded.data_exame_iso, processado_em = excluded.processado_em""",
+            (sha256, VERSAO_EXTRATOR, resultado.get("arquivo"), *(resultado.get(campo) for campo in CAMPOS),
+             data_iso(resultado.get("data_exame")), time.time()))
+
+    def buscar(self, filtros=None, data_inicio=None, data_fim=None, limite=100, deslocamento=0):
+        """
+        Consulta os registros
+
+        Args:
+            filtros: Dicionário {campo: valor} com campos de FILTROS (igualdade)
+            data_inicio: Data do exame mínima (DD/MM/AAAA), inclusiva
+            data_fim: Data do exame máxima (DD/MM/AAAA), inclusiva
+            limite: Número máximo de registros (até LIMITE_MAXIMO)
+            deslocamento: Registros a pular (paginação)
+
+        Returns:
+            Lista de dicionários no formato dos resultados de /upload, ordenada pela data do
+            exame, com "processado_em" (timestamp Unix)
+
+        Raises:
+            ValueError: Se um filtro ou uma data for inválido
+        """
+        where, parametros = _filtrar(filtros, data_inicio, data_fim)
+        sql = (f"SELECT arquivo, {', '.join(CAMPOS)}, processado_em FROM resultados{where}"
+               " ORDER BY data_exame_iso, rowid LIMIT ? OFFSET ?")
+        parametros += [max(min(limite, LIMITE_MAXIMO), 0), max(deslocamento, 0)]
+        return [dict(linha) for linha in self._conexao().execute(sql, parametros)]
+
+    def contar(self, filtros=None, data_inicio=None, data_fim=None):
+        """
+        Conta os registros que atendem aos filtros (mesmos argumentos de `buscar`, sem
+        paginação)
+
+        Raises:
+            ValueError: Se um filtro ou uma data for inválido
+        """
+        where, parametros = _filtrar(filtros, data_inicio, data_fim)
+        return self._conexao().execute(f"SELECT COUNT(*) FROM resultados{where}", parametros).fetchone()[0]
+
+    def existentes(self, codigos):
+        """
+        Verifica quais códigos de solicitação já foram processados
+
+        Returns:
+            Dicionário {codigo: {"arquivo": ..., "processado_em": ...}} apenas com os
+            códigos encontrados (o processamento mais recente de cada um)
+        """
+        encontrados = {}
+        codigos = list(dict.fromkeys(codigo for codigo in codigos if codigo))
+        # Consultas em blocos, abaixo do limite de parâmetros do SQLite
+        for inicio in range(0, len(codigos), 500):
+            bloco = codigos[inicio:inicio + 500]
+            linhas = self._conexao().execute(
+                f"""SELECT codigo_solicitacao, arquivo, processado_em FROM resultados
+                    WHERE codigo_solicitacao IN ({', '.join('?' for _ in bloco)})
+                    ORDER BY processado_em""", bloco)
+            for linha in linhas:
+                encontrados[linha["codigo_solicitacao"]] = {"arquivo": linha["arquivo"],
+                                                            "processado_em": linha["processado_em"]}
+        return encontrados
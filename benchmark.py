@@ -0,0 +1,314 @@
+"""
+Benchmark do pipeline de extração usando os PDFs de uploads/ e pdfs/ como corpus
+
+Cada etapa é medida separadamente, chamada a chamada:
+    extrair_texto_pdf           leitura do PDF (como no pipeline, com o mesmo critério de parada)
+    extrair_dados               cascatas de expressões regulares sobre o texto
+    validar_municipio           CidadesParaiba.validar_municipio (antes da medição, os
+                                resultados são conferidos com CASOS_MUNICIPIOS)
+    montar_linhas               montagem das linhas de adicionar_dados_planilha (sem acesso à API)
+
+Para cada etapa são informados docs/s e os tempos p50/p95 por chamada; o pico de memória
+(RSS) do processo também é registrado. O resultado pode ser salvo em JSON e comparado com
+uma baseline: se alguma etapa piorar mais que o limite, o script termina com código 1.
+
+O benchmark_baseline.json do repositório foi medido na máquina registrada em "maquina";
+em outro ambiente os números não são comparáveis: rode antes com --salvar-baseline.
+
+Uso:
+    python benchmark.py [--pastas uploads pdfs] [--rodadas 20] [--rodadas-pdf 2]
+                        [--saida resultado.json] [--baseline benchmark_baseline.json]
+                        [--limite 0.15] [--salvar-baseline]
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import resource
+from datetime import datetime
+
+from main import extrair_texto_pdf, extrair_dados
+from extrator_sisreg import LeituraPaginas
+from cidades_paraiba import CidadesParaiba
+from google_sheets_integration_fix import mapear_colunas, montar_linhas
+
+BASELINE_PADRAO = 'benchmark_baseline.json'
+CABECALHO_PLANILHA = ["DATA DA AUTORIZAÇÃO", "COD. SOLICITAÇÃO", "CNS DO PACIENTE",
+                      "UNID. SOLICITANTE", "UNID. EXECUTANTE", "PAES"]
+
+
+def listar_corpus(pastas):
+    """Retorna os caminhos de todos os PDFs das pastas, em ordem"""
+    caminhos = []
+    for pasta in pastas:
+        caminhos.extend(sorted(glob.glob(os.path.join(pasta, '*.pdf'))))
+    return caminhos
+
+
+def carregar_textos(pastas):
+    """
+    Extrai uma única vez o texto de todos os PDFs das pastas
+
+    Returns:
+        Lista de textos (PDFs sem texto são ignorados)
+    """
+    if isinstance(pastas, str):
+        pastas = [pastas]
+    textos = []
+    for caminho in listar_corpus(pastas):
+        texto = extrair_texto_pdf(caminho)
+        if texto.strip():
+            textos.append(texto)
+    return textos
+
+
+def nomes_municipios():
+    """
+    Entradas no formato em que o município chega do PDF: bairro colado antes do nome,
+    sufixo com UF e CEP, e alguns textos sem cidade conhecida
+    """
+    nomes = []
+    for cidade in CidadesParaiba.cidades:
+        nomes.append(cidade)
+        nomes.append(f"CEP:CENTRO{cidade}")
+        nomes.append(f"{cidade} - PB58000-000")
+    nomes.extend(["", "JOAO PES SOA", "CEP:ZONA RURAL", "RECIFE - PE50000-000"])
+    return nomes
+
+
+# Entradas com o município esperado. Entre posições diferentes vence o nome que termina
+# mais à direita, mesmo que um anterior seja mais longo: o bairro vem colado antes do
+# município ("SÃO FRANCISCO" é bairro em "SÃO FRANCISCOMONTE HOREBE")
+CASOS_MUNICIPIOS = [
+    ("SÃO FRANCISCOMONTE HOREBE", "MONTE HOREBE"),
+    ("NOSSA SENHORA APARECIDAGUARABIRA", "GUARABIRA"),
+    ("AREIA DE BARAÚNAS", "AREIA DE BARAÚNAS"),
+    ("CEP:CENTROBELÉM DO BREJO DO CRUZ", "BELÉM DO BREJO DO CRUZ"),
+    ("POMBAL - PB58840-000", "POMBAL"),
+    ("CEP:ZONA RURALSÃO FRANCISCO", "SÃO FRANCISCO"),
+    ("RECIFE - PE50000-000", "NÃO ENCONTRADO"),
+]
+
+
+def conferir_municipios():
+    """
+    Confere `CidadesParaiba.validar_municipio` com os CASOS_MUNICIPIOS
+
+    Returns:
+        Lista de mensagens, uma por caso com resultado diferente do esperado
+    """
+    falhas = []
+    for entrada, esperado in CASOS_MUNICIPIOS:
+        obtido = CidadesParaiba.validar_municipio(entrada)
+        if obtido != esperado:
+            falhas.append(f"validar_municipio({entrada!r}): esperado {esperado!r}, obtido {obtido!r}")
+    return falhas
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) pelo método do posto mais próximo"""
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    posicao = max(int(round(p / 100 * len(ordenados) + 0.5)) - 1, 0)
+    return ordenados[min(posicao, len(ordenados) - 1)]
+
+
+def medir(funcao, entradas, rodadas, documentos_por_chamada=1):
+    """
+    Chama `funcao` para cada entrada, `rodadas` vezes, cronometrando cada chamada
+
+    Returns:
+        Dicionário com docs/s e os tempos p50/p95 por chamada (em ms)
+    """
+    tempos = []
+    for _ in range(rodadas):
+        for entrada in entradas:
+            inicio = time.perf_counter()
+            funcao(entrada)
+            tempos.append(time.perf_counter() - inicio)
+    total = sum(tempos)
+    return {
+        "chamadas": len(tempos),
+        "docs_por_segundo": round(len(tempos) * documentos_por_chamada / total, 1) if total else 0.0,
+        "p50_ms": round(percentil(tempos, 50) * 1000, 4),
+        "p95_ms": round(percentil(tempos, 95) * 1000, 4),
+        "total_s": round(total, 4)
+    }
+
+
+def pico_rss_mb():
+    """Pico de memória residente do processo (ru_maxrss é em KB no Linux e em bytes no macOS)"""
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        pico /= 1024
+    return round(pico / 1024, 1)
+
+
+def benchmark_extracao(textos, rodadas=20):
+    """Mede `extrair_dados` sobre os textos já extraídos"""
+    return medir(extrair_dados, textos, rodadas)
+
+
+def benchmark_municipios(nomes, rodadas=20):
+    """Mede `CidadesParaiba.validar_municipio`"""
+    CidadesParaiba.validar_municipio("")  # Construção do autômato fora da medição
+    return medir(CidadesParaiba.validar_municipio, nomes, rodadas)
+
+
+def benchmark_linhas(dados, rodadas=20):
+    """
+    Mede a montagem das linhas da planilha para o lote inteiro (uma chamada por lote),
+    com metade dos códigos já presentes na planilha
+    """
+    indices_colunas = mapear_colunas(CABECALHO_PLANILHA)
+    codigos_existentes = {dado.get("codigo_solicitacao") for dado in dados[::2]}
+    return medir(lambda lote: montar_linhas(lote, CABECALHO_PLANILHA, indices_colunas, codigos_existentes),
+                 [dados], rodadas, documentos_por_chamada=len(dados))
+
+
+def descrever_maquina():
+    """Processador e número de CPUs, para saber se duas medições são comparáveis"""
+    processador = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for linha in f:
+                if linha.startswith('model name'):
+                    processador = linha.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return {"processador": processador, "cpus": os.cpu_count()}
+
+
+def executar(pastas, rodadas=20, rodadas_pdf=2):
+    """
+    Executa todas as etapas sobre o corpus
+
+    Returns:
+        Dicionário com o resultado (formato salvo em JSON)
+    """
+    caminhos = listar_corpus(pastas)
+    # Os PDFs são lidos do disco antes da medição: a etapa mede apenas o PyPDF2
+    conteudos = []
+    for caminho in caminhos:
+        with open(caminho, 'rb') as f:
+            conteudos.append(f.read())
+
+    etapas = {}
+    etapas["extrair_texto_pdf"] = medir(lambda conteudo: extrair_texto_pdf(conteudo, parar_quando=LeituraPaginas),
+                                        conteudos, rodadas_pdf)
+
+    textos = [texto for texto in (extrair_texto_pdf(conteudo, parar_quando=LeituraPaginas) for conteudo in conteudos)
+              if texto.strip()]
+    etapas["extrair_dados"] = benchmark_extracao(textos, rodadas)
+    etapas["validar_municipio"] = benchmark_municipios(nomes_municipios(), rodadas)
+    etapas["montar_linhas"] = benchmark_linhas([extrair_dados(texto) for texto in textos], rodadas)
+
+    return {
+        "data": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "maquina": descrever_maquina(),
+        "pastas": pastas,
+        "documentos": len(caminhos),
+        "documentos_com_texto": len(textos),
+        "rodadas": rodadas,
+        "rodadas_pdf": rodadas_pdf,
+        "etapas": etapas,
+        "pico_rss_mb": pico_rss_mb()
+    }
+
+
+def comparar(atual, baseline, limite=0.15):
+    """
+    Compara o resultado com a baseline
+
+    Uma etapa regrediu se os docs/s caíram ou o p50 subiu mais que `limite` (fração).
+
+    Returns:
+        Lista de mensagens, uma por regressão encontrada
+    """
+    regressoes = []
+    for etapa, medicao in atual["etapas"].items():
+        base = baseline.get("etapas", {}).get(etapa)
+        if not base:
+            continue
+        if medicao["docs_por_segundo"] < base["docs_por_segundo"] * (1 - limite):
+            regressoes.append(f"{etapa}: {medicao['docs_por_segundo']} docs/s "
+                              f"(baseline {base['docs_por_segundo']})")
+        if medicao["p50_ms"] > base["p50_ms"] * (1 + limite):
+            regressoes.append(f"{etapa}: p50 {medicao['p50_ms']} ms (baseline {base['p50_ms']} ms)")
+    return regressoes
+
+
+def imprimir(resultado, baseline=None):
+    print(f"Documentos: {resultado['documentos']} ({resultado['documentos_com_texto']} com texto)")
+    print(f"{'etapa':<20} {'docs/s':>12} {'p50 ms':>10} {'p95 ms':>10} {'vs baseline':>12}")
+    for etapa, medicao in resultado["etapas"].items():
+        variacao = ""
+        base = (baseline or {}).get("etapas", {}).get(etapa)
+        if base and base["docs_por_segundo"]:
+            variacao = f"{(medicao['docs_por_segundo'] / base['docs_por_segundo'] - 1) * 100:+.1f}%"
+        print(f"{etapa:<20} {medicao['docs_por_segundo']:>12.1f} {medicao['p50_ms']:>10.3f} "
+              f"{medicao['p95_ms']:>10.3f} {variacao:>12}")
+    print(f"Pico de memória (RSS): {resultado['pico_rss_mb']} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline de extração")
+    parser.add_argument('--pastas', nargs='+', default=['uploads', 'pdfs'],
+                        help="Pastas com os PDFs do corpus (padrão: uploads pdfs)")
+    parser.add_argument('--rodadas', type=int, default=20,
+                        help="Repetições das etapas sobre texto (padrão: 20)")
+    parser.add_argument('--rodadas-pdf', type=int, default=2,
+                        help="Repetições da leitura dos PDFs (padrão: 2)")
+    parser.add_argument('--saida', help="Arquivo JSON onde salvar o resultado")
+    parser.add_argument('--baseline', default=BASELINE_PADRAO,
+                        help=f"Baseline para comparação (padrão: {BASELINE_PADRAO}, se existir)")
+    parser.add_argument('--limite', type=float, default=0.15,
+                        help="Piora máxima aceita em relação à baseline, em fração (padrão: 0.15)")
+    parser.add_argument('--salvar-baseline', action='store_true',
+                        help="Grava o resultado como nova baseline")
+    args = parser.parse_args()
+
+    # Os tempos só valem se os resultados estiverem corretos
+    falhas = conferir_municipios()
+    if falhas:
+        print("Resultados incorretos:")
+        for falha in falhas:
+            print(f"  {falha}")
+        sys.exit(1)
+
+    resultado = executar(args.pastas, args.rodadas, args.rodadas_pdf)
+
+    baseline = None
+    if not args.salvar_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if baseline and baseline.get("maquina") != resultado["maquina"]:
+        print(f"Aviso: a baseline {args.baseline} foi medida em outra máquina "
+              f"({baseline.get('maquina')}); grave uma baseline deste ambiente com --salvar-baseline")
+    imprimir(resultado, baseline)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+
+    if args.salvar_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+        print(f"Baseline salva em {args.baseline}")
+    elif baseline:
+        regressoes = comparar(resultado, baseline, args.limite)
+        if regressoes:
+            print(f"Regressões (limite {args.limite:.0%}):")
+            for regressao in regressoes:
+                print(f"  {regressao}")
+            sys.exit(1)
+        print(f"Sem regressões em relação a {args.baseline} (limite {args.limite:.0%})")
@@ -0,0 +1,74 @@
+"""
+Cache em memória (LRU) dos resultados da extração, indexado pelo conteúdo do PDF.
+
+A chave é o SHA-256 dos bytes do arquivo combinado com a versão do extrator, de modo
+que reenvios do mesmo documento (mesmo com outro nome) não passam de novo pelo PyPDF2
+nem pelas cascatas de `extrair_dados`, e uma mudança no extrator invalida o cache.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from extrator_sisreg import VERSAO_EXTRATOR
+
+
+class CacheResultados:
+    """
+    Cache LRU com limite de entradas e contadores de acertos/falhas.
+
+    Args:
+        max_entradas: Número máximo de registros mantidos em memória
+    """
+
+    def __init__(self, max_entradas=256):
+        self.max_entradas = max_entradas
+        self.acertos = 0
+        self.falhas = 0
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def chave(conteudo):
+        """Calcula a chave do cache a partir dos bytes do PDF"""
+        return f"{VERSAO_EXTRATOR}:{hashlib.sha256(conteudo).hexdigest()}"
+
+    def obter(self, chave):
+        """
+        Retorna uma cópia do registro em cache ou None se não existir
+        """
+        with self._lock:
+            registro = self._dados.get(chave)
+            if registro is None:
+                self.falhas += 1
+                return None
+            self._dados.move_to_end(chave)
+            self.acertos += 1
+            return dict(registro)
+
+    def guardar(self, chave, registro):
+        """Armazena uma cópia do registro, descartando o menos usado se o limite for atingido"""
+        if self.max_entradas <= 0:
+            return
+        with self._lock:
+            self._dados[chave] = dict(registro)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.max_entradas:
+                self._dados.popitem(last=False)
+
+    def limpar(self):
+        """Remove todos os registros e zera os contadores"""
+        with self._lock:
+            self._dados.clear()
+            self.acertos = 0
+            self.falhas = 0
+
+    def estatisticas(self):
+        """Retorna os contadores do cache"""
+        with self._lock:
+            return {
+                "entradas": len(self._dados),
+                "max_entradas": self.max_entradas,
+                "acertos": self.acertos,
+                "falhas": self.falhas,
+            }
@@ -0,0 +1,353 @@
+"""
+Caixa de saída durável dos envios para o Google Sheets (rota /planilha).
+
+A requisição apenas grava os registros em um banco SQLite local e devolve o ID do
+envio (202); uma thread remetente em cada processo retira os envios prontos do banco e
+os entrega com `adicionar_dados_planilha`, repetindo com backoff exponencial enquanto a
+API estiver lenta ou fora do ar. Erros permanentes (credenciais ausentes, planilha sem
+coluna de código etc.) marcam o envio como falho na primeira tentativa. Os registros não
+se perdem se o processo terminar: a reserva do envio que está sendo entregue é renovada
+enquanto a entrega durar, e o envio volta para a fila quando ela expira.
+
+A idempotência é por código de solicitação: um código que ainda está na fila de uma
+planilha, ou que foi entregue há menos de `janela_duplicados` segundos, não entra de
+novo (o reenvio é informado como duplicado). Depois desse prazo, ou se o envio anterior
+falhou definitivamente, o código volta para a fila e a própria planilha decide: a
+entrega consulta os códigos já gravados (IndiceCodigos) e só escreve a linha se ela não
+estiver lá, de modo que uma linha apagada da planilha pode ser enviada de novo. Se o
+processo terminar depois da escrita na planilha e antes de marcar o envio como entregue,
+a nova tentativa encontra os códigos na planilha e os registra como duplicados, sem
+repetir as linhas.
+
+O banco é compartilhado pelos workers do gunicorn: cada envio é reservado por um único
+remetente com uma transação IMMEDIATE.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from diagnostico import obter_logger
+from metricas import metricas
+
+logger = obter_logger("sisreg.planilha")
+
+PENDENTE = "pendente"
+ENVIANDO = "enviando"
+ENTREGUE = "entregue"
+FALHOU = "falhou"
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS envios (
+    id TEXT PRIMARY KEY,
+    id_planilha TEXT NOT NULL,
+    estado TEXT NOT NULL,
+    tentativas INTEGER NOT NULL DEFAULT 0,
+    proxima_tentativa REAL NOT NULL,
+    reservado_ate REAL,
+    criado_em REAL NOT NULL,
+    atualizado_em REAL NOT NULL,
+    codigos_duplicados TEXT NOT NULL DEFAULT '[]',
+    resultado TEXT,
+    erro TEXT
+);
+CREATE INDEX IF NOT EXISTS envios_prontos ON envios (estado, proxima_tentativa);
+CREATE TABLE IF NOT EXISTS registros (
+    id_planilha TEXT NOT NULL,
+    codigo_solicitacao TEXT NOT NULL,
+    id_envio TEXT NOT NULL,
+    dados TEXT NOT NULL,
+    PRIMARY KEY (id_planilha, codigo_solicitacao)
+);
+CREATE INDEX IF NOT EXISTS registros_envio ON registros (id_envio);
+"""
+
+
+def _codigo(dado):
+    # Mesma normalização usada na planilha (ver validar_e_formatar_dados)
+    from google_sheets_integration_fix import validar_e_formatar_dados
+    return validar_e_formatar_dados(dado).get("codigo_solicitacao", "")
+
+
+class CaixaSaida:
+    """
+    Fila durável (SQLite) de envios para a planilha.
+
+    Args:
+        caminho: Arquivo do banco SQLite
+        enviar: Função (id_planilha, dados) -> resultado, ex.: `adicionar_dados_planilha`;
+            um resultado com a chave "erro" conta como falha, e um com "permanente"
+            verdadeiro não é tentado de novo
+        tentativas: Número máximo de tentativas de entrega de um envio
+        backoff: Espera (em segundos) antes da segunda tentativa, dobrada a cada falha
+        backoff_max: Espera máxima (em segundos) entre tentativas
+        reserva: Tempo (em segundos) após o qual um envio reservado por um processo que
+            não respondeu volta para a fila; a reserva é renovada a cada `reserva / 3`
+            segundos durante a entrega
+        intervalo: Intervalo (em segundos) entre as consultas do remetente ao banco
+        simultaneos: Envios entregues ao mesmo tempo pelo remetente (envios simultâneos
+            para a mesma planilha são reunidos pela fila de escrita)
+        janela_duplicados: Tempo (em segundos) após a entrega em que um reenvio do mesmo
+            código é recusado sem consultar a planilha
+    """
+
+    def __init__(self, caminho, enviar, tentativas=8, backoff=5.0, backoff_max=600.0,
+                 reserva=300.0, intervalo=2.0, simultaneos=4, janela_duplicados=3600.0):
+        self.caminho = caminho
+        self.enviar = enviar
+        self.tentativas = max(tentativas, 1)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.reserva = reserva
+        self.intervalo = intervalo
+        self.simultaneos = max(simultaneos, 1)
+        self.janela_duplicados = janela_duplicados
+        self._iniciado = False
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._remetente_pid = None
+
+    def _conectar(self):
+        # Uma conexão por operação: as conexões do sqlite3 não são compartilhadas entre
+        # threads nem sobrevivem ao fork
+        conexao = sqlite3.connect(self.caminho, timeout=30, isolation_level=None)
+        conexao.row_factory = sqlite3.Row
+        return conexao
+
+    def _iniciar_banco(self):
+        with self._lock:
+            if self._iniciado:
+                return
+            diretorio = os.path.dirname(self.caminho)
+            if diretorio:
+                os.makedirs(diretorio, exist_ok=True)
+            conexao = self._conectar()
+            try:
+                conexao.execute("PRAGMA journal_mode=WAL")
+                conexao.executescript(_ESQUEMA)
+            finally:
+                conexao.close()
+            self._iniciado = True
+
+    def registrar(self, id_planilha, dados):
+        """
+        Grava os registros na caixa de saída
+
+        Args:
+            id_planilha: ID da planilha
+            dados: Lista de dicionários extraídos (os com "erro" ou sem código são ignorados)
+
+        Returns:
+            Dicionário com o ID do envio (None se nenhum registro entrou na fila), o
+            número de registros na fila, os códigos recusados como duplicados (na fila ou
+            entregues dentro de `janela_duplicados`) e o número de registros inválidos
+        """
+        self._iniciar_banco()
+        validos = {}
+        invalidos = 0
+        for dado in dados:
+            codigo = _codigo(dado) if "erro" not in dado else ""
+            if not codigo:
+                invalidos += 1
+            elif codigo not in validos:
+                validos[codigo] = dado
+
+        id_envio = uuid.uuid4().hex
+        agora = time.time()
+        duplicados = []
+        conexao = self._conectar()
+        try:
+            conexao.execute("BEGIN IMMEDIATE")
+            for codigo, dado in validos.items():
+                # Um código já registrado só volta para a fila se o envio anterior falhou ou
+                # foi entregue antes da janela (a entrega confere a planilha)
+                cursor = conexao.execute(
+                    """INSERT INTO registros (id_planilha, codigo_solicitacao, id_envio, dados)
+                       VALUES (?, ?, ?, ?)
+                       ON CONFLICT (id_planilha, codigo_solicitacao) DO UPDATE
+                       SET id_envio = excluded.id_envio, dados = excluded.dados
+                       WHERE COALESCE((SELECT estado = ? OR (estado = ? AND atualizado_em < ?)
+                                       FROM envios WHERE id = registros.id_envio), 1)""",
+                    (id_planilha, codigo, id_envio, json.dumps(dado, ensure_ascii=False), FALHOU, ENTREGUE,
+                     agora - self.janela_duplicados))
+                if cursor.rowcount == 0:
+                    duplicados.append(codigo)
+            na_fila = len(validos) - len(duplicados)
+            if na_fila:
+                conexao.execute(
+                    """INSERT INTO envios (id, id_planilha, estado, proxima_tentativa, criado_em,
+                                           atualizado_em, codigos_duplicados)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (id_envio, id_planilha, PENDENTE, agora, agora, agora, json.dumps(duplicados)))
+            conexao.execute("COMMIT")
+        except Exception:
+            conexao.execute("ROLLBACK")
+            raise
+        finally:
+            conexao.close()
+
+        if na_fila:
+            logger.info("Envio %s registrado: planilha %s, %s registros", id_envio, id_planilha, na_fila)
+            self.garantir_remetente()
+            self._despertar.set()
+        return {
+            "id": id_envio if na_fila else None,
+            "registros_na_fila": na_fila,
+            "codigos_duplicados": duplicados,
+            "registros_invalidos": invalidos
+        }
+
+    def consultar(self, id_envio):
+        """
+        Returns:
+            Dicionário com o estado da entrega do envio, ou None se ele não existir
+        """
+        self._iniciar_banco()
+        conexao = self._conectar()
+        try:
+            envio = conexao.execute("SELECT * FROM envios WHERE id = ?", (id_envio,)).fetchone()
+            if envio is None:
+                return None
+            total = conexao.execute("SELECT COUNT(*) FROM registros WHERE id_envio = ?",
+                                    (id_envio,)).fetchone()[0]
+        finally:
+            conexao.close()
+        resumo = {
+            "id": envio["id"],
+            "id_planilha": envio["id_planilha"],
+            "estado": envio["estado"],
+            "tentativas": envio["tentativas"],
+            "registros": total,
+            "codigos_duplicados": json.loads(envio["codigos_duplicados"]),
+            "criado_em": envio["criado_em"],
+            "atualizado_em": envio["atualizado_em"]
+        }
+        if envio["estado"] == PENDENTE and envio["tentativas"]:
+            resumo["proxima_tentativa"] = envio["proxima_tentativa"]
+        if envio["resultado"]:
+            resumo["resultado"] = json.loads(envio["resultado"])
+        if envio["erro"]:
+            resumo["erro"] = envio["erro"]
+        return resumo
+
+    def garantir_remetente(self):
+        """Inicia a thread remetente deste processo, se ainda não estiver rodando"""
+        # As threads não sobrevivem ao fork: cada worker do gunicorn inicia a sua
+        with self._lock:
+            if self._remetente_pid == os.getpid():
+                return
+            self._remetente_pid = os.getpid()
+            self._despertar = threading.Event()
+        threading.Thread(target=self._remeter, name="caixa-saida", daemon=True).start()
+
+    def _reservar(self):
+        """Reserva os envios prontos (até `simultaneos`) para este processo"""
+        agora = time.time()
+        conexao = self._conectar()
+        try:
+            conexao.execute("BEGIN IMMEDIATE")
+            envios = conexao.execute(
+                """SELECT id, id_planilha, tentativas FROM envios
+                   WHERE (estado = ? AND proxima_tentativa <= ?) OR (estado = ? AND reservado_ate < ?)
+                   ORDER BY criado_em LIMIT ?""",
+                (PENDENTE, agora, ENVIANDO, agora, self.simultaneos)).fetchall()
+            for envio in envios:
+                conexao.execute("UPDATE envios SET estado = ?, reservado_ate = ?, atualizado_em = ? WHERE id = ?",
+                                (ENVIANDO, agora + self.reserva, agora, envio["id"]))
+            conexao.execute("COMMIT")
+        except Exception:
+            conexao.execute("ROLLBACK")
+            raise
+        finally:
+            conexao.close()
+        return [dict(envio) for envio in envios]
+
+    def _atualizar(self, id_envio, **campos):
+        campos["atualizado_em"] = time.time()
+        conexao = self._conectar()
+        try:
+            conexao.execute(f"UPDATE envios SET {', '.join(f'{campo} = ?' for campo in campos)} WHERE id = ?",
+                            (*campos.values(), id_envio))
+        finally:
+            conexao.close()
+
+    def _renovar(self, id_envio, concluido):
+        """Renova a reserva do envio até a entrega terminar (mesmo se exceder `reserva`)"""
+        while not concluido.wait(self.reserva / 3):
+            try:
+                conexao = self._conectar()
+                try:
+                    conexao.execute("UPDATE envios SET reservado_ate = ? WHERE id = ? AND estado = ?",
+                                    (time.time() + self.reserva, id_envio, ENVIANDO))
+                finally:
+                    conexao.close()
+            except Exception:
+                logger.exception("Erro ao renovar a reserva do envio %s", id_envio)
+
+    def _entregar(self, envio):
+        id_envio = envio["id"]
+        conexao = self._conectar()
+        try:
+            dados = [json.loads(linha[0]) for linha in conexao.execute(
+                "SELECT dados FROM registros WHERE id_envio = ? ORDER BY rowid", (id_envio,))]
+            criado_em = conexao.execute("SELECT criado_em FROM envios WHERE id = ?",
+                                        (id_envio,)).fetchone()[0]
+        finally:
+            conexao.close()
+
+        tentativas = envio["tentativas"] + 1
+        concluido = threading.Event()
+        threading.Thread(target=self._renovar, args=(id_envio, concluido), name="caixa-saida-reserva",
+                         daemon=True).start()
+        try:
+            resultado = self.enviar(envio["id_planilha"], dados)
+        except Exception as e:
+            logger.exception("Erro ao entregar o envio %s", id_envio)
+            resultado = {"erro": str(e)}
+        finally:
+            concluido.set()
+
+        if "erro" not in resultado:
+            self._atualizar(id_envio, estado=ENTREGUE, tentativas=tentativas, reservado_ate=None, erro=None,
+                            resultado=json.dumps(resultado, ensure_ascii=False))
+            metricas.incrementar("sisreg_saida_envios_total", resultado="entregue")
+            metricas.observar("sisreg_saida_atraso_segundos", time.time() - criado_em)
+            logger.info("Envio %s entregue na tentativa %s: %s", id_envio, tentativas, resultado.get("mensagem"))
+            return
+
+        if tentativas >= self.tentativas or resultado.get("permanente"):
+            self._atualizar(id_envio, estado=FALHOU, tentativas=tentativas, reservado_ate=None,
+                            erro=resultado["erro"])
+            metricas.incrementar("sisreg_saida_envios_total", resultado="falhou")
+            if resultado.get("permanente"):
+                logger.error("Envio %s falhou com erro permanente: %s", id_envio, resultado["erro"])
+            else:
+                logger.error("Envio %s falhou após %s tentativas: %s", id_envio, tentativas, resultado["erro"])
+            return
+
+        espera = min(self.backoff_max, self.backoff * 2 ** (tentativas - 1))
+        self._atualizar(id_envio, estado=PENDENTE, tentativas=tentativas, reservado_ate=None,
+                        proxima_tentativa=time.time() + espera, erro=resultado["erro"])
+        metricas.incrementar("sisreg_saida_envios_total", resultado="nova_tentativa")
+        logger.warning("Envio %s não entregue (tentativa %s): %s; nova tentativa em %.0fs",
+                       id_envio, tentativas, resultado["erro"], espera)
+
+    def _remeter(self):
+        self._iniciar_banco()
+        with ThreadPoolExecutor(max_workers=self.simultaneos, thread_name_prefix="caixa-saida") as executor:
+            while True:
+                try:
+                    envios = self._reservar()
+                except Exception:
+                    logger.exception("Erro ao consultar a caixa de saída")
+                    envios = []
+                if not envios:
+                    self._despertar.wait(self.intervalo)
+                    self._despertar.clear()
+                    continue
+                # Os envios reservados juntos são entregues em paralelo (ver FilaEscrita)
+                list(executor.map(self._entregar, envios))
@@ -1,6 +1,76 @@
 import unicodedata
 import re
 
+_RE_UF_CEP = re.compile(r'(\s[A-Z]{2})(\d)')
+
+
+class AutomatoCidades:
+    """
+    Autômato de Aho-Corasick sobre os nomes das cidades, para encontrar todas as
+    ocorrências em uma única passada pelo texto.
+
+    Cada estado guarda a melhor ocorrência que termina nele (o nome mais longo; em caso
+    de empate, o que vem primeiro na lista), já combinada com a dos estados de falha.
+    Entre posições diferentes vence a ocorrência que termina por último: no SISREG o
+    bairro vem colado antes do município (ex.: "SÃO FRANCISCOMONTE HOREBE").
+
+    Args:
+        padroes: Pares (nome normalizado, valor retornado), em ordem de prioridade
+    """
+
+    def __init__(self, padroes):
+        self._transicoes = [{}]
+        self._falha = [0]
+        self._melhor = [None]  # (tamanho, -ordem, valor)
+
+        for ordem, (chave, valor) in enumerate(padroes):
+            if not chave:
+                continue
+            estado = 0
+            for c in chave:
+                proximo = self._transicoes[estado].get(c)
+                if proximo is None:
+                    proximo = len(self._transicoes)
+                    self._transicoes[estado][c] = proximo
+                    self._transicoes.append({})
+                    self._falha.append(0)
+                    self._melhor.append(None)
+                estado = proximo
+            candidato = (len(chave), -ordem, valor)
+            if self._melhor[estado] is None or candidato[:2] > self._melhor[estado][:2]:
+                self._melhor[estado] = candidato
+
+        # Links de falha em largura: o estado de falha é sempre mais raso
+        fila = list(self._transicoes[0].values())
+        for estado in fila:
+            for c, proximo in self._transicoes[estado].items():
+                falha = self._falha[estado]
+                while falha and c not in self._transicoes[falha]:
+                    falha = self._falha[falha]
+                self._falha[proximo] = self._transicoes[falha].get(c, 0)
+                herdado = self._melhor[self._falha[proximo]]
+                if herdado and (self._melhor[proximo] is None or herdado[:2] > self._melhor[proximo][:2]):
+                    self._melhor[proximo] = herdado
+                fila.append(proximo)
+
+    def maior_ocorrencia(self, texto):
+        """
+        Returns:
+            Valor do nome mais longo entre os que terminam na posição mais à direita do
+            texto, ou None se nenhum for encontrado
+        """
+        transicoes, falha, melhor_estado = self._transicoes, self._falha, self._melhor
+        estado = 0
+        melhor = None
+        for c in texto:
+            while estado and c not in transicoes[estado]:
+                estado = falha[estado]
+            estado = transicoes[estado].get(c, 0)
+            if melhor_estado[estado]:
+                melhor = melhor_estado[estado]
+        return melhor[2] if melhor else None
+
+
 class CidadesParaiba:
     cidades = [
         "AGUIAR", "ALAGOA GRANDE", "ALAGOA NOVA", "ALAGOINHA", "ALHANDRA", "AMPARO", "APARECIDA", "ARAÇAGI",
@@ -38,6 +108,8 @@ class CidadesParaiba:
         "VÁRZEA", "VIEIRÓPOLIS", "VISTA SERRANA"
     ]
 
+    _automato = None
+
     @classmethod
     def remover_acentos(cls, texto):
         return ''.join(
@@ -45,15 +117,23 @@ class CidadesParaiba:
             if unicodedata.category(c) != 'Mn'
         )
 
+    @classmethod
+    def automato(cls):
+        """Retorna o autômato com os nomes sem acento (construído uma única vez)"""
+        if cls._automato is None:
+            cls._automato = AutomatoCidades(
+                (cls.remover_acentos(cidade.upper()), cidade) for cidade in cls.cidades)
+        return cls._automato
+
     @classmethod
     def validar_municipio(cls, nome_extraido):
         nome_extraido = cls.remover_acentos(nome_extraido.upper().strip())
 
         # Corrige caso esteja grudado com o CEP, ex: "POMBAL - PB58840-000"
-        nome_extraido = re.sub(r'(\s[A-Z]{2})(\d)', r'\1 \2', nome_extraido)
+        nome_extraido = _RE_UF_CEP.sub(r'\1 \2', nome_extraido)
 
-        for cidade in cls.cidades:
-            cidade_sem_acentos = cls.remover_acentos(cidade.upper())
-            if cidade_sem_acentos in nome_extraido:
-                return cidade  # Retorna o nome com acento da lista original
+        # Nome de cidade no fim do texto, o mais longo (ex.: "BELÉM DO BREJO DO CRUZ" e não "BELÉM")
+        cidade = cls.automato().maior_ocorrencia(nome_extraido)
+        if cidade:
+            return cidade  # Retorna o nome com acento da lista original
         return "NÃO ENCONTRADO"
@@ -0,0 +1,227 @@
+"""
+Logging e diagnóstico da aplicação.
+
+As mensagens são registradas em níveis (DEBUG, INFO, WARNING, ERROR) e passam por uma
+fila (QueueHandler): a escrita no console e nos arquivos acontece em uma thread separada
+(QueueListener), fora da thread da requisição. Os arquivos de log são rotacionados por
+tamanho.
+
+Os workers do gunicorn e os processos isolados de leitura (ver isolamento.py) escrevem
+nos mesmos arquivos: a rotação é feita sob uma trava de arquivo (flock) compartilhada
+pelos processos, e cada processo reabre o arquivo quando outro o rotaciona.
+
+A captura do texto completo dos PDFs é opcional e amostrada (CAPTURA_TEXTO_AMOSTRAGEM),
+e os textos capturados ficam em um buffer circular em memória, consultável pela rota
+/diagnostico/textos.
+"""
+
+import os
+import queue
+import random
+import atexit
+import logging
+import threading
+import logging.handlers
+from collections import deque
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: a rotação é feita sem a trava entre processos
+    fcntl = None
+
+# Configurações (variáveis de ambiente)
+LOG_NIVEL = os.environ.get("LOG_NIVEL", "INFO").upper()
+# Arquivos de log (a pasta é criada na primeira mensagem gravada)
+LOG_ARQUIVO = os.environ.get("LOG_ARQUIVO", os.path.join("logs", "app_log.txt"))
+LOG_ARQUIVO_PLANILHA = os.environ.get("LOG_ARQUIVO_PLANILHA", os.path.join("logs", "google_sheets_log.txt"))
+LOG_TAMANHO_MAXIMO = int(os.environ.get("LOG_TAMANHO_MAXIMO", 5 * 1024 * 1024))  # 5MB por arquivo
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", 3))
+# Fração dos documentos cujo texto completo é capturado (0 desliga a captura)
+CAPTURA_TEXTO_AMOSTRAGEM = float(os.environ.get("CAPTURA_TEXTO_AMOSTRAGEM", 0))
+CAPTURA_TEXTO_MAX = int(os.environ.get("CAPTURA_TEXTO_MAX", 50))
+
+LOGGER_RAIZ = "sisreg"
+LOGGER_PLANILHA = "sisreg.planilha"
+
+_FORMATO = logging.Formatter("[%(asctime)s] %(levelname)s %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S")
+
+_handlers = []
+_queue_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+class ArquivoRotativoCompartilhado(logging.handlers.WatchedFileHandler):
+    """
+    Arquivo de log rotacionado por tamanho que pode ser escrito por vários processos.
+
+    Cada escrita é feita com a trava `<arquivo>.lock`; o processo que encontra o arquivo
+    acima do limite faz a rotação, e os demais reabrem o arquivo novo na próxima escrita
+    (WatchedFileHandler), em vez de cada um rotacionar a sua própria cópia.
+
+    Args:
+        arquivo: Caminho do arquivo de log
+        tamanho_maximo: Tamanho (em bytes) a partir do qual o arquivo é rotacionado
+        backups: Número de arquivos antigos mantidos (arquivo.1, arquivo.2, ...)
+    """
+
+    def __init__(self, arquivo, tamanho_maximo, backups):
+        super().__init__(arquivo, encoding="utf-8", delay=True)
+        self.tamanho_maximo = tamanho_maximo
+        self.backups = backups
+        self._trava = None
+        self._trava_pid = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+    def _obter_trava(self):
+        # O descritor herdado no fork é compartilhado com o pai: cada processo abre o seu
+        if self._trava is None or self._trava_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+            self._trava = open(self.baseFilename + ".lock", "a")
+            self._trava_pid = os.getpid()
+        return self._trava
+
+    def _rotacionar(self):
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                origem = f"{self.baseFilename}.{i}"
+                if os.path.exists(origem):
+                    os.replace(origem, f"{self.baseFilename}.{i + 1}")
+            os.replace(self.baseFilename, f"{self.baseFilename}.1")
+        else:
+            open(self.baseFilename, "w").close()
+
+    def emit(self, record):
+        try:
+            trava = self._obter_trava() if fcntl is not None else None
+            if trava is not None:
+                fcntl.flock(trava, fcntl.LOCK_EX)
+            try:
+                try:
+                    if self.tamanho_maximo and os.path.getsize(self.baseFilename) >= self.tamanho_maximo:
+                        self._rotacionar()
+                except FileNotFoundError:
+                    pass
+                # Reabre o arquivo se ele foi rotacionado (por este ou por outro processo)
+                super().emit(record)
+            finally:
+                if trava is not None:
+                    fcntl.flock(trava, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+
+def _criar_handlers():
+    """Cria os handlers de saída usados pela thread de escrita"""
+    console = logging.StreamHandler()
+    console.setFormatter(_FORMATO)
+
+    arquivo = ArquivoRotativoCompartilhado(LOG_ARQUIVO, LOG_TAMANHO_MAXIMO, LOG_BACKUPS)
+    arquivo.setFormatter(_FORMATO)
+
+    # Log separado para a integração com o Google Sheets
+    planilha = ArquivoRotativoCompartilhado(LOG_ARQUIVO_PLANILHA, LOG_TAMANHO_MAXIMO, LOG_BACKUPS)
+    planilha.setFormatter(_FORMATO)
+    planilha.addFilter(logging.Filter(LOGGER_PLANILHA))
+
+    return [console, arquivo, planilha]
+
+
+def _iniciar_listener():
+    global _listener
+    fila = queue.Queue(-1)
+    _queue_handler.queue = fila
+    _listener = logging.handlers.QueueListener(fila, *_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _reiniciar_apos_fork():
+    # A thread de escrita não existe no processo filho: criar uma nova fila e uma nova thread
+    global _lock
+    _lock = threading.Lock()
+    if _queue_handler is not None:
+        _iniciar_listener()
+
+
+def configurar_logging():
+    """
+    Configura o logger "sisreg" (idempotente).
+
+    Returns:
+        Logger raiz da aplicação
+    """
+    global _handlers, _queue_handler
+    logger = logging.getLogger(LOGGER_RAIZ)
+    with _lock:
+        if _queue_handler is not None:
+            return logger
+
+        _handlers = _criar_handlers()
+        _queue_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+        _iniciar_listener()
+
+        logger.setLevel(LOG_NIVEL)
+        logger.addHandler(_queue_handler)
+        logger.propagate = False
+
+        os.register_at_fork(after_in_child=_reiniciar_apos_fork)
+        atexit.register(encerrar_logging)
+    return logger
+
+
+def encerrar_logging():
+    """Esvazia a fila e encerra a thread de escrita"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def obter_logger(nome):
+    """Retorna um logger da aplicação (ex.: "sisreg.extracao")"""
+    configurar_logging()
+    return logging.getLogger(nome)
+
+
+class CapturaTexto:
+    """
+    Buffer circular com os textos completos de uma amostra dos PDFs processados.
+
+    Args:
+        amostragem: Fração dos documentos a capturar (0 desliga a captura, 1 captura todos)
+        max_entradas: Número máximo de textos mantidos em memória
+    """
+
+    def __init__(self, amostragem=0.0, max_entradas=50):
+        self.amostragem = amostragem
+        self._entradas = deque(maxlen=max_entradas)
+        self._lock = threading.Lock()
+
+    def deve_capturar(self):
+        """Sorteia se o próximo documento deve ter o texto capturado"""
+        return self.amostragem > 0 and random.random() < self.amostragem
+
+    def registrar(self, nome_arquivo, texto, dados):
+        """Guarda o texto e os campos extraídos de um documento"""
+        with self._lock:
+            self._entradas.append({
+                "arquivo": nome_arquivo,
+                "data": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "texto": texto,
+                "dados": dados,
+            })
+
+    def listar(self, nome_arquivo=None):
+        """Retorna os textos capturados (opcionalmente apenas os de um arquivo)"""
+        with self._lock:
+            entradas = list(self._entradas)
+        if nome_arquivo:
+            entradas = [entrada for entrada in entradas if entrada["arquivo"] == nome_arquivo]
+        return entradas
+
+
+captura_texto = CapturaTexto(CAPTURA_TEXTO_AMOSTRAGEM, CAPTURA_TEXTO_MAX)
@@ -0,0 +1,746 @@
+"""
+Motor de extração de campos dos PDFs do SISREG III.
+
+Todas as expressões regulares usadas por `extrair_dados` são compiladas uma única
+vez, na importação do módulo, e as cascatas de cada campo ficam declaradas como
+dados (listas ordenadas de padrões). Cada padrão pode declarar "âncoras": trechos
+literais que precisam existir no texto para que ele tenha chance de casar. O texto
+é convertido para minúsculas uma única vez e os padrões cujas âncoras não aparecem
+são descartados sem varrer o documento.
+
+Antes das cascatas, uma única varredura localiza os rótulos do SISREG III ("Código da
+Solicitação", "DADOS DO PACIENTE", "UNIDADE EXECUTANTE"...) e guarda as suas posições
+(`IndiceRotulos`). Os padrões que começam por um rótulo são testados apenas a partir
+de cada ocorrência dele, numa janela que termina no cabeçalho da seção seguinte, em
+vez de recomeçar do início do texto.
+"""
+
+import re
+import time
+from bisect import bisect_right
+from functools import lru_cache
+from cidades_paraiba import CidadesParaiba
+from diagnostico import obter_logger
+from metricas import metricas
+
+logger = obter_logger("sisreg.extracao")
+
+# Incrementar sempre que uma mudança nas cascatas alterar os valores extraídos
+# (invalida os resultados guardados em cache_resultados)
+VERSAO_EXTRATOR = "4"
+
+NAO_ENCONTRADO = "NÃO ENCONTRADO"
+
+CAMPOS = ("codigo_solicitacao", "cns", "unidade_solicitante",
+          "unidade_executante", "data_exame", "procedimento")
+
+
+# Rótulos localizados pela varredura inicial. A expressão de cada rótulo precisa casar em
+# todas as posições em que casa o início dos padrões que o declaram (ver Padrao)
+ROTULOS = {
+    "unidade_solicitante": r'UNIDADE\s*SOLICITANTE',
+    "unidade_executante": r'UNIDADE\s*EXECUTANTE',
+    "dados_paciente": r'DADOS\s+DO\s+PACIENTE',
+    "dados_solicitacao": r'DADOS\s*DA\s*SOLICITA[ÇC][ÃA]O',
+    "codigo_solicitacao": r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o',
+    "municipio_residencia": r'Município\s*(?:de)?\s*Resid[êe]ncia',
+    "procedimentos_autorizados": r'Procedimentos\s*Autorizados',
+    "data_atendimento": r'Data\s*e\s*Hor[áa]rio\s*de\s*Atendimento',
+}
+
+# Cabeçalhos das seções do documento: a janela de um rótulo termina no próximo deles
+SECOES = frozenset(("unidade_solicitante", "unidade_executante", "dados_paciente", "dados_solicitacao"))
+
+# Início de cada rótulo no texto em minúsculas (casefold), procurado com str.find; cada
+# ocorrência é confirmada com a expressão do rótulo no texto original
+_INICIOS_ROTULOS = (
+    ("unidade", ("unidade_solicitante", "unidade_executante")),
+    ("dados", ("dados_paciente", "dados_solicitacao")),
+    ("código", ("codigo_solicitacao",)),
+    ("codigo", ("codigo_solicitacao",)),
+    ("município", ("municipio_residencia",)),
+    ("procedimentos", ("procedimentos_autorizados",)),
+    ("data", ("data_atendimento",)),
+)
+_RE_ROTULO = {nome: re.compile(regex, re.IGNORECASE) for nome, regex in ROTULOS.items()}
+_RE_ROTULOS = re.compile("|".join(f"(?P<{nome}>{regex})" for nome, regex in ROTULOS.items()), re.IGNORECASE)
+
+
+class IndiceRotulos:
+    """
+    Posições dos rótulos do SISREG III em um texto, encontradas em uma única varredura.
+
+    Args:
+        texto: Texto extraído do PDF
+        texto_minusculo: O mesmo texto após casefold (opcional)
+    """
+
+    __slots__ = ("posicoes", "secoes", "tamanho")
+
+    def __init__(self, texto, texto_minusculo=None):
+        self.posicoes = {}
+        self.tamanho = len(texto)
+        if texto_minusculo is not None and len(texto_minusculo) == len(texto):
+            for inicio, nomes in _INICIOS_ROTULOS:
+                posicao = texto_minusculo.find(inicio)
+                while posicao != -1:
+                    for nome in nomes:
+                        if _RE_ROTULO[nome].match(texto, posicao):
+                            self.posicoes.setdefault(nome, []).append(posicao)
+                            break
+                    posicao = texto_minusculo.find(inicio, posicao + 1)
+            for posicoes in self.posicoes.values():
+                posicoes.sort()
+        else:
+            # O casefold mudou o tamanho do texto (ex.: "ß" -> "ss") e as posições não
+            # correspondem: localizar os rótulos direto no texto original
+            for match in _RE_ROTULOS.finditer(texto):
+                self.posicoes.setdefault(match.lastgroup, []).append(match.start())
+        self.secoes = sorted(posicao for nome in SECOES for posicao in self.posicoes.get(nome, ()))
+
+    def janelas(self, rotulo):
+        """
+        Yields:
+            Tuplas (inicio, fim) para cada ocorrência do rótulo, em ordem: `inicio` é a
+            posição do rótulo e `fim` a do próximo cabeçalho de seção (ou o fim do texto)
+        """
+        for inicio in self.posicoes.get(rotulo, ()):
+            i = bisect_right(self.secoes, inicio)
+            yield inicio, self.secoes[i] if i < len(self.secoes) else self.tamanho
+
+
+class Padrao:
+    """
+    Expressão regular pré-compilada de uma cascata de extração.
+
+    Args:
+        regex: Expressão regular (string)
+        flags: Flags do módulo re
+        ancoras: Trechos em minúsculas que precisam existir no texto para o padrão casar
+        prefixo: Texto adicionado antes do valor capturado
+        grupo: Grupo a ser retornado (0 para o trecho completo)
+        rotulo: Rótulo de ROTULOS pelo qual a expressão começa; o padrão é testado apenas
+            nas ocorrências do rótulo, dentro da janela de cada uma
+    """
+
+    __slots__ = ("regex", "ancoras", "prefixo", "grupo", "rotulo")
+
+    def __init__(self, regex, flags=0, ancoras=(), prefixo="", grupo=1, rotulo=None):
+        self.regex = re.compile(regex, flags)
+        self.ancoras = tuple(ancoras)
+        self.prefixo = prefixo
+        self.grupo = grupo
+        self.rotulo = rotulo
+
+    def buscar(self, texto, texto_minusculo, rotulos=None):
+        """
+        Executa a busca apenas se todas as âncoras estiverem presentes no texto. Com o
+        índice de rótulos, um padrão com `rotulo` é ancorado em cada ocorrência do rótulo.
+        """
+        for ancora in self.ancoras:
+            if ancora not in texto_minusculo:
+                return None
+        if self.rotulo is None or rotulos is None:
+            return self.regex.search(texto)
+        for inicio, fim in rotulos.janelas(self.rotulo):
+            match = self.regex.match(texto, inicio, fim)
+            if match:
+                return match
+        return None
+
+    def valor(self, match):
+        """Retorna o valor capturado pelo padrão, já com o prefixo"""
+        return self.prefixo + match.group(self.grupo).strip()
+
+
+I = re.IGNORECASE
+IM = re.IGNORECASE | re.MULTILINE
+
+# Extrair CNS - procurar especificamente por padrões de CNS
+CASCATA_CNS = (
+    Padrao(r'CNS\s*:?\s*(\d{15})', I, ["cns"]),  # CNS com 15 dígitos após "CNS:"
+    Padrao(r'CNS\s*:?\s*(\d+)', I, ["cns"]),     # Qualquer número após "CNS:"
+    Padrao(r'DADOS\s+DO\s+PACIENTE[\s\S]*?CNS\s*:?\s*(\d+)', I, ["paciente", "cns"],
+           rotulo="dados_paciente"),  # CNS na seção de dados do paciente
+    Padrao(r'Apelido\s*:?\s*(\d{15})', I, ["apelido"]),
+    # Procurar por números de 15 dígitos (formato típico do CNS)
+    Padrao(r'\b(\d{15})\b'),
+)
+
+# Extrair código de solicitação
+CASCATA_CODIGO = (
+    # NOVOS PADRÕES: Código seguido imediatamente por data
+    # Busca por "Vaga Solicitada:Vaga Consumida:" seguido por código de 9 dígitos começando com 5 e data
+    Padrao(r'Código da Solicitação:\s*Situação Atual:\s*(5\d{8})', IM, ["digo da solicita", "atual:"],
+           rotulo="codigo_solicitacao"),
+
+    # Busca por "Consumida:" seguido por código de 9 dígitos começando com 5 e data
+    Padrao(r'Consumida\s*:\s*(5\d{8})(\d{2}/\d{2}/\d{4})', IM, ["consumida"]),
+
+    # Busca por qualquer ":" seguido por código de 9 dígitos começando com 5 e data
+    Padrao(r':\s*(5\d{8})(\d{2}/\d{2}/\d{4})', IM, [":"]),
+
+    # Busca genérica por código de 9 dígitos começando com 5 seguido por data
+    Padrao(r'\b(5\d{8})(\d{2}/\d{2}/\d{4})\b', IM, ["/"]),
+
+    # PADRÕES ANTERIORES: Código que começa com 5
+    # Busca por "Código da Solicitação" e depois procura por um número de 9 dígitos que começa com 5
+    Padrao(r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?[\s\S]{0,100}?(5\d{8})\b', IM, ["digo", "solicita"],
+           rotulo="codigo_solicitacao"),
+
+    # Busca por "Código da Solicitação:" seguido de número que começa com 5
+    Padrao(r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?\s*(5\d+)', IM, ["digo", "solicita"],
+           rotulo="codigo_solicitacao"),
+
+    # Busca por número de 9 dígitos que começa com 5 após "Vaga Solicitada" e "Vaga Consumida"
+    Padrao(r'Vaga\s+Solicitada\s*:?\s*Vaga\s+Consumida\s*:?[\s\S]{0,100}?(5\d{8})\b', IM, ["solicitada", "consumida"]),
+
+    # Busca por número de 9 dígitos que começa com 5 após "1ª Vez"
+    Padrao(r'1[ªa]\s+Vez[\s\S]{0,50}?(5\d{8})\b', IM, ["vez"]),
+
+    # Busca por número de 9 dígitos que começa com 5 isolado no início de uma linha
+    Padrao(r'^\s*(5\d{8})\s*$', IM),
+
+    # Busca por número de 9 dígitos que começa com 5 em qualquer lugar
+    Padrao(r'\b(5\d{8})\b', IM),
+
+    # Busca por número de 9 dígitos que começa com 5 após "Situação Atual"
+    Padrao(r'Situação+Atual*:?[\s\S]{0,100}?(5\d{8})\b', IM, ["atua"]),
+
+    # PADRÕES DE FALLBACK: Menos específicos
+    Padrao(r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?[\s\S]{0,100}?(\d{9})\b', IM, ["digo", "solicita"],
+           rotulo="codigo_solicitacao"),
+    Padrao(r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?\s*(\d+)', IM, ["digo", "solicita"],
+           rotulo="codigo_solicitacao"),
+    Padrao(r'Vaga\s+Solicitada\s*:?\s*Vaga\s+Consumida\s*:?[\s\S]{0,100}?(\d{9})\b', IM, ["solicitada", "consumida"]),
+    Padrao(r'1[ªa]\s+Vez[\s\S]{0,50}?(\d{9})\b', IM, ["vez"]),
+    Padrao(r'^\s*(\d{9})\s*$', IM),
+    Padrao(r'\b(\d{9})\b', IM),
+)
+
+# Padrões que não exigem o dígito 5 podem aceitar códigos com outro prefixo
+# (apenas se nenhum outro código tiver sido encontrado antes)
+_CODIGO_ACEITA_OUTRO_PREFIXO = tuple('5' not in p.regex.pattern for p in CASCATA_CODIGO)
+
+# Novo padrão para unidade_executante
+PADRAO_UNIDADE_EXECUTANTE = Padrao(
+    r'UNIDADE\s*EXECUTANTE[\s\S]*?Nome\s*:\s*([A-Z\sÀ-ÖØ-öø-ÿ]+?)(?:\s*Endereço|\s*C[óo]d\.\s*CNES|\s*Número|\s*Telefone|\s*Op\.\s*Autorizador|\s*Vaga\s*Consumida|$)',
+    I, ["executante", "nome"], rotulo="unidade_executante")
+
+# Padrões alternativos para unidade executante
+CASCATA_UNIDADE_EXECUTANTE = (
+    # Busca por HOSPITAL seguido de texto (preservando o nome "HOSPITAL")
+    Padrao(r'HOSPITAL\s+([^\r\n:]+)', I, ["hospital"], prefixo="HOSPITAL "),
+
+    # Busca por nome após "UNIDADE EXECUTANTE" e "Nome:"
+    Padrao(r'UNIDADE\s*EXECUTANTE[\s\S]*?Nome\s*:\s*([A-Z][A-Z\s]+)', I, ["executante", "nome"],
+           rotulo="unidade_executante"),
+
+    # Busca por nome após "EXECUTANTE" e "Nome:"
+    Padrao(r'EXECUTANTE[\s\S]*?Nome\s*:\s*([A-Z][A-Z\s]+)', I, ["executante", "nome"]),
+
+    # Busca por nome entre "Nome:" e "Endereço:"
+    Padrao(r'Nome\s*:\s*([A-Z][A-Z\s]+)(?:[\s\S]*?Endere[çc]o\s*:)', I, ["nome", "endere"]),
+
+    # Busca por nome após "UNIDADE EXECUTANTE"
+    Padrao(r'UNIDADE\s*EXECUTANTE[\s\S]*?([A-Z][A-Z\s]+(?:HOSPITAL|CLÍNICA|CENTRO|INSTITUTO)[^\r\n:]+)', I,
+           ["executante"], prefixo="HOSPITAL ", rotulo="unidade_executante"),
+
+    # Buscar diretamente por padrões de hospital no texto, capturando o trecho completo
+    Padrao(r'HOSPITAL\s+([A-ZÀ-Úa-zà-ú\s]+)', I, ["hospital"], grupo=0),
+    Padrao(r'HOSPITAL\s+DE\s+([A-ZÀ-Úa-zà-ú\s]+)', I, ["hospital"], grupo=0),
+    Padrao(r'HOSPITAL\s+([A-ZÀ-Úa-zà-ú\s]+)(?:[\s\S]*?Endere[çc]o\s*:)', I, ["hospital", "endere"], grupo=0),
+)
+
+PADRAO_DATA_EXAME = Padrao(r'Data\s*e\s*Hor[áa]rio\s*de\s*Atendimento\s*:?\s*([^\r\n]+)', I, ["atendimento"],
+                           rotulo="data_atendimento")
+
+# Abordagens alternativas para data do exame
+CASCATA_DATA_EXAME = (
+    # Busca por padrão de data e hora
+    Padrao(r'(\d{2}/\d{2}/\d{4}\s*\d{2}:\d{2})', I, ["/", ":"]),
+
+    # Busca por data após "Data de Atendimento:"
+    Padrao(r'Data\s*de\s*Atendimento\s*:?\s*([^\r\n]+)', I, ["atendimento"]),
+)
+
+PADRAO_PROCEDIMENTO = Padrao(r'Procedimentos\s*Autorizados\s*:?[\s\S]*?([^\r\n]+?)(?:\s{2,}|\r|\n)', I,
+                             ["autorizados"], rotulo="procedimentos_autorizados")
+
+# Padrões alternativos para procedimento (capturando o trecho completo)
+CASCATA_PROCEDIMENTO = (
+    # Busca por CONSULTA EM seguido de texto
+    Padrao(r'CONSULTA\s+EM\s+([A-ZÀ-Úa-zà-ú\s\-]+)', I, ["consulta"], grupo=0),
+
+    # Busca por TOMOGRAFIA seguido de texto
+    Padrao(r'TOMOGRAFIA\s+([A-ZÀ-Úa-zà-ú\s\-]+)', I, ["tomografia"], grupo=0),
+
+    # Busca por EXAME seguido de texto
+    Padrao(r'EXAME\s+([A-ZÀ-Úa-zà-ú\s\-]+)', I, ["exame"], grupo=0),
+)
+
+# Padrão principal: Captura o texto após "Município de Residência:"
+PADRAO_MUNICIPIO = Padrao(
+    r'Município\s*(?:de)?\s*Resid[êe]ncia\s*:\s*([^\r\n]+?)(?:\s*\d{5}-\d{3}|\s*Telefone\(s\):|\s*Laudo\s*/\s*Justificativa:|\s*DADOS\s*DA\s*SOLICITA[ÇC][ÃA]O|$)',
+    I, ["resid"], rotulo="municipio_residencia")
+PADRAO_MUNICIPIO_FALLBACK = Padrao(r'Município\s*de\s*Residência\s*:?(.*?)(?:\d{5}-\d{3}|Telefone\(s\):)', I,
+                                   ["resid"], rotulo="municipio_residencia")
+
+_RE_DATA = re.compile(r'(\d{2}/\d{2}/\d{4})')
+_RE_DIGITO = re.compile(r'\d')
+_RE_NAO_NOME = re.compile(r'[^\w\sÀ-ÖØ-öø-ÿ-]', re.UNICODE)
+_RE_ESPACOS = re.compile(r'\s+')
+_RE_LETRA = re.compile(r'[A-ZÀ-ÖØ-öø-ÿ]', re.IGNORECASE)
+_RE_CONSULTA = re.compile(r'(CONSULTA\s+EM\s+[A-ZÀ-Úa-zà-ú\s\-]+)', re.IGNORECASE)
+_RE_OUTROS_PROCEDIMENTOS = (
+    re.compile(r'(TOMOGRAFIA\s+[A-ZÀ-Úa-zà-ú\s\-]+)', re.IGNORECASE),
+    re.compile(r'(RESSONANCIA\s+[A-ZÀ-Úa-zà-ú\s\-]+)', re.IGNORECASE),
+    re.compile(r'(EXAME\s+[A-ZÀ-Úa-zà-ú\s\-]+)', re.IGNORECASE),
+)
+_RE_COD_UNIFICADO = re.compile(r'Cod\.\s*Unificado\s*:?', re.IGNORECASE)
+_RE_COD_INTERNO = re.compile(r'Cod\.\s*Interno\s*:?', re.IGNORECASE)
+_RE_PALAVRAS = re.compile(r'[A-ZÀ-Úa-zà-ú\s\-]+')
+_RE_BRASILEIRA = re.compile(r'BRASILEIRA\s*', re.IGNORECASE)
+_RE_BRASIL = re.compile(r'BRASIL\s*', re.IGNORECASE)
+_RE_SUFIXO_PB = re.compile(r'\s*-\s*PB\s*$', re.IGNORECASE)
+_RE_MUNICIPIO_TRECHO = re.compile(r'([A-ZÀ-Úa-zà-ú\s]+(?:\s*-\s*[A-Z]{2})?)')
+
+
+def campos_vazios():
+    """Retorna o dicionário de dados com todos os campos como "NÃO ENCONTRADO" """
+    return {campo: NAO_ENCONTRADO for campo in CAMPOS}
+
+
+def limpar_unidade_executante(texto):
+    """Limpa a unidade executante preservando o nome "HOSPITAL" """
+    if not texto or texto == NAO_ENCONTRADO:
+        return texto
+
+    # Nomes de unidades executantes não contêm números: desconsiderar tudo a partir do primeiro dígito
+    match_digito = _RE_DIGITO.search(texto)
+    if match_digito:
+        texto = texto[:match_digito.start()]
+
+    # Remover qualquer caractere que não seja letra, espaço ou hífen
+    texto = _RE_NAO_NOME.sub('', texto)
+    texto = _RE_ESPACOS.sub(' ', texto).strip()
+
+    # Se o resultado for muito curto ou não contiver nenhuma letra, a extração falhou
+    if len(texto) < 3 or not _RE_LETRA.search(texto):
+        return NAO_ENCONTRADO
+
+    return texto
+
+
+def limpar_procedimento(texto):
+    """Limpa o procedimento, priorizando "CONSULTA EM" e outros tipos conhecidos"""
+    if not texto or texto == NAO_ENCONTRADO:
+        return texto
+
+    consulta_match = _RE_CONSULTA.search(texto)
+    if consulta_match:
+        return consulta_match.group(1).strip()
+
+    for regex in _RE_OUTROS_PROCEDIMENTOS:
+        match = regex.search(texto)
+        if match:
+            return match.group(1).strip()
+
+    # Remover "Cod. Unificado:", "Cod. Interno:" e variações
+    texto = _RE_COD_UNIFICADO.sub('', texto)
+    texto = _RE_COD_INTERNO.sub('', texto)
+
+    # Extrair apenas palavras e hífens (sem números)
+    texto = ' '.join(_RE_PALAVRAS.findall(texto))
+    texto = _RE_ESPACOS.sub(' ', texto).strip()
+
+    if len(texto) < 3:
+        return NAO_ENCONTRADO
+
+    return texto
+
+
+def limpar_municipio(texto):
+    """Remove nacionalidade, país e a sigla "- PB" do município de residência"""
+    texto = _RE_BRASILEIRA.sub('', texto).strip()
+    texto = _RE_BRASIL.sub('', texto).strip()
+    texto = _RE_SUFIXO_PB.sub('', texto).strip()
+    return _RE_ESPACOS.sub(' ', texto).strip()
+
+
+# Cascatas completas como pares (identificador, padrão), na ordem em que são testadas;
+# os layouts (ver Layout) usam subconjuntos dessas tuplas
+_CNS = tuple((str(i), padrao) for i, padrao in enumerate(CASCATA_CNS))
+_CODIGO = tuple((str(i), padrao, aceita_outro_prefixo) for i, (padrao, aceita_outro_prefixo)
+                in enumerate(zip(CASCATA_CODIGO, _CODIGO_ACEITA_OUTRO_PREFIXO)))
+_UNIDADE_EXECUTANTE = tuple((str(i), padrao) for i, padrao in enumerate(CASCATA_UNIDADE_EXECUTANTE))
+_DATA_EXAME = tuple((str(i), padrao) for i, padrao in enumerate(CASCATA_DATA_EXAME))
+_PROCEDIMENTO = tuple((str(i), padrao) for i, padrao in enumerate(CASCATA_PROCEDIMENTO))
+
+
+def _extrair_cns(texto, texto_minusculo, rotulos, dados, cascata=_CNS):
+    for identificador, padrao in cascata:
+        match = padrao.buscar(texto, texto_minusculo, rotulos)
+        if match:
+            return padrao.valor(match), identificador
+    return NAO_ENCONTRADO, None
+
+
+def _extrair_codigo(texto, texto_minusculo, rotulos, dados, cascata=_CODIGO):
+    cns = dados["cns"]
+    codigo_final = NAO_ENCONTRADO
+    padrao_final = None
+    for identificador, padrao, aceita_outro_prefixo in cascata:
+        match = padrao.buscar(texto, texto_minusculo, rotulos)
+        if not match:
+            continue
+        codigo = padrao.valor(match)
+
+        # O código deve ter 9 dígitos, ser diferente do CNS e começar com 5 (se possível)
+        if len(codigo) != 9 or codigo == cns:
+            continue
+        if codigo.startswith('5'):
+            return codigo, identificador
+        if padrao_final is None and aceita_outro_prefixo:
+            codigo_final = codigo
+            padrao_final = identificador
+    return codigo_final, padrao_final
+
+
+def _extrair_unidade_executante(texto, texto_minusculo, rotulos, dados, principal=True,
+                                cascata=_UNIDADE_EXECUTANTE):
+    unidade = NAO_ENCONTRADO
+    if principal:
+        match = PADRAO_UNIDADE_EXECUTANTE.buscar(texto, texto_minusculo, rotulos)
+        if match:
+            unidade = limpar_unidade_executante(PADRAO_UNIDADE_EXECUTANTE.valor(match))
+        if unidade and unidade != NAO_ENCONTRADO:
+            return unidade, "principal"
+
+    for identificador, padrao in cascata:
+        match = padrao.buscar(texto, texto_minusculo, rotulos)
+        if match:
+            resultado = limpar_unidade_executante(padrao.valor(match))
+            if resultado and resultado != NAO_ENCONTRADO:
+                return resultado, identificador
+    return unidade, None
+
+
+def _extrair_data_exame(texto, texto_minusculo, rotulos, dados, principal=True, cascata=_DATA_EXAME):
+    data = NAO_ENCONTRADO
+    origem = None
+    if principal:
+        match = PADRAO_DATA_EXAME.buscar(texto, texto_minusculo, rotulos)
+        if match:
+            data = PADRAO_DATA_EXAME.valor(match)
+            origem = "principal"
+    if data == NAO_ENCONTRADO:
+        for identificador, padrao in cascata:
+            match = padrao.buscar(texto, texto_minusculo, rotulos)
+            if match:
+                data = padrao.valor(match)
+                origem = identificador
+                break
+
+    # Pós-processamento para garantir o formato DD/MM/AAAA
+    if data != NAO_ENCONTRADO:
+        data_match = _RE_DATA.search(data)
+        if data_match:
+            data = data_match.group(1)
+    return data, origem
+
+
+def _extrair_procedimento(texto, texto_minusculo, rotulos, dados, principal=True, cascata=_PROCEDIMENTO):
+    procedimento = NAO_ENCONTRADO
+    if principal:
+        procedimento_bruto = NAO_ENCONTRADO
+        match = PADRAO_PROCEDIMENTO.buscar(texto, texto_minusculo, rotulos)
+        if match:
+            procedimento_bruto = PADRAO_PROCEDIMENTO.valor(match)
+
+        procedimento = limpar_procedimento(procedimento_bruto)
+        if procedimento != NAO_ENCONTRADO:
+            return procedimento, "principal"
+
+    for identificador, padrao in cascata:
+        match = padrao.buscar(texto, texto_minusculo, rotulos)
+        if match:
+            return padrao.valor(match), identificador
+    return procedimento, None
+
+
+def _extrair_municipio(texto, texto_minusculo, rotulos, dados, principal=True, fallback=True):
+    municipio_residencia = ""
+    origem = None
+    if principal:
+        match = PADRAO_MUNICIPIO.buscar(texto, texto_minusculo, rotulos)
+        if match:
+            municipio_residencia = limpar_municipio(PADRAO_MUNICIPIO.valor(match))
+            origem = "principal"
+
+    if not municipio_residencia and fallback:
+        trecho_pos_municipio = PADRAO_MUNICIPIO_FALLBACK.buscar(texto, texto_minusculo, rotulos)
+        if trecho_pos_municipio:
+            municipio = _RE_MUNICIPIO_TRECHO.search(trecho_pos_municipio.group(1))
+            if municipio:
+                municipio_residencia = limpar_municipio(municipio.group(1).strip())
+                origem = "fallback"
+
+    try:
+        municipio_validado = CidadesParaiba.validar_municipio(municipio_residencia)
+    except Exception as e:
+        logger.error("Erro ao extrair município para unidade solicitante: %s", e)
+        return NAO_ENCONTRADO, None
+    if not municipio_validado:
+        return NAO_ENCONTRADO, None
+    return municipio_validado, origem
+
+
+# Extrator de cada campo, na ordem de execução (o código depende do CNS). A unidade
+# solicitante recebe o município de residência.
+_EXTRATORES = (
+    ("cns", _extrair_cns),
+    ("codigo_solicitacao", _extrair_codigo),
+    ("unidade_executante", _extrair_unidade_executante),
+    ("data_exame", _extrair_data_exame),
+    ("procedimento", _extrair_procedimento),
+    ("unidade_solicitante", _extrair_municipio),
+)
+
+# Cascata completa de cada campo (None para os campos sem cascata além dos padrões nomeados)
+_CASCATAS = {
+    "cns": _CNS,
+    "codigo_solicitacao": _CODIGO,
+    "unidade_executante": _UNIDADE_EXECUTANTE,
+    "data_exame": _DATA_EXAME,
+    "procedimento": _PROCEDIMENTO,
+    "unidade_solicitante": None,
+}
+
+# Trechos (em minúsculas) que distinguem os formatos de impressão do SISREG III
+MARCADORES = (
+    ("autorizacao_ambulatorial", "autorização de procedimentos ambulatoriais"),
+    ("chave_confirmacao", "chave de confirmação"),
+    ("situacao_atual", "situação atual:"),
+    ("apelido", "apelido:"),
+    ("procedimentos_solicitados", "procedimentos solicitados"),
+    ("propriedades_agenda", "propriedades da agenda"),
+)
+
+# Número mínimo de rótulos distintos para que o texto seja tratado como documento do SISREG III
+MIN_ROTULOS_SISREG = 2
+
+
+class Layout:
+    """
+    Formato de impressão do SISREG III, reconhecido pela assinatura do texto.
+
+    Args:
+        nome: Nome do layout (usado nos logs e nas métricas)
+        marcadores: Nomes de MARCADORES que precisam estar presentes
+        ordem: Rótulos (de ROTULOS) que precisam aparecer nesta ordem
+        padroes: Para cada campo, os padrões a testar neste layout: índices da cascata,
+            "principal" e/ou "fallback" (município). Se eles não encontrarem o campo, a
+            cascata completa é executada.
+    """
+
+    __slots__ = ("nome", "marcadores", "ordem", "argumentos")
+
+    def __init__(self, nome, marcadores=(), ordem=(), padroes=None):
+        self.nome = nome
+        self.marcadores = frozenset(marcadores)
+        self.ordem = tuple(ordem)
+        # Argumentos de cada extrator, montados uma única vez a partir das cascatas completas
+        self.argumentos = {}
+        for campo, selecao in (padroes or {}).items():
+            argumentos = {}
+            cascata = _CASCATAS[campo]
+            if cascata is not None:
+                argumentos["cascata"] = tuple(item for item in cascata if int(item[0]) in selecao)
+            if campo != "cns" and campo != "codigo_solicitacao":
+                argumentos["principal"] = "principal" in selecao
+            if campo == "unidade_solicitante":
+                argumentos["fallback"] = "fallback" in selecao
+            self.argumentos[campo] = argumentos
+
+    def reconhece(self, ordem, marcadores):
+        """Indica se a assinatura (ordem dos rótulos, marcadores presentes) é deste layout"""
+        if not self.marcadores.issubset(marcadores):
+            return False
+        restantes = iter(ordem)
+        return all(rotulo in restantes for rotulo in self.ordem)
+
+    def __repr__(self):
+        return f"Layout({self.nome!r})"
+
+
+LAYOUTS = (
+    # Impressão "AUTORIZAÇÃO DE PROCEDIMENTOS AMBULATORIAIS": rótulos colados aos valores,
+    # CNS após "Apelido:" e código seguido imediatamente pela data após "Vaga Consumida:"
+    Layout("autorizacao_ambulatorial",
+           marcadores=("autorizacao_ambulatorial", "apelido"),
+           ordem=("unidade_executante", "dados_paciente", "dados_solicitacao", "procedimentos_autorizados"),
+           padroes={"cns": (3,), "codigo_solicitacao": (1,), "unidade_executante": (0,),
+                    "data_exame": ("principal",), "procedimento": ("principal",),
+                    "unidade_solicitante": ("principal",)}),
+
+    # Comprovante impresso do autorizador ("Chave de Confirmação"): código após
+    # "Código da Solicitação:Situação Atual:" e "Procedimentos Solicitados" no lugar de
+    # "Procedimentos Autorizados"
+    Layout("comprovante_autorizador",
+           marcadores=("chave_confirmacao", "situacao_atual", "procedimentos_solicitados"),
+           ordem=("unidade_solicitante", "unidade_executante", "dados_paciente", "dados_solicitacao"),
+           padroes={"cns": (0,), "codigo_solicitacao": (0,), "unidade_executante": (0,),
+                    "data_exame": ("principal",), "procedimento": (0,),
+                    "unidade_solicitante": ("principal",)}),
+)
+
+# Documento do SISREG III com formato não catalogado: cascata completa em todos os campos
+LAYOUT_DESCONHECIDO = Layout("desconhecido")
+
+
+def _minusculo(texto):
+    # Com re.IGNORECASE o "i" também casa com o "ı" (i sem ponto), que o casefold não converte
+    return texto.casefold().replace("ı", "i")
+
+
+def assinatura_layout(texto, texto_minusculo=None, rotulos=None):
+    """
+    Assinatura do formato do documento: rótulos na ordem da primeira ocorrência e
+    marcadores presentes
+
+    Returns:
+        Tupla (ordem, marcadores), ambos tuplas de nomes
+    """
+    if texto_minusculo is None:
+        texto_minusculo = _minusculo(texto)
+    if rotulos is None:
+        rotulos = IndiceRotulos(texto, texto_minusculo)
+    posicoes = rotulos.posicoes
+    ordem = tuple(sorted(posicoes, key=lambda nome: posicoes[nome][0]))
+    marcadores = tuple(nome for nome, trecho in MARCADORES if trecho in texto_minusculo)
+    return ordem, marcadores
+
+
+@lru_cache(maxsize=256)
+def classificar_layout(assinatura):
+    """
+    Returns:
+        Layout da assinatura, LAYOUT_DESCONHECIDO para documentos do SISREG III de formato
+        não catalogado, ou None se o texto não for de um documento do SISREG III
+    """
+    ordem, marcadores = assinatura
+    if len(ordem) < MIN_ROTULOS_SISREG:
+        return None
+    for layout in LAYOUTS:
+        if layout.reconhece(ordem, marcadores):
+            return layout
+    return LAYOUT_DESCONHECIDO
+
+
+def identificar_layout(texto, texto_minusculo=None, rotulos=None):
+    """Classifica o texto (ver `assinatura_layout` e `classificar_layout`)"""
+    return classificar_layout(assinatura_layout(texto, texto_minusculo, rotulos))
+
+
+def _registrar_campo(campo, valor, padrao, inicio):
+    metricas.observar("sisreg_campo_segundos", time.perf_counter() - inicio, campo=campo)
+    if valor == NAO_ENCONTRADO:
+        metricas.incrementar("sisreg_campo_total", campo=campo, resultado="nao_encontrado")
+    else:
+        metricas.incrementar("sisreg_campo_total", campo=campo, resultado="encontrado")
+        metricas.incrementar("sisreg_padrao_total", campo=campo, padrao=padrao)
+
+
+def extrair_campos(texto, dados=None, medir=False, layout=None, campos=None):
+    """
+    Executa as cascatas de todos os campos sobre o texto de um PDF do SISREG III.
+
+    Nos layouts conhecidos (ver LAYOUTS), cada campo é procurado primeiro apenas com os
+    padrões do layout; a cascata completa só é executada se eles não o encontrarem.
+
+    Args:
+        texto: Texto extraído do PDF
+        dados: Dicionário a ser preenchido (opcional, criado com `campos_vazios`)
+        medir: Se True, registra em `metricas` a duração de cada cascata, os campos
+            não encontrados e o padrão que encontrou cada campo
+        layout: Layout já identificado pelo chamador (evita procurar de novo os rótulos e
+            marcadores da assinatura); identificado aqui se omitido
+        campos: Campos a procurar (padrão: todos); os demais ficam como estão em `dados`
+
+    Returns:
+        Dicionário com os seis campos extraídos
+    """
+    if dados is None:
+        dados = campos_vazios()
+
+    texto_minusculo = _minusculo(texto)
+    # Posições dos rótulos, encontradas uma única vez para todas as cascatas
+    rotulos = IndiceRotulos(texto, texto_minusculo)
+    if layout is None:
+        layout = identificar_layout(texto, texto_minusculo, rotulos) or LAYOUT_DESCONHECIDO
+
+    for campo, extrator in _EXTRATORES:
+        if campos is not None and campo not in campos:
+            continue
+        inicio = time.perf_counter() if medir else 0
+        valor, padrao = NAO_ENCONTRADO, None
+        argumentos = layout.argumentos.get(campo)
+        if argumentos is not None:
+            valor, padrao = extrator(texto, texto_minusculo, rotulos, dados, **argumentos)
+        if valor == NAO_ENCONTRADO:
+            valor, padrao = extrator(texto, texto_minusculo, rotulos, dados)
+        dados[campo] = valor
+        if medir:
+            _registrar_campo(campo, valor, padrao, inicio)
+
+    return dados
+
+
+def parar_leitura(texto):
+    """
+    Critério de parada da leitura das páginas: todos os campos já foram encontrados, ou
+    o texto lido (a partir da primeira página) não é de um documento do SISREG III
+    """
+    layout = identificar_layout(texto)
+    if layout is None:
+        if texto.strip():
+            return True
+        layout = LAYOUT_DESCONHECIDO
+    return NAO_ENCONTRADO not in extrair_campos(texto, layout=layout).values()
+
+
+class LeituraPaginas:
+    """
+    Critério de parada da leitura das páginas, atualizado página a página.
+
+    Equivale a chamar `parar_leitura` com o texto lido até cada página, sem refazer o
+    trabalho das páginas anteriores: o layout é identificado na primeira página com
+    texto e, em cada página nova, apenas os campos ainda não encontrados são procurados,
+    apenas no texto dessa página. A extração final continua sendo feita sobre o texto
+    completo.
+    """
+
+    __slots__ = ("dados", "layout")
+
+    def __init__(self):
+        self.dados = campos_vazios()
+        self.layout = None
+
+    def __call__(self, texto_pagina):
+        """
+        Registra o texto de mais uma página
+
+        Returns:
+            True quando as páginas restantes não precisam ser lidas
+        """
+        if not texto_pagina.strip():
+            return False
+        if self.layout is None:
+            self.layout = identificar_layout(texto_pagina)
+            if self.layout is None:
+                # A primeira página com texto não é de um documento do SISREG III
+                return True
+        faltando = [campo for campo, valor in self.dados.items() if valor == NAO_ENCONTRADO]
+        extrair_campos(texto_pagina, self.dados, layout=self.layout, campos=faltando)
+        return NAO_ENCONTRADO not in self.dados.values()
@@ -2,15 +2,755 @@
 Solução aprimorada para integração com Google Sheets
 Este arquivo contém uma implementação para adicionar dados a uma planilha do Google Sheets
 com logs detalhados e tratamento de erros robusto
+
+Os envios para a mesma planilha passam por uma fila de escrita (FilaEscrita): os que
+chegam dentro de SHEETS_JANELA segundos viram um único lote, deduplicado contra a
+planilha e entre si, gravado com uma única chamada append. As chamadas à API são
+espaçadas por um balde de tokens e repetidas com backoff exponencial em 429/5xx.
+
+Com SHEETS_API_URL definida, as chamadas vão para essa URL em vez do Google, sem
+autenticação (para testar com um servidor local que imita a API do Sheets).
 """
 
-import gspread
-from google.oauth2.service_account import Credentials
+# gspread e google-auth são importados apenas quando a planilha é usada: a importação
+# custa cerca de 200 ms e dezenas de MB por worker (ver main.aquecer)
 import json
-import traceback
 import re
 import os
+import time
+import random
+import threading
 from datetime import datetime
+from diagnostico import obter_logger
+from metricas import metricas
+
+# Logs da integração (arquivo logs/google_sheets_log.txt, com rotação; ver diagnostico.py)
+log = obter_logger("sisreg.planilha")
+
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+# Tempo (em segundos) que a planilha e a aba abertas ficam em cache
+SHEETS_CACHE_TTL = int(os.environ.get("SHEETS_CACHE_TTL", 300))
+# Janela (em segundos) em que os envios para a mesma planilha são reunidos em um lote
+SHEETS_JANELA = float(os.environ.get("SHEETS_JANELA", 0.3))
+# Chamadas à API por segundo (por processo) e tamanho máximo das rajadas
+SHEETS_TAXA = float(os.environ.get("SHEETS_TAXA", 1.0))
+SHEETS_RAJADA = int(os.environ.get("SHEETS_RAJADA", 10))
+# Tentativas por chamada e espera inicial/máxima (em segundos) do backoff exponencial
+SHEETS_TENTATIVAS = int(os.environ.get("SHEETS_TENTATIVAS", 5))
+SHEETS_BACKOFF = float(os.environ.get("SHEETS_BACKOFF", 1.0))
+SHEETS_BACKOFF_MAX = float(os.environ.get("SHEETS_BACKOFF_MAX", 32.0))
+# Tempo máximo (em segundos) de cada chamada HTTP à API
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", 60))
+# URL de uma API substituta (ex.: http://127.0.0.1:8099), usada no lugar do Google
+SHEETS_API_URL = os.environ.get("SHEETS_API_URL") or None
+
+# Endereços do Google usados pelo gspread (Sheets e, ao abrir a planilha, Drive)
+GOOGLE_APIS_URLS = ("https://sheets.googleapis.com", "https://www.googleapis.com")
+# Status que indicam cota excedida ou falha temporária do Google
+STATUS_RETENTAVEIS = {429, 500, 502, 503, 504}
+
+
+def medir_sheets(operacao):
+    """Mede a duração de uma chamada à API do Google Sheets e conta os erros (ver metricas.py)"""
+    return metricas.cronometrar("sisreg_sheets_segundos", erros="sisreg_sheets_erros_total", operacao=operacao)
+
+
+class BaldeTokens:
+    """
+    Limita a taxa de chamadas à API: cada chamada retira um token do balde, que é
+    reabastecido continuamente até `capacidade` tokens
+
+    Args:
+        taxa: Tokens repostos por segundo
+        capacidade: Máximo de tokens acumulados (tamanho da rajada)
+    """
+
+    def __init__(self, taxa=SHEETS_TAXA, capacidade=SHEETS_RAJADA):
+        self.taxa = taxa
+        self.capacidade = max(capacidade, 1)
+        self._tokens = float(self.capacidade)
+        self._atualizado = time.monotonic()
+        self._lock = threading.Lock()
+
+    def retirar(self):
+        """
+        Retira um token, esperando se o balde estiver vazio
+
+        Returns:
+            Tempo esperado (em segundos)
+        """
+        if self.taxa <= 0:
+            return 0.0
+        with self._lock:
+            agora = time.monotonic()
+            self._tokens = min(self.capacidade, self._tokens + (agora - self._atualizado) * self.taxa)
+            self._atualizado = agora
+            self._tokens -= 1
+            # Com o balde vazio o token fica "devendo": a espera é o tempo até repô-lo
+            espera = -self._tokens / self.taxa if self._tokens < 0 else 0.0
+        if espera:
+            time.sleep(espera)
+        return espera
+
+
+_balde = BaldeTokens()
+
+
+def _status_erro(erro):
+    resposta = getattr(erro, "response", None)
+    return getattr(resposta, "status_code", None)
+
+
+def _espera_retry_after(erro):
+    # Retry-After em segundos, quando a API informa
+    resposta = getattr(erro, "response", None)
+    try:
+        return float(resposta.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def chamar_sheets(operacao, funcao, *args, idempotente=True, **kwargs):
+    """
+    Chama a API do Google Sheets respeitando o balde de tokens, medindo a duração e
+    repetindo a chamada com backoff exponencial (com jitter) quando a API responde 429
+    (cota excedida) ou 5xx.
+
+    Args:
+        operacao: Nome da operação nas métricas e nos logs
+        funcao: Método do gspread a chamar com `args` e `kwargs`
+        idempotente: Se False (escritas), só repete em 429, quando a API garante que a
+            chamada não foi aplicada
+
+    Returns:
+        Retorno de `funcao`
+    """
+    import gspread
+
+    for tentativa in range(SHEETS_TENTATIVAS):
+        espera = _balde.retirar()
+        if espera:
+            metricas.observar("sisreg_sheets_espera_segundos", espera, operacao=operacao)
+        try:
+            with medir_sheets(operacao):
+                return funcao(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = _status_erro(e)
+            retentavel = status == 429 or (idempotente and status in STATUS_RETENTAVEIS)
+            if not retentavel or tentativa == SHEETS_TENTATIVAS - 1:
+                raise
+            espera = _espera_retry_after(e)
+            if espera is None:
+                espera = min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF * 2 ** tentativa) * random.uniform(0.5, 1.0)
+            metricas.incrementar("sisreg_sheets_retentativas_total", operacao=operacao, status=status)
+            log.warning("API do Google Sheets respondeu %s em %s; nova tentativa em %.1fs (%s/%s)",
+                        status, operacao, espera, tentativa + 2, SHEETS_TENTATIVAS)
+            time.sleep(espera)
+
+
+def _sessao_substituta(api_url):
+    """Sessão HTTP sem autenticação que envia as chamadas do gspread para `api_url`"""
+    import requests
+
+    class SessaoSubstituta(requests.Session):
+        def request(self, method, url, *args, **kwargs):
+            for url_google in GOOGLE_APIS_URLS:
+                if url.startswith(url_google):
+                    url = api_url.rstrip("/") + url[len(url_google):]
+                    break
+            return super().request(method, url, *args, **kwargs)
+
+    return SessaoSubstituta()
+
+
+class ClienteSheets:
+    """
+    Cliente do Google Sheets compartilhado pelo processo.
+    
+    As credenciais são carregadas e o cliente gspread é autorizado uma única vez; a
+    sessão HTTP autorizada (e seu pool de conexões) é reutilizada entre as requisições
+    e o token OAuth só é renovado quando expira. As planilhas e abas abertas ficam em
+    cache por `ttl` segundos.
+    
+    Args:
+        arquivo_credenciais: Caminho para o arquivo JSON de credenciais
+        ttl: Validade (em segundos) das planilhas/abas em cache
+        api_url: URL de uma API substituta, sem autenticação (padrão: SHEETS_API_URL)
+    """
+    
+    def __init__(self, arquivo_credenciais, ttl=SHEETS_CACHE_TTL, api_url=SHEETS_API_URL):
+        self.arquivo_credenciais = arquivo_credenciais
+        self.ttl = ttl
+        self.api_url = api_url
+        self.credentials = None
+        self.client = None
+        self._planilhas = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def email(self):
+        """Email da conta de serviço (para as mensagens de permissão)"""
+        if self.credentials is None:
+            return "Email não encontrado"
+        return getattr(self.credentials, "service_account_email", None) or "Email não encontrado"
+    
+    def carregar_credenciais(self):
+        """Carrega as credenciais da conta de serviço (apenas na primeira chamada)"""
+        with self._lock:
+            if self.credentials is None:
+                from google.oauth2.service_account import Credentials
+                with medir_sheets("credenciais"):
+                    self.credentials = Credentials.from_service_account_file(self.arquivo_credenciais, scopes=SCOPE)
+        return self.credentials
+    
+    def autorizar(self):
+        """Autoriza o cliente gspread (apenas na primeira chamada)"""
+        credentials = None if self.api_url else self.carregar_credenciais()
+        with self._lock:
+            if self.client is None:
+                import gspread
+                with medir_sheets("autorizar"):
+                    if self.api_url:
+                        self.client = gspread.Client(None, session=_sessao_substituta(self.api_url))
+                    else:
+                        self.client = gspread.authorize(credentials)
+                    # Sem timeout, uma conexão travada prenderia a thread para sempre
+                    self.client.set_timeout(SHEETS_TIMEOUT)
+        return self.client
+    
+    def abrir_planilha(self, id_planilha):
+        """Retorna a planilha pelo ID, reutilizando o objeto aberto enquanto o cache for válido"""
+        with self._lock:
+            entrada = self._planilhas.get(id_planilha)
+            if entrada and entrada["expira"] > time.monotonic():
+                return entrada["planilha"]
+        
+        client = self.autorizar()
+        planilha = chamar_sheets("abrir_planilha", client.open_by_key, id_planilha)
+        with self._lock:
+            self._planilhas[id_planilha] = {"planilha": planilha, "aba": None, "indice": None,
+                                            "expira": time.monotonic() + self.ttl}
+        return planilha
+    
+    def obter_aba(self, id_planilha):
+        """
+        Retorna a primeira aba da planilha (criando a aba "Dados" se não existir),
+        reutilizando o objeto em cache
+        """
+        planilha = self.abrir_planilha(id_planilha)
+        with self._lock:
+            entrada = self._planilhas.get(id_planilha)
+            if entrada and entrada["aba"] is not None:
+                return entrada["aba"]
+        
+        aba = chamar_sheets("obter_aba", planilha.get_worksheet, 0)
+        if not aba:
+            log.info("Primeira aba não encontrada, criando nova aba")
+            aba = chamar_sheets("criar_aba", planilha.add_worksheet, title="Dados", rows=1000, cols=20,
+                                idempotente=False)
+            log.info("Nova aba criada com sucesso")
+        with self._lock:
+            entrada = self._planilhas.get(id_planilha)
+            if entrada:
+                entrada["aba"] = aba
+        return aba
+    
+    def obter_indice(self, id_planilha):
+        """
+        Retorna o índice de códigos da primeira aba, atualizado com as linhas novas.
+        O índice vive junto com a aba em cache e é reconstruído quando o cache expira.
+        """
+        aba = self.obter_aba(id_planilha)
+        with self._lock:
+            entrada = self._planilhas.get(id_planilha)
+            indice = entrada["indice"] if entrada else None
+            if indice is None or indice.aba is not aba:
+                indice = IndiceCodigos(aba)
+                if entrada:
+                    entrada["indice"] = indice
+        return indice.atualizar()
+    
+    def invalidar(self, id_planilha=None):
+        """Descarta a planilha em cache (ou todas, se nenhum ID for informado)"""
+        with self._lock:
+            if id_planilha is None:
+                self._planilhas.clear()
+            else:
+                self._planilhas.pop(id_planilha, None)
+
+
+# Mapeamento entre os nomes das colunas da planilha e os campos dos dados
+# Usando os nomes de colunas exatos da planilha do usuário
+MAPEAMENTO_COLUNAS = {
+    "DATA DO EXAME/CONSULTA": "data_exame",
+    "COD. SOLICITAÇÃO": "codigo_solicitacao",
+    "CNS DO PACIENTE": "cns",
+    "UNID. SOLICITANTE": "municipio_residencia",
+    "UNID. EXECUTANTE": "unidade_executante",
+    "CONSULTA/EXAME/ESPECIALIDADE": "procedimento",
+    # Mapeamentos alternativos para maior compatibilidade
+    "DATA DA AUTORIZAÇÃO": "data_exame",
+    "CÓDIGO DE SOLICITAÇÃO": "codigo_solicitacao",
+    "CÓDIGO SOLICITAÇÃO": "codigo_solicitacao",
+    "CNS": "cns",
+    "UNIDADE SOLICITANTE": "municipio_residencia",
+    "UNIDADE EXECUTANTE": "unidade_executante",
+    "PROCEDIMENTO": "procedimento",
+    "ESPECIALIDADE": "procedimento",
+    "PAES": "procedimento"
+}
+
+
+def mapear_colunas(cabecalho):
+    """
+    Cria um mapeamento de índices para saber em qual coluna cada dado deve ser inserido
+    
+    Returns:
+        Dicionário {campo: índice da coluna}
+    """
+    indices_colunas = {}
+    for i, nome_coluna in enumerate(cabecalho):
+        for key, campo_dado in MAPEAMENTO_COLUNAS.items():
+            if nome_coluna.strip().upper() == key.strip().upper():
+                indices_colunas[campo_dado] = i
+                break
+    return indices_colunas
+
+
+def validar_e_formatar_dados(dado):
+    """Valida e formata os campos de um registro extraído para a planilha"""
+    resultado = {}
+
+    # Validar e formatar código de solicitação
+    codigo = dado.get("codigo_solicitacao", "")
+    if codigo and codigo != "NÃO ENCONTRADO":
+        # Remover espaços e caracteres não numéricos
+        codigo_limpo = re.sub(r'[^0-9]', '', codigo)
+        if len(codigo_limpo) > 0:
+            resultado["codigo_solicitacao"] = codigo_limpo
+        else:
+            resultado["codigo_solicitacao"] = ""
+    else:
+        resultado["codigo_solicitacao"] = ""
+
+    # Validar e formatar CNS
+    cns = dado.get("cns", "")
+    if cns and cns != "NÃO ENCONTRADO":
+        # Remover espaços e caracteres não numéricos
+        cns_limpo = re.sub(r'[^0-9]', '', cns)
+        if len(cns_limpo) > 0:
+            resultado["cns"] = cns_limpo
+        else:
+            resultado["cns"] = ""
+    else:
+        resultado["cns"] = ""
+
+    # Validar e formatar data
+    data = dado.get("data_exame", "")
+    if data and data != "NÃO ENCONTRADO":
+        # Verificar se a data está no formato DD/MM/AAAA
+        match = re.search(r'(\d{2}/\d{2}/\d{4})', data)
+        if match:
+            resultado["data_exame"] = match.group(1)
+        else:
+            # Tentar outros formatos comuns
+            try:
+                # Tentar interpretar a data em vários formatos
+                for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y'):
+                    try:
+                        dt = datetime.strptime(data, fmt)
+                        resultado["data_exame"] = dt.strftime('%d/%m/%Y')
+                        break
+                    except ValueError:
+                        continue
+                else:
+                    resultado["data_exame"] = data  # Manter o original se não conseguir converter
+            except:
+                resultado["data_exame"] = data  # Manter o original em caso de erro
+    else:
+        resultado["data_exame"] = ""
+
+    # Copiar outros campos sem validação específica
+    for campo in ["unidade_solicitante", "unidade_executante", "procedimento"]:
+        valor = dado.get(campo, "")
+        if valor and valor != "NÃO ENCONTRADO":
+            resultado[campo] = valor
+        else:
+            resultado[campo] = ""
+
+    return resultado
+
+
+def montar_linhas(dados, cabecalho, indices_colunas, codigos_existentes):
+    """
+    Monta as linhas a serem adicionadas à planilha, separando duplicados e inválidos
+    
+    Args:
+        dados: Lista de dicionários com os dados extraídos
+        cabecalho: Cabeçalho da planilha
+        indices_colunas: Mapeamento {campo: índice da coluna} (ver mapear_colunas)
+        codigos_existentes: Conjunto com os códigos de solicitação já presentes
+        
+    Returns:
+        Tupla (novas_linhas, codigos_duplicados, registros_invalidos)
+    """
+    novas_linhas = []
+    codigos_duplicados = []  # Lista para armazenar códigos de solicitação duplicados
+    registros_invalidos = []
+    
+    for dado in dados:
+        # Pular se for um erro
+        if "erro" in dado:
+            registros_invalidos.append({"erro": dado["erro"]})
+            continue
+
+        # Validar e formatar os dados
+        dado_validado = validar_e_formatar_dados(dado)
+
+        # Verificar se o código de solicitação é válido
+        codigo_solicitacao = dado_validado.get("codigo_solicitacao", "")
+        if not codigo_solicitacao:
+            registros_invalidos.append({"erro": "Código de solicitação inválido ou não encontrado", "dados": dado})
+            continue
+
+        # Verificar se o código de solicitação já existe na planilha
+        if codigo_solicitacao in codigos_existentes:
+            codigos_duplicados.append(codigo_solicitacao)
+            continue
+
+        # Criar uma linha vazia com o mesmo número de colunas que o cabeçalho
+        nova_linha = [""] * len(cabecalho)
+
+        # Preencher apenas as colunas que temos mapeamento
+        for campo, indice in indices_colunas.items():
+            if indice < len(nova_linha):
+                nova_linha[indice] = dado_validado.get(campo, "")
+
+        novas_linhas.append(nova_linha)
+    
+    return novas_linhas, codigos_duplicados, registros_invalidos
+
+
+class IndiceCodigos:
+    """
+    Índice dos códigos de solicitação já presentes em uma aba.
+    
+    A primeira carga lê apenas a linha de cabeçalho e a coluna do código; as
+    atualizações seguintes leem somente as linhas após a última linha conhecida
+    (normalmente nenhuma). O número de linhas conhecido dá a posição onde os novos
+    registros devem ser escritos, sem baixar a planilha inteira a cada envio.
+    
+    Args:
+        aba: Worksheet do gspread
+    """
+    
+    def __init__(self, aba):
+        self.aba = aba
+        self.cabecalho = []
+        self.indice_codigo = None
+        self.codigos = set()
+        self.total_linhas = 0
+        self.carregado = False
+        self._lock = threading.Lock()
+    
+    def _definir_cabecalho(self, cabecalho):
+        self.cabecalho = cabecalho
+        self.indice_codigo = mapear_colunas(cabecalho).get("codigo_solicitacao")
+    
+    def _registrar(self, linhas):
+        for linha in linhas:
+            if self.indice_codigo is not None and linha and len(linha) > self.indice_codigo:
+                codigo = linha[self.indice_codigo]
+                if codigo:
+                    self.codigos.add(codigo)
+        self.total_linhas += len(linhas)
+    
+    def atualizar(self):
+        """Carrega o índice na primeira chamada; depois lê apenas as linhas novas"""
+        with self._lock:
+            self._atualizar()
+        return self
+    
+    def _atualizar(self):
+        if not self.carregado:
+            self._definir_cabecalho(chamar_sheets("ler_cabecalho", self.aba.row_values, 1))
+            if self.cabecalho:
+                self.total_linhas = 1
+                if self.indice_codigo is not None:
+                    coluna = chamar_sheets("ler_codigos", self.aba.col_values, self.indice_codigo + 1)
+                    self.codigos.update(codigo for codigo in coluna[1:] if codigo)
+                    self.total_linhas = max(len(coluna), 1)
+            self.carregado = True
+        
+        # Linhas escritas depois da última leitura (por outro processo ou diretamente na
+        # planilha), incluindo linhas sem código abaixo da última linha com código
+        from gspread.utils import rowcol_to_a1
+        ultima_coluna = rowcol_to_a1(1, max(len(self.cabecalho), 1))[:-1]
+        novas = chamar_sheets("ler_linhas_novas", self.aba.get, f"A{self.total_linhas + 1}:{ultima_coluna}")
+        if novas:
+            self._registrar(novas)
+    
+    def registrar_cabecalho(self, cabecalho):
+        """Registra o cabeçalho escrito em uma aba vazia"""
+        with self._lock:
+            self._definir_cabecalho(cabecalho)
+            self.total_linhas = 1
+    
+    def registrar_linhas(self, linhas, primeira_linha=None):
+        """
+        Registra as linhas escritas com sucesso na planilha
+
+        Args:
+            linhas: Linhas escritas
+            primeira_linha: Linha (a partir de 1) onde a API gravou a primeira delas. Se
+                houver linhas ainda não lidas antes dela (gravadas por outro processo), o
+                índice é recarregado na próxima atualização.
+        """
+        with self._lock:
+            if primeira_linha is not None and primeira_linha != self.total_linhas + 1:
+                self.carregado = False
+                return
+            self._registrar(linhas)
+
+
+# Cabeçalho escrito em uma planilha vazia (nomes de colunas exatos da planilha do usuário)
+CABECALHO_PADRAO = ["DATA DA AUTORIZAÇÃO", "COD. SOLICITAÇÃO", "CNS DO PACIENTE",
+                    "UNID. SOLICITANTE", "UNID. EXECUTANTE", "PAES"]
+
+
+def _primeira_linha(resposta):
+    """Linha inicial do intervalo gravado pelo append (ex.: "Dados!A12:F14" -> 12)"""
+    try:
+        intervalo = resposta["updates"]["updatedRange"]
+    except (KeyError, TypeError):
+        return None
+    match = re.match(r"[A-Za-z]*(\d+)", intervalo.rsplit("!", 1)[-1])
+    return int(match.group(1)) if match else None
+
+
+def _resultado_envio(id_planilha, adicionados, codigos_duplicados):
+    """Resposta de um envio, no formato devolvido pela rota /planilha"""
+    if not adicionados and codigos_duplicados:
+        # Mensagem simplificada: apenas documentos duplicados
+        mensagem = f"Documento {', '.join(codigos_duplicados)} já se encontra na planilha. Registros adicionados: 0"
+        return {
+            "mensagem": mensagem,
+            "id_planilha": id_planilha,
+            "registros_adicionados": 0,
+            "codigos_duplicados": codigos_duplicados
+        }
+    if not adicionados:
+        return {
+            "mensagem": "Nenhum novo registro para adicionar à planilha",
+            "id_planilha": id_planilha,
+            "registros_adicionados": 0
+        }
+    mensagem = f"Registros adicionados: {adicionados}"
+    if codigos_duplicados:
+        mensagem = f"Documento {', '.join(codigos_duplicados)} já se encontra na planilha. {mensagem}"
+    return {
+        "mensagem": mensagem,
+        "id_planilha": id_planilha,
+        "registros_adicionados": adicionados,
+        "codigos_duplicados": codigos_duplicados
+    }
+
+
+class _Envio:
+    """Dados de um envio à espera na fila e o resultado, preenchido pela fila"""
+
+    __slots__ = ("dados", "resultado", "concluido")
+
+    def __init__(self, dados):
+        self.dados = dados
+        self.resultado = None
+        self.concluido = threading.Event()
+
+
+class FilaEscrita:
+    """
+    Fila de escrita de uma planilha.
+
+    O primeiro envio que encontra a fila vazia inicia uma thread que espera `janela`
+    segundos e processa de uma vez todos os envios acumulados: o índice de códigos é
+    atualizado uma vez, os códigos já presentes na planilha ou em um envio anterior do
+    mesmo lote são separados como duplicados e as linhas de todos os envios (com o
+    cabeçalho, se a planilha estiver vazia) são gravadas com uma única chamada append.
+    Como o Google escolhe a posição das linhas no append, dois lotes nunca escrevem na
+    mesma célula inicial. A thread termina quando não há mais envios.
+
+    Args:
+        cliente: ClienteSheets usado nas chamadas
+        id_planilha: ID da planilha
+        janela: Tempo (em segundos) de espera por outros envios antes de gravar
+    """
+
+    def __init__(self, cliente, id_planilha, janela=SHEETS_JANELA):
+        self.cliente = cliente
+        self.id_planilha = id_planilha
+        self.janela = janela
+        self._pendentes = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enviar(self, dados):
+        """
+        Coloca os dados na fila e espera a gravação do lote
+
+        Returns:
+            Dicionário com o resultado deste envio (mesmo formato de `adicionar_dados_planilha`)
+        """
+        envio = _Envio(dados)
+        with self._lock:
+            self._pendentes.append(envio)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executar, daemon=True,
+                                                name=f"planilha-{self.id_planilha[:8]}")
+                self._thread.start()
+        envio.concluido.wait()
+        return envio.resultado
+
+    def _executar(self):
+        while True:
+            time.sleep(self.janela)
+            with self._lock:
+                envios, self._pendentes = self._pendentes, []
+                if not envios:
+                    self._thread = None
+                    return
+            try:
+                resultados = self._gravar_lote([envio.dados for envio in envios])
+            except Exception as e:
+                self.cliente.invalidar(self.id_planilha)
+                log.exception("Erro ao adicionar dados à planilha")
+                resultados = [{"erro": f"Erro ao adicionar dados à planilha: {str(e)}"}] * len(envios)
+            for envio, resultado in zip(envios, resultados):
+                envio.resultado = resultado
+                envio.concluido.set()
+
+    def _gravar_lote(self, lote):
+        """
+        Grava os envios do lote na planilha
+
+        Args:
+            lote: Lista com os dados de cada envio
+
+        Returns:
+            Lista com o resultado de cada envio, na mesma ordem
+        """
+        import gspread  # gspread.exceptions.APIError, usado no tratamento de erros
+
+        cliente, id_planilha = self.cliente, self.id_planilha
+        log.info("Lote da planilha %s: %s envios, %s registros", id_planilha, len(lote),
+                 sum(len(dados) for dados in lote))
+
+        # Índice dos códigos já existentes (lê apenas o cabeçalho, a coluna do código e as linhas novas)
+        try:
+            log.debug("Atualizando índice de códigos da planilha")
+            aba = cliente.obter_aba(id_planilha)
+            indice_codigos = cliente.obter_indice(id_planilha)
+            log.debug("Índice com %s linhas", indice_codigos.total_linhas)
+        except Exception as e:
+            cliente.invalidar(id_planilha)
+            log.error("Erro ao ler dados da planilha: %s", e)
+            return [{"erro": f"Erro ao ler dados da planilha: {str(e)}"}] * len(lote)
+
+        # Se a planilha estiver vazia, o cabeçalho é gravado junto com as linhas
+        cabecalho_novo = not indice_codigos.cabecalho
+        if cabecalho_novo:
+            log.info("Planilha vazia, adicionando cabeçalho")
+            cabecalho = CABECALHO_PADRAO
+        else:
+            cabecalho = indice_codigos.cabecalho
+            log.debug("Cabeçalho existente: %s", cabecalho)
+
+        indices_colunas = mapear_colunas(cabecalho)
+        log.debug("Mapeamento de índices de colunas: %s", indices_colunas)
+
+        # Verificar se todas as colunas necessárias foram encontradas
+        campos_necessarios = ["codigo_solicitacao", "cns", "unidade_solicitante",
+                              "unidade_executante", "data_exame", "procedimento"]
+        campos_faltantes = [campo for campo in campos_necessarios if campo not in indices_colunas]
+        if campos_faltantes:
+            log.warning("Algumas colunas necessárias não foram encontradas: %s", campos_faltantes)
+
+        indice_codigo = indices_colunas.get("codigo_solicitacao")
+        if indice_codigo is None:
+            log.error("Coluna para código de solicitação não encontrada na planilha")
+            return [{"erro": "Coluna para código de solicitação não encontrada na planilha. Verifique se o cabeçalho da planilha contém uma coluna para o código de solicitação.", "permanente": True}] * len(lote)
+
+        # Códigos da planilha mais os dos envios anteriores do lote, para evitar duplicatas
+        codigos_existentes = set(indice_codigos.codigos)
+        linhas_lote = []
+        separados = []
+        for dados in lote:
+            novas_linhas, codigos_duplicados, registros_invalidos = montar_linhas(
+                dados, cabecalho, indices_colunas, codigos_existentes)
+            codigos_existentes.update(linha[indice_codigo] for linha in novas_linhas)
+            linhas_lote.extend(novas_linhas)
+            separados.append((len(novas_linhas), codigos_duplicados))
+            log.info("Envio: %s linhas novas, %s duplicados, %s inválidos",
+                     len(novas_linhas), len(codigos_duplicados), len(registros_invalidos))
+
+        if linhas_lote:
+            linhas = [cabecalho] + linhas_lote if cabecalho_novo else linhas_lote
+            log.info("Adicionando %s novas linhas com uma chamada append", len(linhas_lote))
+            try:
+                resposta = chamar_sheets("escrever_linhas", aba.append_rows, linhas,
+                                         value_input_option="USER_ENTERED", table_range="A1",
+                                         idempotente=False)
+            except gspread.exceptions.APIError as e:
+                cliente.invalidar(id_planilha)
+                error_message = str(e)
+                log.error("Erro da API do Google Sheets ao adicionar dados: %s", error_message)
+                if "permission" in error_message.lower():
+                    resultado = {"erro": f"Sem permissão para editar a planilha. Certifique-se de compartilhar a planilha com {cliente.email} e dar permissão de edição.", "permanente": True}
+                else:
+                    resultado = {"erro": f"Erro ao adicionar dados à planilha: {error_message}"}
+                return [resultado] * len(lote)
+
+            primeira_linha = _primeira_linha(resposta)
+            if cabecalho_novo:
+                indice_codigos.registrar_cabecalho(cabecalho)
+                if primeira_linha is not None:
+                    primeira_linha += 1
+            indice_codigos.registrar_linhas(linhas_lote, primeira_linha)
+            log.debug("Dados adicionados com sucesso à planilha")
+
+        resultados = [_resultado_envio(id_planilha, adicionados, codigos_duplicados)
+                      for adicionados, codigos_duplicados in separados]
+        for resultado in resultados:
+            log.info("Operação concluída com sucesso: %s", resultado["mensagem"])
+        return resultados
+
+
+_clientes = {}
+_clientes_lock = threading.Lock()
+_filas = {}
+_filas_pid = None
+
+
+def obter_cliente_sheets(arquivo_credenciais='credentials.json'):
+    """Retorna o ClienteSheets do processo para o arquivo de credenciais informado"""
+    with _clientes_lock:
+        cliente = _clientes.get(arquivo_credenciais)
+        if cliente is None:
+            cliente = _clientes[arquivo_credenciais] = ClienteSheets(arquivo_credenciais)
+        return cliente
+
+
+def obter_fila_escrita(cliente, id_planilha):
+    """Retorna a FilaEscrita do processo para a planilha"""
+    global _filas_pid
+    with _clientes_lock:
+        # As threads das filas não sobrevivem ao fork: cada worker do gunicorn cria as suas
+        if _filas_pid != os.getpid():
+            _filas.clear()
+            _filas_pid = os.getpid()
+        fila = _filas.get((id(cliente), id_planilha))
+        if fila is None:
+            fila = _filas[(id(cliente), id_planilha)] = FilaEscrita(cliente, id_planilha)
+        return fila
 
 def adicionar_dados_planilha(id_planilha, dados, arquivo_credenciais='credentials.json'):
     """
@@ -23,361 +763,106 @@ def adicionar_dados_planilha(id_planilha, dados, arquivo_credenciais='credential
         arquivo_credenciais: Caminho para o arquivo JSON de credenciais
         
     Returns:
-        Dicionário com o resultado da operação
+        Dicionário com o resultado da operação. Os erros que não se resolvem com uma nova
+        tentativa (ID ou credenciais ausentes, planilha inexistente ou sem permissão, sem
+        coluna de código) vêm com "permanente": True
     """
-    # Criar arquivo de log para depuração
-    log_file = "google_sheets_log.txt"
-    with open(log_file, "a", encoding="utf-8") as log:
-        log.write(f"\n\n--- NOVA EXECUÇÃO: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---\n")
-        log.write(f"ID da planilha: {id_planilha}\n")
-        log.write(f"Número de registros: {len(dados) if dados else 0}\n")
+    import gspread  # gspread.exceptions.APIError, usado no tratamento de erros
+    
+    log.info("Nova execução: planilha %s, %s registros", id_planilha, len(dados) if dados else 0)
+    
+    try:
+        # Verificar se há dados para adicionar
+        if not dados:
+            log.error("Nenhum dado fornecido para adicionar à planilha")
+            return {
+                "mensagem": "Nenhum dado fornecido para adicionar à planilha",
+                "id_planilha": id_planilha,
+                "registros_adicionados": 0
+            }
         
-        try:
-            # Verificar se há dados para adicionar
-            if not dados:
-                log.write("ERRO: Nenhum dado fornecido para adicionar à planilha\n")
-                return {
-                    "mensagem": "Nenhum dado fornecido para adicionar à planilha",
-                    "id_planilha": id_planilha,
-                    "registros_adicionados": 0
-                }
-            
-            # Verificar se o ID da planilha foi fornecido
-            if not id_planilha:
-                log.write("ERRO: ID da planilha não fornecido\n")
-                return {"erro": "ID da planilha não fornecido"}
-            
-            log.write(f"Iniciando adição de {len(dados)} registros à planilha {id_planilha}\n")
-            
+        # Verificar se o ID da planilha foi fornecido
+        if not id_planilha:
+            log.error("ID da planilha não fornecido")
+            return {"erro": "ID da planilha não fornecido", "permanente": True}
+        
+        log.info("Iniciando adição de %s registros à planilha %s", len(dados), id_planilha)
+        
+        # Cliente compartilhado: credenciais, autorização e planilhas abertas ficam em cache
+        cliente = obter_cliente_sheets(arquivo_credenciais)
+        
+        if cliente.client is None and not cliente.api_url:
             # Verificar se o arquivo de credenciais existe
             if not os.path.exists(arquivo_credenciais):
-                log.write(f"ERRO: Arquivo de credenciais não encontrado: {arquivo_credenciais}\n")
-                log.write(f"Diretório atual: {os.getcwd()}\n")
-                log.write(f"Arquivos no diretório: {os.listdir()}\n")
-                return {"erro": f"Arquivo de credenciais não encontrado: {arquivo_credenciais}. Verifique se o arquivo está no diretório correto."}
+                log.error("Arquivo de credenciais não encontrado: %s", arquivo_credenciais)
+                log.error("Diretório atual: %s", os.getcwd())
+                log.error("Arquivos no diretório: %s", os.listdir())
+                return {"erro": f"Arquivo de credenciais não encontrado: {arquivo_credenciais}. Verifique se o arquivo está no diretório correto.", "permanente": True}
             
             # Configurar as credenciais
-            log.write("Configurando credenciais...\n")
-            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-            
+            log.debug("Configurando credenciais")
             try:
-                credentials = Credentials.from_service_account_file(arquivo_credenciais, scopes=scope)
-                log.write("Credenciais carregadas com sucesso\n")
+                cliente.carregar_credenciais()
+                log.debug("Credenciais carregadas com sucesso")
             except FileNotFoundError:
-                log.write(f"ERRO: Arquivo de credenciais não encontrado: {arquivo_credenciais}\n")
-                return {"erro": f"Arquivo de credenciais não encontrado: {arquivo_credenciais}"}
+                log.error("Arquivo de credenciais não encontrado: %s", arquivo_credenciais)
+                return {"erro": f"Arquivo de credenciais não encontrado: {arquivo_credenciais}", "permanente": True}
             except json.JSONDecodeError:
-                log.write(f"ERRO: Arquivo de credenciais inválido (formato JSON inválido): {arquivo_credenciais}\n")
-                return {"erro": f"Arquivo de credenciais inválido (formato JSON inválido): {arquivo_credenciais}"}
+                log.error("Arquivo de credenciais inválido (formato JSON inválido): %s", arquivo_credenciais)
+                return {"erro": f"Arquivo de credenciais inválido (formato JSON inválido): {arquivo_credenciais}", "permanente": True}
             except Exception as e:
-                log.write(f"ERRO ao carregar credenciais: {str(e)}\n")
+                log.error("Erro ao carregar credenciais: %s", e)
                 return {"erro": f"Erro ao carregar credenciais: {str(e)}"}
-            
-            # Obter o email da conta de serviço para referência
-            service_account_email = "Email não encontrado"
-            try:
-                with open(arquivo_credenciais, 'r') as f:
-                    creds_data = json.load(f)
-                    service_account_email = creds_data.get('client_email', 'Email não encontrado')
-                log.write(f"Email da conta de serviço: {service_account_email}\n")
-            except Exception as e:
-                log.write(f"AVISO: Não foi possível ler o email da conta de serviço: {str(e)}\n")
-            
+        
+        if cliente.client is None:
             # Autorizar o cliente
-            log.write("Autorizando cliente gspread...\n")
+            log.debug("Autorizando cliente gspread")
             try:
-                client = gspread.authorize(credentials)
-                log.write("Cliente gspread autorizado com sucesso\n")
+                cliente.autorizar()
+                log.debug("Cliente gspread autorizado com sucesso")
             except Exception as e:
-                log.write(f"ERRO ao autorizar cliente gspread: {str(e)}\n")
+                log.error("Erro ao autorizar cliente gspread: %s", e)
                 return {"erro": f"Erro ao autorizar cliente gspread: {str(e)}"}
+        
+        # Email da conta de serviço para referência
+        service_account_email = cliente.email
+        log.debug("Email da conta de serviço: %s", service_account_email)
+        
+        # Abrir a planilha pelo ID
+        try:
+            log.debug("Tentando abrir planilha com ID: %s", id_planilha)
+            cliente.abrir_planilha(id_planilha)
+            log.debug("Planilha aberta com sucesso")
+        except gspread.exceptions.APIError as e:
+            error_message = str(e)
+            log.error("Erro da API do Google Sheets: %s", error_message)
             
-            # Abrir a planilha pelo ID
-            try:
-                log.write(f"Tentando abrir planilha com ID: {id_planilha}\n")
-                planilha = client.open_by_key(id_planilha)
-                log.write("Planilha aberta com sucesso\n")
-            except gspread.exceptions.APIError as e:
-                error_message = str(e)
-                log.write(f"ERRO API do Google Sheets: {error_message}\n")
-                
-                if "not found" in error_message.lower():
-                    log.write(f"Planilha não encontrada com o ID: {id_planilha}\n")
-                    return {"erro": f"Planilha não encontrada com o ID: {id_planilha}. Verifique se o ID está correto."}
-                elif "permission" in error_message.lower():
-                    log.write(f"Sem permissão para acessar a planilha. Certifique-se de compartilhar a planilha com {service_account_email}\n")
-                    return {"erro": f"Sem permissão para acessar a planilha. Certifique-se de compartilhar a planilha com {service_account_email} e dar permissão de edição."}
-                else:
-                    log.write(f"Erro desconhecido ao abrir planilha: {error_message}\n")
-                    return {"erro": f"Erro ao abrir planilha: {error_message}"}
-            except Exception as e:
-                log.write(f"ERRO ao abrir planilha: {str(e)}\n")
-                return {"erro": f"Erro ao abrir planilha: {str(e)}"}
-            
-            # Selecionar a primeira aba (índice 0)
-            try:
-                log.write("Selecionando primeira aba...\n")
-                aba = planilha.get_worksheet(0)
-                if not aba:
-                    log.write("Primeira aba não encontrada, criando nova aba...\n")
-                    aba = planilha.add_worksheet(title="Dados", rows=1000, cols=20)
-                    log.write("Nova aba criada com sucesso\n")
-                else:
-                    log.write("Primeira aba selecionada com sucesso\n")
-            except Exception as e:
-                log.write(f"ERRO ao selecionar aba da planilha: {str(e)}\n")
-                return {"erro": f"Erro ao selecionar aba da planilha: {str(e)}"}
-            
-            # Verificar se a planilha está vazia ou tem cabeçalho
-            try:
-                log.write("Obtendo valores existentes...\n")
-                todas_linhas = aba.get_all_values()
-                log.write(f"Obtidos {len(todas_linhas)} linhas da planilha\n")
-            except Exception as e:
-                log.write(f"ERRO ao ler dados da planilha: {str(e)}\n")
-                return {"erro": f"Erro ao ler dados da planilha: {str(e)}"}
-            
-            # Definir o mapeamento correto entre os campos dos dados e as colunas da planilha
-            # Usando os nomes de colunas exatos da planilha do usuário
-            mapeamento_colunas = {
-                "DATA DO EXAME/CONSULTA": "data_exame",
-                "COD. SOLICITAÇÃO": "codigo_solicitacao",
-                "CNS DO PACIENTE": "cns",
-                "UNID. SOLICITANTE": "municipio_residencia",
-                "UNID. EXECUTANTE": "unidade_executante",
-                "CONSULTA/EXAME/ESPECIALIDADE": "procedimento",
-                # Mapeamentos alternativos para maior compatibilidade
-                "DATA DA AUTORIZAÇÃO": "data_exame",
-                "CÓDIGO DE SOLICITAÇÃO": "codigo_solicitacao",
-                "CÓDIGO SOLICITAÇÃO": "codigo_solicitacao",
-                "CNS": "cns",
-                "UNIDADE SOLICITANTE": "municipio_residencia",
-                "UNIDADE EXECUTANTE": "unidade_executante",
-                "PROCEDIMENTO": "procedimento",
-                "ESPECIALIDADE": "procedimento",
-                "PAES": "procedimento"
-            }
-            
-            # Se a planilha estiver vazia, adicionar cabeçalho
-            if not todas_linhas:
-                log.write("Planilha vazia, adicionando cabeçalho...\n")
-                # Usar os nomes de colunas exatos da planilha do usuário
-                cabecalho = ["DATA DA AUTORIZAÇÃO", "COD. SOLICITAÇÃO", "CNS DO PACIENTE", 
-                            "UNID. SOLICITANTE", "UNID. EXECUTANTE", "PAES"]
-                try:
-                    aba.append_row(cabecalho)
-                    todas_linhas = [cabecalho]
-                    log.write(f"Cabeçalho adicionado: {cabecalho}\n")
-                except Exception as e:
-                    log.write(f"ERRO ao adicionar cabeçalho: {str(e)}\n")
-                    return {"erro": f"Erro ao adicionar cabeçalho: {str(e)}"}
+            if "not found" in error_message.lower():
+                log.error("Planilha não encontrada com o ID: %s", id_planilha)
+                return {"erro": f"Planilha não encontrada com o ID: {id_planilha}. Verifique se o ID está correto.", "permanente": True}
+            elif "permission" in error_message.lower():
+                log.error("Sem permissão para acessar a planilha. Certifique-se de compartilhar a planilha com %s", service_account_email)
+                return {"erro": f"Sem permissão para acessar a planilha. Certifique-se de compartilhar a planilha com {service_account_email} e dar permissão de edição.", "permanente": True}
             else:
-                # Se já existir cabeçalho, usar o existente
-                cabecalho = todas_linhas[0]
-                log.write(f"Cabeçalho existente: {cabecalho}\n")
-            
-            # Criar um mapeamento de índices para saber em qual coluna cada dado deve ser inserido
-            indices_colunas = {}
-            for i, nome_coluna in enumerate(cabecalho):
-                for key, campo_dado in mapeamento_colunas.items():
-                    if nome_coluna.strip().upper() == key.strip().upper():
-                        indices_colunas[campo_dado] = i
-                        break
-            
-            log.write(f"Mapeamento de índices de colunas: {indices_colunas}\n")
-            
-            # Verificar se todas as colunas necessárias foram encontradas
-            campos_necessarios = ["codigo_solicitacao", "cns", "unidade_solicitante", 
-                                "unidade_executante", "data_exame", "procedimento"]
-            campos_faltantes = [campo for campo in campos_necessarios if campo not in indices_colunas]
-            
-            if campos_faltantes:
-                log.write(f"AVISO: Algumas colunas necessárias não foram encontradas: {campos_faltantes}\n")
-                log.write("Continuando com as colunas disponíveis...\n")
-            
-            # Função para validar e formatar dados
-            def validar_e_formatar_dados(dado):
-                resultado = {}
-                
-                # Validar e formatar código de solicitação
-                codigo = dado.get("codigo_solicitacao", "")
-                if codigo and codigo != "NÃO ENCONTRADO":
-                    # Remover espaços e caracteres não numéricos
-                    codigo_limpo = re.sub(r'[^0-9]', '', codigo)
-                    if len(codigo_limpo) > 0:
-                        resultado["codigo_solicitacao"] = codigo_limpo
-                    else:
-                        resultado["codigo_solicitacao"] = ""
-                else:
-                    resultado["codigo_solicitacao"] = ""
-                
-                # Validar e formatar CNS
-                cns = dado.get("cns", "")
-                if cns and cns != "NÃO ENCONTRADO":
-                    # Remover espaços e caracteres não numéricos
-                    cns_limpo = re.sub(r'[^0-9]', '', cns)
-                    if len(cns_limpo) > 0:
-                        resultado["cns"] = cns_limpo
-                    else:
-                        resultado["cns"] = ""
-                else:
-                    resultado["cns"] = ""
-                
-                # Validar e formatar data
-                data = dado.get("data_exame", "")
-                if data and data != "NÃO ENCONTRADO":
-                    # Verificar se a data está no formato DD/MM/AAAA
-                    match = re.search(r'(\d{2}/\d{2}/\d{4})', data)
-                    if match:
-                        resultado["data_exame"] = match.group(1)
-                    else:
-                        # Tentar outros formatos comuns
-                        try:
-                            # Tentar interpretar a data em vários formatos
-                            for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y'):
-                                try:
-                                    dt = datetime.strptime(data, fmt)
-                                    resultado["data_exame"] = dt.strftime('%d/%m/%Y')
-                                    break
-                                except ValueError:
-                                    continue
-                            else:
-                                resultado["data_exame"] = data  # Manter o original se não conseguir converter
-                        except:
-                            resultado["data_exame"] = data  # Manter o original em caso de erro
-                else:
-                    resultado["data_exame"] = ""
-                
-                # Copiar outros campos sem validação específica
-                for campo in ["unidade_solicitante", "unidade_executante", "procedimento"]:
-                    valor = dado.get(campo, "")
-                    if valor and valor != "NÃO ENCONTRADO":
-                        resultado[campo] = valor
-                    else:
-                        resultado[campo] = ""
-                
-                return resultado
-            
-            # Preparar as linhas para adicionar
-            log.write("Preparando novas linhas...\n")
-            novas_linhas = []
-            codigos_duplicados = []  # Lista para armazenar códigos de solicitação duplicados
-            registros_invalidos = []
-            
-            # Determinar o índice da coluna do código de solicitação
-            indice_codigo = indices_colunas.get("codigo_solicitacao")
-            if indice_codigo is None:
-                log.write("ERRO: Coluna para código de solicitação não encontrada na planilha\n")
-                return {"erro": "Coluna para código de solicitação não encontrada na planilha. Verifique se o cabeçalho da planilha contém uma coluna para o código de solicitação."}
-            
-            # Verificar códigos existentes para evitar duplicatas
-            codigos_existentes = []
-            if todas_linhas and len(todas_linhas) > 1:  # Ignorar o cabeçalho
-                for linha in todas_linhas[1:]:
-                    if linha and len(linha) > indice_codigo:
-                        codigo = linha[indice_codigo]
-                        if codigo:
-                            codigos_existentes.append(codigo)
-            
-            log.write(f"Códigos existentes na planilha: {len(codigos_existentes)}\n")
-            
-            for dado in dados:
-                # Pular se for um erro
-                if "erro" in dado:
-                    registros_invalidos.append({"erro": dado["erro"]})
-                    continue
-                
-                # Validar e formatar os dados
-                dado_validado = validar_e_formatar_dados(dado)
-                
-                # Verificar se o código de solicitação é válido
-                codigo_solicitacao = dado_validado.get("codigo_solicitacao", "")
-                if not codigo_solicitacao:
-                    registros_invalidos.append({"erro": "Código de solicitação inválido ou não encontrado", "dados": dado})
-                    continue
-                    
-                # Verificar se o código de solicitação já existe na planilha
-                if codigo_solicitacao in codigos_existentes:
-                    codigos_duplicados.append(codigo_solicitacao)
-                    continue
-                
-                # Criar uma linha vazia com o mesmo número de colunas que o cabeçalho
-                nova_linha = [""] * len(cabecalho)
-                
-                # Preencher apenas as colunas que temos mapeamento
-                for campo, indice in indices_colunas.items():
-                    if indice < len(nova_linha):
-                        nova_linha[indice] = dado_validado.get(campo, "")
-                
-                novas_linhas.append(nova_linha)
-            
-            log.write(f"Novas linhas preparadas: {len(novas_linhas)}\n")
-            log.write(f"Códigos duplicados: {len(codigos_duplicados)}\n")
-            log.write(f"Registros inválidos: {len(registros_invalidos)}\n")
-            
-            # Se não houver novas linhas para adicionar, retornar mensagem simplificada
-            if not novas_linhas and codigos_duplicados:
-                log.write("Nenhuma nova linha para adicionar, apenas documentos duplicados.\n")
-                
-                # Criar mensagem simplificada conforme solicitado pelo usuário
-                codigos_duplicados_str = ", ".join(codigos_duplicados)
-                mensagem = f"Documento {codigos_duplicados_str} já se encontra na planilha. Registros adicionados: 0"
-                
-                return {
-                    "mensagem": mensagem,
-                    "id_planilha": id_planilha,
-                    "registros_adicionados": 0,
-                    "codigos_duplicados": codigos_duplicados
-                }
-            elif not novas_linhas:
-                log.write("Nenhum novo registro para adicionar à planilha\n")
-                return {
-                    "mensagem": "Nenhum novo registro para adicionar à planilha",
-                    "id_planilha": id_planilha,
-                    "registros_adicionados": 0
-                }
-            
-            # Encontrar a última linha preenchida
-            ultima_linha = len(todas_linhas)
-            log.write(f"Última linha preenchida: {ultima_linha}\n")
-            
-            # Adicionar as novas linhas após a última linha preenchida
-            inicio_celula = f"A{ultima_linha + 1}"
-            log.write(f"Adicionando {len(novas_linhas)} novas linhas a partir de {inicio_celula}...\n")
-            
-            try:
-                aba.update(inicio_celula, novas_linhas, value_input_option="USER_ENTERED")
-                log.write("Dados adicionados com sucesso à planilha\n")
-            except gspread.exceptions.APIError as e:
-                error_message = str(e)
-                log.write(f"ERRO API do Google Sheets ao adicionar dados: {error_message}\n")
-                
-                if "permission" in error_message.lower():
-                    return {"erro": f"Sem permissão para editar a planilha. Certifique-se de compartilhar a planilha com {service_account_email} e dar permissão de edição."}
-                else:
-                    return {"erro": f"Erro ao adicionar dados à planilha: {error_message}"}
-            except Exception as e:
-                log.write(f"ERRO ao adicionar dados à planilha: {str(e)}\n")
-                return {"erro": f"Erro ao adicionar dados à planilha: {str(e)}"}
-            
-            # Criar mensagem de resultado com formato simplificado
-            mensagem = f"Registros adicionados: {len(novas_linhas)}"
-            
-            # Se houver documentos duplicados, adicionar à mensagem
-            if codigos_duplicados:
-                codigos_duplicados_str = ", ".join(codigos_duplicados)
-                mensagem = f"Documento {codigos_duplicados_str} já se encontra na planilha. {mensagem}"
-            
-            log.write(f"Operação concluída com sucesso: {mensagem}\n")
-            return {
-                "mensagem": mensagem,
-                "id_planilha": id_planilha,
-                "registros_adicionados": len(novas_linhas),
-                "codigos_duplicados": codigos_duplicados
-            }
-            
+                log.error("Erro desconhecido ao abrir planilha: %s", error_message)
+                return {"erro": f"Erro ao abrir planilha: {error_message}"}
         except Exception as e:
-            erro_detalhado = traceback.format_exc()
-            log.write(f"ERRO DETALHADO: {erro_detalhado}\n")
-            return {"erro": f"Erro ao adicionar dados à planilha: {str(e)}"}
-    
\ No newline at end of file
+            log.error("Erro ao abrir planilha: %s", e)
+            return {"erro": f"Erro ao abrir planilha: {str(e)}"}
+        
+        # Selecionar a primeira aba (índice 0)
+        try:
+            log.debug("Selecionando primeira aba")
+            cliente.obter_aba(id_planilha)
+        except Exception as e:
+            cliente.invalidar(id_planilha)
+            log.error("Erro ao selecionar aba da planilha: %s", e)
+            return {"erro": f"Erro ao selecionar aba da planilha: {str(e)}"}
+        
+        # Leitura do índice, deduplicação e escrita ficam com a fila da planilha, que
+        # reúne em um único lote os envios simultâneos
+        return obter_fila_escrita(cliente, id_planilha).enviar(dados)
+        
+    except Exception as e:
+        log.exception("Erro ao adicionar dados à planilha")
+        return {"erro": f"Erro ao adicionar dados à planilha: {str(e)}"}
@@ -0,0 +1,38 @@
+"""
+Configuração do gunicorn (lida automaticamente quando o gunicorn é iniciado na pasta do projeto)
+
+Com PRECARREGAR_APP=1, a aplicação é importada e aquecida uma única vez no processo
+mestre (ver main.aquecer) e os workers são criados por fork a partir dele: cada worker
+sobe sem importar nada e compartilha com o mestre as páginas de memória que não
+modifica (copy-on-write). Sem a variável, cada worker importa a aplicação ao subir e as
+dependências pesadas são carregadas na primeira requisição que as usa.
+"""
+
+import os
+
+preload_app = os.environ.get("PRECARREGAR_APP", "0") == "1"
+
+# Workers com threads: uma requisição que chega enquanto o worker extrai PDFs é aceita e
+# passa pelo controle de admissão (main.fila_extracao), que a coloca na fila ou responde
+# 503 imediatamente, em vez de esperar no socket até o timeout. As threads devem cobrir
+# EXTRACOES_SIMULTANEAS + EXTRACOES_FILA e ainda sobrar para as rotas leves.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+
+def on_starting(server):
+    # Executado no mestre antes de carregar a aplicação: as métricas recomeçam do zero, sem
+    # os retratos dos workers de execuções anteriores (ver metricas.py)
+    from metricas import limpar_retratos
+    limpar_retratos()
+
+
+def when_ready(server):
+    # Executado no mestre depois de carregar a aplicação e antes de criar os workers
+    if preload_app:
+        import gc
+        from main import aquecer
+        aquecer()
+        # Os objetos criados até aqui saem das coletas do gc, que ao percorrê-los
+        # tocariam as páginas compartilhadas e forçariam a cópia em cada worker
+        gc.freeze()
@@ -0,0 +1,181 @@
+"""
+Pool de processos isolados para a leitura dos PDFs.
+
+Um PDF malformado pode fazer o PyPDF2 entrar em laço ou alocar memória sem limite. Cada
+documento é lido em um processo separado, com limite de memória (RLIMIT_AS) e tempo
+máximo de execução: um processo que excede o tempo ou morre é encerrado (SIGKILL) e
+substituído no próximo documento, e apenas aquele documento termina com erro.
+
+Os processos são persistentes (um por tarefa simultânea, até `processos`) e criados por
+fork sob demanda, herdando os módulos já importados. Cada tarefa é acompanhada por uma
+thread de supervisão; `submit` devolve um Future, como o ProcessPoolExecutor.
+"""
+
+import os
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from diagnostico import obter_logger
+from metricas import metricas
+
+logger = obter_logger("sisreg.isolamento")
+
+MENSAGENS = {
+    "tempo": "Tempo limite de {timeout:g}s excedido ao ler o PDF",
+    "memoria": "Limite de memória de {memoria_mb} MB excedido ao ler o PDF",
+    "encerrado": "O processo que lia o PDF foi encerrado inesperadamente",
+}
+
+
+class FalhaIsolamento(Exception):
+    """
+    A tarefa não terminou no processo isolado
+
+    Args:
+        motivo: "tempo", "memoria" ou "encerrado"
+        mensagem: Descrição para o campo "erro" do resultado
+    """
+
+    def __init__(self, motivo, mensagem):
+        super().__init__(mensagem)
+        self.motivo = motivo
+
+
+def _memoria_virtual():
+    # Tamanho atual do espaço de endereçamento do processo (Linux), em bytes
+    try:
+        with open("/proc/self/statm") as arquivo:
+            return int(arquivo.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _limitar_memoria(memoria_mb):
+    # O limite é somado ao que o processo já herdou do worker no fork
+    import resource
+    atual = _memoria_virtual()
+    if not memoria_mb or atual is None:
+        return
+    limite = atual + memoria_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+
+
+def _trabalhador(conexao, memoria_mb):
+    """Laço do processo isolado: recebe (funcao, args) e devolve (sucesso, valor)"""
+    # Interrupções (Ctrl+C em processar_lote.py) são tratadas pelo processo pai
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _limitar_memoria(memoria_mb)
+    while True:
+        try:
+            funcao, args = conexao.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            resposta = (True, funcao(*args))
+        except MemoryError:
+            # O processo é descartado: a memória fragmentada não volta para o sistema
+            resposta = (False, "memoria")
+        except Exception as e:
+            resposta = (False, f"{type(e).__name__}: {e}")
+        try:
+            conexao.send(resposta)
+        except MemoryError:
+            return
+        if resposta == (False, "memoria"):
+            return
+
+
+class _Processo:
+    """Processo isolado e a ponta da conexão usada pelo pai"""
+
+    __slots__ = ("processo", "conexao")
+
+    def __init__(self, contexto, memoria_mb):
+        self.conexao, conexao_filho = contexto.Pipe()
+        self.processo = contexto.Process(target=_trabalhador, args=(conexao_filho, memoria_mb), daemon=True)
+        self.processo.start()
+        conexao_filho.close()
+
+    def encerrar(self):
+        if self.processo.is_alive():
+            self.processo.kill()
+        self.processo.join(5)
+        self.conexao.close()
+
+
+class PoolIsolado:
+    """
+    Pool de processos com tempo máximo por tarefa e limite de memória.
+
+    Args:
+        processos: Tarefas (e processos) simultâneos
+        timeout: Tempo máximo (em segundos) de cada tarefa
+        memoria_mb: Memória adicional que cada processo pode alocar (0 desativa o limite)
+    """
+
+    def __init__(self, processos=1, timeout=20.0, memoria_mb=512):
+        self.processos = max(processos, 1)
+        self.timeout = timeout
+        self.memoria_mb = memoria_mb
+        self._contexto = multiprocessing.get_context("fork")
+        self._supervisores = ThreadPoolExecutor(max_workers=self.processos, thread_name_prefix="isolamento")
+        self._ociosos = []
+        self._lock = threading.Lock()
+
+    def submit(self, funcao, *args):
+        """
+        Executa `funcao(*args)` em um processo isolado
+
+        Returns:
+            Future com o valor retornado pela função. Falha com FalhaIsolamento se o
+            processo exceder o tempo ou a memória, ou morrer durante a tarefa
+        """
+        return self._supervisores.submit(self._executar, funcao, args)
+
+    def _obter_processo(self):
+        with self._lock:
+            while self._ociosos:
+                processo = self._ociosos.pop()
+                if processo.processo.is_alive():
+                    return processo
+                # Morreu enquanto estava ocioso (ex.: OOM killer): não culpar o próximo PDF
+                processo.encerrar()
+        return _Processo(self._contexto, self.memoria_mb)
+
+    def _executar(self, funcao, args):
+        processo = self._obter_processo()
+        try:
+            processo.conexao.send((funcao, args))
+            if processo.conexao.poll(self.timeout):
+                sucesso, valor = processo.conexao.recv()
+                if sucesso:
+                    with self._lock:
+                        self._ociosos.append(processo)
+                    return valor
+                if valor != "memoria":
+                    # Exceção da própria função: o processo continua íntegro
+                    with self._lock:
+                        self._ociosos.append(processo)
+                    raise RuntimeError(valor)
+                motivo = "memoria"
+            else:
+                motivo = "tempo"
+        except (EOFError, OSError):
+            motivo = "encerrado"
+
+        codigo = processo.processo.exitcode
+        processo.encerrar()
+        logger.warning("Processo isolado %s descartado (%s, código de saída %s)",
+                       processo.processo.pid, motivo, codigo)
+        metricas.incrementar("sisreg_isolamento_total", motivo=motivo)
+        raise FalhaIsolamento(motivo, MENSAGENS[motivo].format(timeout=self.timeout, memoria_mb=self.memoria_mb))
+
+    def encerrar(self):
+        """Encerra os processos ociosos e as threads de supervisão"""
+        with self._lock:
+            ociosos, self._ociosos = self._ociosos, []
+        for processo in ociosos:
+            processo.encerrar()
+        self._supervisores.shutdown(wait=False)
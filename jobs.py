@@ -0,0 +1,289 @@
+"""
+Processamento assíncrono de lotes de PDFs (rotas /jobs).
+
+A requisição apenas grava os arquivos em uma pasta temporária e devolve o ID do job;
+uma thread em segundo plano processa os arquivos em lotes (cada lote passa pelo cache
+e pelo pool de processos de `processar_pdfs`) e atualiza o progresso, que pode ser
+consultado enquanto o job está em andamento.
+
+O estado e os resultados de cada job ficam em um banco SQLite compartilhado pelos
+workers do gunicorn: o job é processado pelo worker que recebeu os arquivos, mas pode
+ser consultado em qualquer um. Um job cujo processo terminou antes de concluí-lo é
+informado como erro.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from diagnostico import obter_logger
+
+logger = obter_logger("sisreg.jobs")
+
+NA_FILA = "na_fila"
+PROCESSANDO = "processando"
+CONCLUIDO = "concluido"
+ERRO = "erro"
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    estado TEXT NOT NULL,
+    erro TEXT,
+    total INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    criado_em REAL NOT NULL,
+    concluido_em REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_concluidos ON jobs (concluido_em);
+CREATE TABLE IF NOT EXISTS jobs_resultados (
+    id_job TEXT NOT NULL,
+    posicao INTEGER NOT NULL,
+    resultado TEXT NOT NULL,
+    PRIMARY KEY (id_job, posicao)
+);
+"""
+
+
+def _processo_ativo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Job:
+    """
+    Job gravado no banco (os dados são lidos a cada consulta).
+
+    Args:
+        gerenciador: GerenciadorJobs dono do banco
+        id_job: Identificador do job
+    """
+
+    def __init__(self, gerenciador, id_job):
+        self.gerenciador = gerenciador
+        self.id = id_job
+
+    def resumo(self):
+        """
+        Returns:
+            Dicionário com o progresso e os resultados já disponíveis, no mesmo formato
+            `resultados`/`estatisticas` da rota /upload (None se o job não existir mais)
+        """
+        job, resultados = self.gerenciador._ler(self.id)
+        if job is None:
+            return None
+        estado, erro = job["estado"], job["erro"]
+        if estado in (NA_FILA, PROCESSANDO) and not _processo_ativo(job["pid"]):
+            # O worker foi encerrado (reinício, OOM) com o job em andamento
+            estado, erro = ERRO, "O processo que executava o job foi encerrado"
+            self.gerenciador._finalizar(self.id, ERRO, erro)
+        total = job["total"]
+        falhas = sum(1 for resultado in resultados if "erro" in resultado)
+        resumo = {
+            "id": self.id,
+            "estado": estado,
+            "progresso": {
+                "total": total,
+                "concluidos": len(resultados),
+                "percentual": round(100 * len(resultados) / total, 1) if total else 100.0
+            },
+            "resultados": resultados,
+            "estatisticas": {
+                "total": total,
+                "sucessos": len(resultados) - falhas,
+                "falhas": falhas
+            }
+        }
+        if erro:
+            resumo["erro"] = erro
+        return resumo
+
+
+class GerenciadorJobs:
+    """
+    Fila de jobs executados em segundo plano.
+
+    Args:
+        caminho: Arquivo do banco SQLite com o estado e os resultados dos jobs
+        processar_lote: Função (pdfs, nomes_arquivos) -> resultados, ex.: `processar_pdfs`
+        max_simultaneos: Número de jobs processados ao mesmo tempo (por processo)
+        tamanho_lote: Número de arquivos enviados de cada vez para `processar_lote`
+        ttl: Tempo (em segundos) que um job finalizado continua disponível para consulta
+    """
+
+    def __init__(self, caminho, processar_lote, max_simultaneos=1, tamanho_lote=4, ttl=3600):
+        self.caminho = caminho
+        self.processar_lote = processar_lote
+        self.max_simultaneos = max_simultaneos
+        self.tamanho_lote = max(tamanho_lote, 1)
+        self.ttl = ttl
+        self._iniciado = False
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def _conectar(self):
+        # Uma conexão por operação: as conexões do sqlite3 não são compartilhadas entre
+        # threads nem sobrevivem ao fork
+        conexao = sqlite3.connect(self.caminho, timeout=30, isolation_level=None)
+        conexao.row_factory = sqlite3.Row
+        return conexao
+
+    def _iniciar_banco(self):
+        with self._lock:
+            if self._iniciado:
+                return
+            diretorio = os.path.dirname(self.caminho)
+            if diretorio:
+                os.makedirs(diretorio, exist_ok=True)
+            conexao = self._conectar()
+            try:
+                conexao.execute("PRAGMA journal_mode=WAL")
+                conexao.executescript(_ESQUEMA)
+            finally:
+                conexao.close()
+            self._iniciado = True
+
+    def _obter_executor(self):
+        # As threads não sobrevivem ao fork: cada worker do gunicorn cria as suas
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_simultaneos,
+                                                    thread_name_prefix="job")
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _remover_expirados(self):
+        limite = time.time() - self.ttl
+        conexao = self._conectar()
+        try:
+            conexao.execute("BEGIN IMMEDIATE")
+            conexao.execute("""DELETE FROM jobs_resultados WHERE id_job IN
+                               (SELECT id FROM jobs WHERE concluido_em < ?)""", (limite,))
+            conexao.execute("DELETE FROM jobs WHERE concluido_em < ?", (limite,))
+            conexao.execute("COMMIT")
+        except Exception:
+            conexao.execute("ROLLBACK")
+            raise
+        finally:
+            conexao.close()
+
+    def _registrar(self, id_job, posicoes, resultados):
+        """Guarda os resultados de um lote processado"""
+        conexao = self._conectar()
+        try:
+            conexao.executemany(
+                "INSERT OR REPLACE INTO jobs_resultados (id_job, posicao, resultado) VALUES (?, ?, ?)",
+                [(id_job, posicao, json.dumps(resultado, ensure_ascii=False))
+                 for posicao, resultado in zip(posicoes, resultados)])
+        finally:
+            conexao.close()
+
+    def _atualizar_estado(self, id_job, estado):
+        conexao = self._conectar()
+        try:
+            conexao.execute("UPDATE jobs SET estado = ? WHERE id = ?", (estado, id_job))
+        finally:
+            conexao.close()
+
+    def _finalizar(self, id_job, estado, erro=None):
+        conexao = self._conectar()
+        try:
+            conexao.execute("UPDATE jobs SET estado = ?, erro = ?, concluido_em = ? WHERE id = ? AND estado IN (?, ?)",
+                            (estado, erro, time.time(), id_job, NA_FILA, PROCESSANDO))
+        finally:
+            conexao.close()
+
+    def _ler(self, id_job):
+        """
+        Returns:
+            Tupla (job, resultados): linha da tabela jobs (None se não existir) e os
+            resultados já gravados, na ordem do envio
+        """
+        conexao = self._conectar()
+        try:
+            job = conexao.execute("SELECT * FROM jobs WHERE id = ?", (id_job,)).fetchone()
+            if job is None:
+                return None, []
+            resultados = [json.loads(linha[0]) for linha in conexao.execute(
+                "SELECT resultado FROM jobs_resultados WHERE id_job = ? ORDER BY posicao", (id_job,))]
+        finally:
+            conexao.close()
+        return job, resultados
+
+    def submeter(self, resultados, pendentes, pasta_temporaria=None):
+        """
+        Cria um job e o coloca na fila.
+
+        Args:
+            resultados: Lista com um item por arquivo (None para os que serão processados,
+                ou o erro de validação já conhecido)
+            pendentes: Lista de tuplas (posicao, pdf, nome_arquivo) a processar
+            pasta_temporaria: Pasta com os arquivos do job, removida ao final
+
+        Returns:
+            Job criado
+        """
+        self._iniciar_banco()
+        self._remover_expirados()
+        id_job = uuid.uuid4().hex
+        conexao = self._conectar()
+        try:
+            conexao.execute("BEGIN IMMEDIATE")
+            conexao.execute("INSERT INTO jobs (id, estado, total, pid, criado_em) VALUES (?, ?, ?, ?, ?)",
+                            (id_job, NA_FILA, len(resultados), os.getpid(), time.time()))
+            conexao.executemany(
+                "INSERT INTO jobs_resultados (id_job, posicao, resultado) VALUES (?, ?, ?)",
+                [(id_job, posicao, json.dumps(resultado, ensure_ascii=False))
+                 for posicao, resultado in enumerate(resultados) if resultado is not None])
+            conexao.execute("COMMIT")
+        except Exception:
+            conexao.execute("ROLLBACK")
+            raise
+        finally:
+            conexao.close()
+        job = Job(self, id_job)
+        self._obter_executor().submit(self._executar, id_job, pendentes, pasta_temporaria)
+        logger.info("Job %s criado: %s arquivos, %s a processar", id_job, len(resultados), len(pendentes))
+        return job
+
+    def obter(self, id_job):
+        """Retorna o job pelo ID (None se não existir ou já tiver expirado)"""
+        self._iniciar_banco()
+        self._remover_expirados()
+        conexao = self._conectar()
+        try:
+            existe = conexao.execute("SELECT 1 FROM jobs WHERE id = ?", (id_job,)).fetchone()
+        finally:
+            conexao.close()
+        return Job(self, id_job) if existe else None
+
+    def _executar(self, id_job, pendentes, pasta_temporaria):
+        inicio = time.perf_counter()
+        try:
+            self._atualizar_estado(id_job, PROCESSANDO)
+            for i in range(0, len(pendentes), self.tamanho_lote):
+                lote = pendentes[i:i + self.tamanho_lote]
+                processados = self.processar_lote([pdf for _, pdf, _ in lote], [nome for _, _, nome in lote])
+                self._registrar(id_job, [posicao for posicao, _, _ in lote], processados)
+            self._finalizar(id_job, CONCLUIDO)
+            logger.info("Job %s concluído em %.1fs", id_job, time.perf_counter() - inicio)
+        except Exception as e:
+            logger.exception("Erro ao processar o job %s", id_job)
+            try:
+                self._finalizar(id_job, ERRO, str(e))
+            except Exception:
+                logger.exception("Erro ao gravar o estado do job %s", id_job)
+        finally:
+            if pasta_temporaria:
+                shutil.rmtree(pasta_temporaria, ignore_errors=True)
@@ -1,14 +1,57 @@
+import io
 import os
-import re
-import PyPDF2
-import pandas as pd
-from flask import Flask, request, jsonify, render_template, send_from_directory
+import importlib
+import csv
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+import json
+from concurrent.futures import FIRST_COMPLETED, wait
+from flask import Flask, Request, Response, g, request, jsonify, render_template, send_file, url_for
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 from google_sheets_integration_fix import adicionar_dados_planilha
+from extrator_sisreg import (campos_vazios, extrair_campos, parar_leitura, LeituraPaginas,
+                             assinatura_layout, classificar_layout, LAYOUT_DESCONHECIDO)
+from cidades_paraiba import CidadesParaiba
+from cache_resultados import CacheResultados
+from diagnostico import obter_logger, captura_texto
+from jobs import GerenciadorJobs
+from caixa_saida import CaixaSaida, PENDENTE
+from base_resultados import BaseResultados, FILTROS as FILTROS_RESULTADOS
+from admissao import FilaExtracao, FilaCheia
+from triagem_pdf import ArquivoTriado, Recusa
+from ocr_paginas import MotorOcr, OcrPendente
+from isolamento import PoolIsolado, FalhaIsolamento
+from metricas import metricas, limpar_retratos
+
+
+class RequisicaoSisreg(Request):
+    """
+    Requisição com limite de tamanho próprio para o envio de lotes (/jobs) e triagem dos
+    arquivos enviados enquanto o corpo é recebido (ver triagem_pdf.py)
+    """
+    
+    @property
+    def max_content_length(self):
+        if self.path == '/jobs':
+            return app.config['MAX_CONTENT_LENGTH_JOB']
+        return super().max_content_length
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        recusa = None
+        if filename and not allowed_file(filename):
+            recusa = Recusa("extensao", "Tipo de arquivo não permitido")
+        # Os arquivos de /jobs (até MAX_CONTENT_LENGTH_JOB por requisição) vão direto para o
+        # disco: criar_job grava todos em disco de qualquer forma
+        em_memoria = 0 if self.path == '/jobs' else app.config['MAX_UPLOAD_EM_MEMORIA']
+        return ArquivoTriado(app.config['MAX_FILE_SIZE'], em_memoria, recusa)
 
 
 app = Flask(__name__)
+app.request_class = RequisicaoSisreg
+logger = obter_logger("sisreg.extracao")
 CORS(app)  # Habilita CORS para todas as rotas
 
 # Configurações
@@ -16,62 +59,243 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf'}
 MAX_FILE_SIZE = 2 * 1024 * 1024  # 2MB em bytes
 MAX_FILES = 10
+# Número de processos usados para processar os PDFs de um upload em paralelo (por worker do gunicorn)
+MAX_PROCESSOS = int(os.environ.get("MAX_PROCESSOS", os.cpu_count() or 1))
+# Cada PDF é lido em um processo isolado (ver isolamento.py): tempo máximo (em segundos)
+# e memória adicional (em MB, 0 desativa o limite) de cada leitura
+EXTRACAO_TIMEOUT = float(os.environ.get("EXTRACAO_TIMEOUT", 20))
+EXTRACAO_MEMORIA_MB = int(os.environ.get("EXTRACAO_MEMORIA_MB", 512))
+# Número máximo de resultados mantidos no cache por conteúdo do PDF
+MAX_CACHE_RESULTADOS = int(os.environ.get("MAX_CACHE_RESULTADOS", 256))
+# Arquivos maiores que este limite são gravados em um arquivo temporário em vez de mantidos em
+# memória (padrão de 500 KB, o mesmo do Werkzeug; deve ficar abaixo de MAX_FILE_SIZE)
+MAX_UPLOAD_EM_MEMORIA = int(os.environ.get("MAX_UPLOAD_EM_MEMORIA", 500 * 1024))
+# Jobs assíncronos (/jobs): número máximo de arquivos por envio, jobs processados ao mesmo
+# tempo e tempo (em segundos) que um job finalizado continua disponível para consulta;
+# o estado e os resultados ficam no banco SQLite JOBS_DB, compartilhado pelos workers
+MAX_FILES_JOB = int(os.environ.get("MAX_ARQUIVOS_JOB", 500))
+JOBS_SIMULTANEOS = int(os.environ.get("JOBS_SIMULTANEOS", 1))
+JOBS_TTL = int(os.environ.get("JOBS_TTL", 3600))
+JOBS_DB = os.environ.get("JOBS_DB", "jobs.db")
+# Caixa de saída da planilha (/planilha): banco SQLite, tentativas de entrega, espera
+# (em segundos) antes da segunda tentativa, dobrada a cada falha, e tempo (em segundos)
+# após a entrega em que um reenvio do mesmo código é recusado sem consultar a planilha
+CAIXA_SAIDA_DB = os.environ.get("CAIXA_SAIDA_DB", "caixa_saida.db")
+CAIXA_SAIDA_TENTATIVAS = int(os.environ.get("CAIXA_SAIDA_TENTATIVAS", 8))
+CAIXA_SAIDA_BACKOFF = float(os.environ.get("CAIXA_SAIDA_BACKOFF", 5))
+CAIXA_SAIDA_JANELA_DUPLICADOS = float(os.environ.get("CAIXA_SAIDA_JANELA_DUPLICADOS", 3600))
+# Controle de admissão de /upload e /upload/stream (por worker): extrações simultâneas,
+# requisições que podem esperar por uma vaga e espera máxima (em segundos) na fila
+EXTRACOES_SIMULTANEAS = int(os.environ.get("EXTRACOES_SIMULTANEAS", 1))
+EXTRACOES_FILA = int(os.environ.get("EXTRACOES_FILA", 2))
+EXTRACOES_ESPERA_MAXIMA = float(os.environ.get("EXTRACOES_ESPERA_MAXIMA", 20))
+# Base local dos registros extraídos (/resultados); vazio desativa a gravação
+RESULTADOS_DB = os.environ.get("RESULTADOS_DB", "resultados.db")
+# OCR das páginas sem camada de texto (ver ocr_paginas.py): processos e documentos na fila
+# do pool de OCR (por worker), resolução, idioma do tesseract, tempo máximo (em segundos)
+# por página, páginas reconhecidas por documento e páginas mantidas no cache
+OCR_ATIVO = os.environ.get("OCR_ATIVO", "1") == "1"
+OCR_PROCESSOS = int(os.environ.get("OCR_PROCESSOS", 1))
+OCR_FILA = int(os.environ.get("OCR_FILA", 8))
+OCR_DPI = int(os.environ.get("OCR_DPI", 300))
+OCR_IDIOMA = os.environ.get("OCR_IDIOMA", "por")
+OCR_TIMEOUT_PAGINA = float(os.environ.get("OCR_TIMEOUT_PAGINA", 30))
+OCR_MAX_PAGINAS = int(os.environ.get("OCR_MAX_PAGINAS", 4))
+OCR_CACHE_PAGINAS = int(os.environ.get("OCR_CACHE_PAGINAS", 256))
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE * MAX_FILES  # Limite total para todos os arquivos
+app.config['MAX_FILE_SIZE'] = MAX_FILE_SIZE
+app.config['MAX_PROCESSOS'] = MAX_PROCESSOS
+app.config['EXTRACAO_TIMEOUT'] = EXTRACAO_TIMEOUT
+app.config['EXTRACAO_MEMORIA_MB'] = EXTRACAO_MEMORIA_MB
+app.config['MAX_CACHE_RESULTADOS'] = MAX_CACHE_RESULTADOS
+app.config['MAX_UPLOAD_EM_MEMORIA'] = MAX_UPLOAD_EM_MEMORIA
+app.config['MAX_CONTENT_LENGTH_JOB'] = MAX_FILE_SIZE * MAX_FILES_JOB
+app.config['JOBS_DB'] = JOBS_DB
+app.config['CAIXA_SAIDA_DB'] = CAIXA_SAIDA_DB
+app.config['CAIXA_SAIDA_JANELA_DUPLICADOS'] = CAIXA_SAIDA_JANELA_DUPLICADOS
+app.config['RESULTADOS_DB'] = RESULTADOS_DB
+app.config['EXTRACOES_SIMULTANEAS'] = EXTRACOES_SIMULTANEAS
+app.config['EXTRACOES_FILA'] = EXTRACOES_FILA
+app.config['EXTRACOES_ESPERA_MAXIMA'] = EXTRACOES_ESPERA_MAXIMA
+app.config['OCR_ATIVO'] = OCR_ATIVO
+app.config['OCR_PROCESSOS'] = OCR_PROCESSOS
+app.config['OCR_DPI'] = OCR_DPI
+app.config['OCR_TIMEOUT_PAGINA'] = OCR_TIMEOUT_PAGINA
+
+# Cache dos resultados, indexado pelo SHA-256 do conteúdo de cada PDF
+cache_pdfs = CacheResultados(MAX_CACHE_RESULTADOS)
+
+# Envios para a planilha: gravados no banco e entregues em segundo plano
+caixa_saida = CaixaSaida(CAIXA_SAIDA_DB, adicionar_dados_planilha, tentativas=CAIXA_SAIDA_TENTATIVAS,
+                         backoff=CAIXA_SAIDA_BACKOFF, janela_duplicados=CAIXA_SAIDA_JANELA_DUPLICADOS)
+
+# Fila limitada das extrações feitas dentro da requisição (ver admissao.py)
+fila_extracao = FilaExtracao(EXTRACOES_SIMULTANEAS, EXTRACOES_FILA, EXTRACOES_ESPERA_MAXIMA)
+
+# OCR das guias digitalizadas, em um pool de processos separado do pool de extração
+motor_ocr = MotorOcr(OCR_PROCESSOS, OCR_FILA, OCR_DPI, OCR_IDIOMA, OCR_TIMEOUT_PAGINA, OCR_MAX_PAGINAS,
+                     OCR_CACHE_PAGINAS, ativo=OCR_ATIVO)
+
+# Registros extraídos, consultados em /resultados
+base_resultados = BaseResultados(RESULTADOS_DB) if RESULTADOS_DB else None
+
+# Pool de processos isolados criado sob demanda (ver obter_pool)
+_pool = None
+_pool_pid = None
 
-# Criar pasta de uploads se não existir
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
     """Verifica se o arquivo tem uma extensão permitida"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extrair_texto_pdf(pdf_path):
+def validar_arquivo(file):
+    """
+    Verifica a extensão, o tamanho e a estrutura de um arquivo enviado
+    
+    O tamanho e o cabeçalho %PDF- já foram conferidos enquanto o arquivo era recebido
+    (ver triagem_pdf.ArquivoTriado); aqui a triagem é concluída com a leitura do final
+    do arquivo, sem criar um PdfReader.
+    
+    Returns:
+        Tupla (erro, tamanho): dicionário de erro no formato dos resultados (None se o
+        arquivo for aceito) e o tamanho do arquivo em bytes
+    """
+    # Verificar se é um arquivo permitido
+    if not allowed_file(file.filename):
+        return {"erro": f"Tipo de arquivo não permitido: {file.filename}", "arquivo": file.filename}, 0
+    
+    # Concluir a triagem (tamanho, cabeçalho, xref/trailer e criptografia)
+    recusa = file.stream.verificar()
+    if recusa:
+        return {"erro": f"{recusa.mensagem}: {file.filename}", "arquivo": file.filename}, file.stream.tamanho
+    return None, file.stream.tamanho
+
+@contextmanager
+def abrir_pdf(pdf):
+    """
+    Abre um PDF recebido como caminho, bytes ou objeto de arquivo binário.
+    
+    Yields:
+        Stream binário posicionado no início do documento
+    """
+    if isinstance(pdf, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(pdf)
+    elif isinstance(pdf, (str, os.PathLike)):
+        with open(pdf, 'rb') as file:
+            yield file
+    else:
+        # Objeto de arquivo (ex.: stream do Werkzeug ou BytesIO): não é fechado aqui
+        pdf.seek(0)
+        yield pdf
+
+def ler_bytes_pdf(pdf):
+    """Retorna o conteúdo de um PDF recebido como caminho, bytes ou objeto de arquivo"""
+    if isinstance(pdf, bytes):
+        return pdf
+    with abrir_pdf(pdf) as file:
+        return file.read()
+
+def nome_pdf(pdf, nome_arquivo=None):
+    """Retorna o nome usado no campo "arquivo" do resultado"""
+    if nome_arquivo:
+        return nome_arquivo
+    if isinstance(pdf, (str, os.PathLike)):
+        return os.path.basename(pdf)
+    return os.path.basename(getattr(pdf, 'name', '') or '')
+
+def gerar_texto_paginas(reader, modo_layout=False):
+    """
+    Gera o texto de cada página do PDF sob demanda.
+    
+    Páginas que não forem consumidas pelo chamador não são processadas.
+    
+    Args:
+        reader: PyPDF2.PdfReader já aberto
+        modo_layout: Se True, tenta a extração em modo layout antes do modo padrão
+        
+    Yields:
+        String com o texto de cada página
+    """
+    for page in reader.pages:
+        inicio = time.perf_counter()
+        if not modo_layout:
+            texto = page.extract_text()
+        else:
+            try:
+                # Tenta extrair texto ignorando LTFigures (pode ajudar em alguns PDFs)
+                texto = page.extract_text(extraction_mode="layout", layout_mode_space_vertically=True)
+            except Exception:
+                # Fallback para o método padrão
+                texto = page.extract_text()
+        metricas.observar("sisreg_pdf_segundos", time.perf_counter() - inicio, etapa="pagina")
+        yield texto
+
+def _juntar_paginas(reader, modo_layout, parar_quando, textos_paginas=None):
+    """
+    Concatena o texto das páginas, parando antes do fim se o critério criado por
+    `parar_quando` indicar que o texto já lido é suficiente. O texto de cada página
+    lida é acrescentado a `textos_paginas`, se informada.
+    """
+    # Um critério novo a cada leitura: ele guarda o que já foi encontrado nas páginas anteriores
+    criterio = parar_quando() if parar_quando else None
+    partes = []
+    total_paginas = len(reader.pages)
+    for num_pagina, texto_pagina in enumerate(gerar_texto_paginas(reader, modo_layout), 1):
+        partes.append(texto_pagina + "\n")
+        if textos_paginas is not None:
+            textos_paginas.append(texto_pagina)
+        if criterio and num_pagina < total_paginas:
+            with metricas.cronometrar("sisreg_pdf_segundos", etapa="verificar_campos"):
+                completo = criterio(texto_pagina)
+            if completo:
+                break
+    return "".join(partes)
+
+def extrair_texto_pdf(pdf, parar_quando=None, textos_paginas=None):
     """
     Extrai texto de um arquivo PDF usando apenas PyPDF2 com técnicas otimizadas.
     
+    O arquivo é aberto e interpretado uma única vez; o mesmo PdfReader é reutilizado
+    em todas as técnicas de fallback.
+    
     Args:
-        pdf_path: Caminho para o arquivo PDF
+        pdf: Caminho, bytes ou objeto de arquivo binário do PDF
+        parar_quando: Fábrica opcional do critério de parada (ex.: LeituraPaginas): o
+            critério recebe o texto de cada página e retorna True quando as páginas
+            restantes não precisam ser lidas
+        textos_paginas: Lista opcional que recebe o texto de cada página lida, na ordem
+            (as páginas em branco são as candidatas ao OCR). Quando informada, o fallback
+            de metadados não é usado: um PDF sem texto em nenhuma página retorna string vazia
         
     Returns:
         String contendo o texto extraído do PDF
     """
+    import PyPDF2  # Carregado na primeira extração (ou em aquecer)
+    
     try:
-        # Método principal: PyPDF2 com configurações padrão
-        texto_total = ""
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            for page_num in range(len(reader.pages)):
-                texto_total += reader.pages[page_num].extract_text() + "\n"
-        
-        # Se conseguiu extrair texto, retorna
-        if texto_total.strip():
-            return texto_total
-        
-        # Se não conseguiu extrair texto, tenta técnicas alternativas
-        texto_alternativo = ""
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
+        with abrir_pdf(pdf) as file:
+            with metricas.cronometrar("sisreg_pdf_segundos", etapa="abrir"):
+                reader = PyPDF2.PdfReader(file)
             
-            # Técnica 1: Extrair texto com diferentes parâmetros
-            for page_num in range(len(reader.pages)):
-                # Tenta extrair texto com diferentes configurações
-                page = reader.pages[page_num]
-                try:
-                    # Tenta extrair texto ignorando LTFigures (pode ajudar em alguns PDFs)
-                    texto_alternativo += page.extract_text(extraction_mode="layout", layout_mode_space_vertically=True) + "\n"
-                except:
-                    # Fallback para o método padrão
-                    texto_alternativo += page.extract_text() + "\n"
-        
-        # Se conseguiu extrair texto com técnicas alternativas, retorna
-        if texto_alternativo.strip():
-            return texto_alternativo
-        
-        # Se ainda não conseguiu extrair texto, tenta extrair metadados
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
+            # Método principal: PyPDF2 com configurações padrão
+            texto_total = _juntar_paginas(reader, False, parar_quando, textos_paginas)
+            if texto_total.strip():
+                return texto_total
+            
+            # Se não conseguiu extrair texto, tenta extrair com diferentes parâmetros
+            if textos_paginas is not None:
+                textos_paginas.clear()
+            texto_alternativo = _juntar_paginas(reader, True, parar_quando, textos_paginas)
+            if texto_alternativo.strip():
+                return texto_alternativo
+            
+            # Nenhuma página tem texto: as páginas serão reconhecidas por OCR
+            if textos_paginas is not None:
+                return ""
+            
+            # Se ainda não conseguiu extrair texto, tenta extrair metadados
             metadados = reader.metadata
             if metadados:
                 texto_metadados = f"Título: {metadados.title or 'N/A'}\n"
@@ -84,529 +308,755 @@ def extrair_texto_pdf(pdf_path):
         # Se nenhuma técnica funcionou, retorna string vazia
         return ""
     except Exception as e:
-        print(f"Erro ao extrair texto com PyPDF2: {e}")
+        logger.error("Erro ao extrair texto com PyPDF2: %s", e)
         return ""
 
-def extrair_dados(texto, nome_arquivo=""):
+def extrair_dados(texto, nome_arquivo="", layout=None):
     """
     Extrai dados específicos do texto do PDF usando expressões regulares.
     Otimizado para lidar com múltiplos formatos de PDF do SISREG III.
     
     Args:
         texto: Texto extraído do PDF
-        nome_arquivo: Nome do arquivo para debug (opcional)
+        nome_arquivo: Nome do arquivo usado no log (opcional)
+        layout: Layout já identificado (ver extrator_sisreg.classificar_layout), opcional
         
     Returns:
         Dicionário com os dados extraídos (nunca retorna None)
     """
-    import re
-    import os
-    from cidades_paraiba import CidadesParaiba
-
     # Inicializar o dicionário de dados com valores padrão
-    dados = {
-        "codigo_solicitacao": "NÃO ENCONTRADO",
-        "cns": "NÃO ENCONTRADO",
-        "unidade_solicitante": "NÃO ENCONTRADO", 
-        "unidade_executante": "NÃO ENCONTRADO",
-        "data_exame": "NÃO ENCONTRADO",
-        "procedimento": "NÃO ENCONTRADO"
-    }
-
-    print("\n" + "="*50)
-    print(f"CONTEÚDO COMPLETO DO PDF: {nome_arquivo}")
-    print("="*50)
-    print(texto)
-    print("="*50 + "\n")
+    dados = campos_vazios()
 
     try:
-        # Salvar o texto para debug
-        if nome_arquivo:
-            debug_file = f"texto_extraido_{os.path.basename(nome_arquivo)}.txt"
-            with open(debug_file, "w", encoding="utf-8") as f:
-                f.write(texto)
-
-        # Extrair CNS - procurar especificamente por padrões de CNS
-        cns_patterns = [
-            r'CNS\s*:?\s*(\d{15})',  # CNS com 15 dígitos após "CNS:"
-            r'CNS\s*:?\s*(\d+)',     # Qualquer número após "CNS:"
-            r'DADOS\s+DO\s+PACIENTE[\s\S]*?CNS\s*:?\s*(\d+)',  # CNS na seção de dados do paciente
-            r'Apelido\s*:?\s*(\d{15})'
-        ]
-        
-        cns_encontrado = False
-        for pattern in cns_patterns:
-            match = re.search(pattern, texto, re.IGNORECASE)
-            if match:
-                dados["cns"] = match.group(1).strip()
-                cns_encontrado = True
-                break
-        
-        if not cns_encontrado:
-            # Procurar por números de 15 dígitos (formato típico do CNS)
-            match = re.search(r'\b(\d{15})\b', texto)
-            if match:
-                dados["cns"] = match.group(1).strip()
-        
-        # Extrair código de solicitação
-        codigo_patterns = [
-            # NOVOS PADRÕES: Código seguido imediatamente por data
-            # Busca por "Vaga Solicitada:Vaga Consumida:" seguido por código de 9 dígitos começando com 5 e data
-            r'Código da Solicitação:\s*Situação Atual:\s*(5\d{8})',
-            
-            # Busca por "Consumida:" seguido por código de 9 dígitos começando com 5 e data
-            r'Consumida\s*:\s*(5\d{8})(\d{2}/\d{2}/\d{4})',
-            
-            # Busca por qualquer ":" seguido por código de 9 dígitos começando com 5 e data
-            r':\s*(5\d{8})(\d{2}/\d{2}/\d{4})',
-            
-            # Busca genérica por código de 9 dígitos começando com 5 seguido por data
-            r'\b(5\d{8})(\d{2}/\d{2}/\d{4})\b',
-            
-            # PADRÕES ANTERIORES: Código que começa com 5
-            # Busca por "Código da Solicitação" e depois procura por um número de 9 dígitos que começa com 5
-            r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?[\s\S]{0,100}?(5\d{8})\b',
-            
-            # Busca por "Código da Solicitação:" seguido de número que começa com 5
-            r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?\s*(5\d+)',
-            
-            # Busca por número de 9 dígitos que começa com 5 após "Vaga Solicitada" e "Vaga Consumida"
-            r'Vaga\s+Solicitada\s*:?\s*Vaga\s+Consumida\s*:?[\s\S]{0,100}?(5\d{8})\b',
-            
-            # Busca por número de 9 dígitos que começa com 5 após "1ª Vez"
-            r'1[ªa]\s+Vez[\s\S]{0,50}?(5\d{8})\b',
-            
-            # Busca por número de 9 dígitos que começa com 5 isolado no início de uma linha
-            r'^\s*(5\d{8})\s*$',
-            
-            # Busca por número de 9 dígitos que começa com 5 em qualquer lugar
-            r'\b(5\d{8})\b',
+        # Executar as cascatas pré-compiladas de cada campo (ver extrator_sisreg.py),
+        # registrando a duração de cada cascata e o padrão que encontrou cada campo
+        extrair_campos(texto, dados, medir=True, layout=layout)
 
-            # Busca por número de 9 dígitos que começa com 5 após "Situação Atual"
-            r'Situação+Atual*:?[\s\S]{0,100}?(5\d{8})\b',
-            
-            # PADRÕES DE FALLBACK: Menos específicos
-            r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?[\s\S]{0,100}?(\d{9})\b',
-            r'C[óo]digo\s*d[ae]\s*Solicita[çc][ãa]o\s*:?\s*(\d+)',
-            r'Vaga\s+Solicitada\s*:?\s*Vaga\s+Consumida\s*:?[\s\S]{0,100}?(\d{9})\b',
-            r'1[ªa]\s+Vez[\s\S]{0,50}?(\d{9})\b',
-            r'^\s*(\d{9})\s*$',
-            r'\b(\d{9})\b'
-        ]
-        
-        # Tentar cada padrão para o código de solicitação
-        codigo_encontrado = False
-        for pattern in codigo_patterns:
-            match = re.search(pattern, texto, re.IGNORECASE | re.MULTILINE)
-            if match:
-                codigo = match.group(1).strip()
-                
-                # Validação para garantir que o código:
-                # 1. Tenha exatamente 9 dígitos
-                # 2. Comece com o dígito 5 (se possível)
-                # 3. Não seja igual ao CNS
-                if (len(codigo) == 9 and 
-                    codigo != dados.get("cns", "") and 
-                    (codigo.startswith('5') or (not codigo_encontrado and not '5' in pattern))):
-                    
-                    # Se encontramos um código que começa com 5, usamos ele
-                    # Se não, só aceitamos códigos que não começam com 5 se não tivermos encontrado nenhum outro
-                    if codigo.startswith('5') or not codigo_encontrado:
-                        dados["codigo_solicitacao"] = codigo
-                        codigo_encontrado = True
-                        
-                        # Se encontramos um código que começa com 5, paramos a busca
-                        if codigo.startswith('5'):
-                            break
-        
-        # Extrair unidade executante e data do exame
-        outros_padroes = {
-            # Novo padrão para unidade_executante
-            "unidade_executante": r'UNIDADE\s*EXECUTANTE[\s\S]*?Nome\s*:\s*([A-Z\sÀ-ÖØ-öø-ÿ]+?)(?:\s*Endereço|\s*C[óo]d\.\s*CNES|\s*Número|\s*Telefone|\s*Op\.\s*Autorizador|\s*Vaga\s*Consumida|$)',
-            "data_exame": r'Data\s*e\s*Hor[áa]rio\s*de\s*Atendimento\s*:?\s*([^\r\n]+)',
-        }
-        
-        # Aplicar cada padrão e armazenar os resultados
-        for campo, padrao in outros_padroes.items():
-            match = re.search(padrao, texto, re.IGNORECASE)
-            if match:
-                dados[campo] = match.group(1).strip()
+        # Campos extraídos para a planilha (apenas com LOG_NIVEL=DEBUG)
+        logger.debug("Campos extraídos de %s: %s", nome_arquivo, dados)
+    
+        return dados
         
+    except Exception as e:
+        logger.exception("Erro ao extrair dados de %s: %s", nome_arquivo, e)
+        # Retornar o dicionário com valores padrão em caso de erro
+        return dados
+
+def _extrair_pdf(pdf, nome_arquivo=None, capturar_texto=False):
+    """
+    Extrai os dados de um único arquivo PDF, sem consultar o cache.
+    
+    Args:
+        pdf: Caminho, bytes ou objeto de arquivo binário do PDF
+        nome_arquivo: Nome do arquivo (opcional quando `pdf` é um caminho)
+        capturar_texto: Se True, devolve também o texto completo (ver diagnostico.CapturaTexto)
         
-        # FUNÇÃO CORRIGIDA: Limpar unidade executante preservando o nome "HOSPITAL"
-        def limpar_unidade_executante(texto):
-            if not texto or texto == "NÃO ENCONTRADO":
-                return texto
-            
-            # 1. Encontrar o primeiro dígito no texto
-            # Se um dígito for encontrado, desconsiderar tudo a partir dele.
-            # Isso é baseado na premissa de que nomes de unidades executantes não contêm números.
-            match_digito = re.search(r'\d', texto)
-            if match_digito:
-                texto = texto[:match_digito.start()]
-            
-            # 2. Remover qualquer caractere que não seja letra, espaço ou hífen.
-            # Isso limpa pontuações, símbolos e outros caracteres especiais que possam ter sobrado.
-            # Mantemos o hífen pois pode aparecer em nomes (ex: "Hospital São José-Maria").
-            # O flag re.UNICODE é importante para lidar corretamente com caracteres acentuados.
-            texto = re.sub(r'[^\w\sÀ-ÖØ-öø-ÿ-]', '', texto, flags=re.UNICODE)
-            
-            # 3. Normalizar espaços: substituir múltiplos espaços por um único e remover espaços nas extremidades.
-            texto = re.sub(r'\s+', ' ', texto).strip()
-            
-            # 4. Validação final: garantir que o resultado seja um nome válido.
-            # Se o texto resultante for muito curto ou não contiver nenhuma letra,
-            # consideramos que a extração falhou e retornamos "NÃO ENCONTRADO".
-            if len(texto) < 3 or not re.search(r'[A-ZÀ-ÖØ-öø-ÿ]', texto, flags=re.IGNORECASE):
-                return "NÃO ENCONTRADO"
-                
-            return texto
+    Returns:
+        Tupla (dados, texto): dicionário com os dados extraídos ou com a chave "erro",
+        e o texto do PDF (None se `capturar_texto` for False). Se houver páginas sem
+        camada de texto para o OCR, `dados` é um OcrPendente: o OCR não ocupa o processo
+        de extração e é concluído pelo processo da requisição com `_concluir_ocr`
+    """
+    nome_arquivo = nome_pdf(pdf, nome_arquivo)
+    inicio = time.perf_counter()
+    try:
+        # Extrair texto do PDF, parando de ler páginas quando todos os campos forem encontrados
+        # ou quando a primeira página já mostrar que o PDF não é do SISREG III
+        # O fallback de metadados não é usado: uma guia digitalizada sem OCR não tem os
+        # rótulos do SISREG e seria recusada como outro documento em vez de "sem texto"
+        textos_paginas = []
+        texto = extrair_texto_pdf(pdf, parar_quando=LeituraPaginas, textos_paginas=textos_paginas)
         
-        # Aplicar limpeza à unidade executante
-        dados["unidade_executante"] = limpar_unidade_executante(dados["unidade_executante"])
+        # Páginas sem camada de texto (guias digitalizadas) passam pelo OCR, se disponível
+        paginas = _paginas_para_ocr(texto, textos_paginas) if motor_ocr.disponivel() else []
+        if paginas:
+            return OcrPendente(textos_paginas, paginas), None
         
-        # CORREÇÃO: Verificar se a unidade executante é "NÃO ENCONTRADO" ou está vazia
-        if dados["unidade_executante"] == "NÃO ENCONTRADO" or not dados["unidade_executante"]:
-            # Tentar padrões alternativos para unidade executante
-            patterns = [
-                # Busca por HOSPITAL seguido de texto
-                r'HOSPITAL\s+([^\r\n:]+)',
-                
-                # Busca por nome após "UNIDADE EXECUTANTE" e "Nome:"
-                r'UNIDADE\s*EXECUTANTE[\s\S]*?Nome\s*:\s*([A-Z][A-Z\s]+)',
-                
-                # Busca por nome após "EXECUTANTE" e "Nome:"
-                r'EXECUTANTE[\s\S]*?Nome\s*:\s*([A-Z][A-Z\s]+)',
-                
-                # Busca por nome entre "Nome:" e "Endereço:"
-                r'Nome\s*:\s*([A-Z][A-Z\s]+)(?:[\s\S]*?Endere[çc]o\s*:)',
-                
-                # Busca por nome após "UNIDADE EXECUTANTE"
-                r'UNIDADE\s*EXECUTANTE[\s\S]*?([A-Z][A-Z\s]+(?:HOSPITAL|CLÍNICA|CENTRO|INSTITUTO)[^\r\n:]+)'
-            ]
-            
-            for pattern in patterns:
-                match = re.search(pattern, texto, re.IGNORECASE)
-                if match:
-                    # CORREÇÃO: Capturar o texto completo para preservar "HOSPITAL"
-                    if "HOSPITAL" in pattern:
-                        resultado = "HOSPITAL " + match.group(1).strip()
-                    else:
-                        resultado = match.group(1).strip()
-                    
-                    # Limpar o resultado para remover números e a palavra "CNES"
-                    resultado = limpar_unidade_executante(resultado)
-                    if resultado and resultado != "NÃO ENCONTRADO":
-                        dados["unidade_executante"] = resultado
-                        break
-            
-            # NOVA CORREÇÃO: Buscar diretamente por padrões de hospital no texto
-            if dados["unidade_executante"] == "NÃO ENCONTRADO" or not dados["unidade_executante"]:
-                hospital_patterns = [
-                    r'HOSPITAL\s+([A-ZÀ-Úa-zà-ú\s]+)',
-                    r'HOSPITAL\s+DE\s+([A-ZÀ-Úa-zà-ú\s]+)',
-                    r'HOSPITAL\s+([A-ZÀ-Úa-zà-ú\s]+)(?:[\s\S]*?Endere[çc]o\s*:)'
-                ]
-                
-                for pattern in hospital_patterns:
-                    match = re.search(pattern, texto, re.IGNORECASE)
-                    if match:
-                        # Capturar o texto completo incluindo "HOSPITAL"
-                        inicio = match.start()
-                        fim = match.end()
-                        hospital_completo = texto[inicio:fim].strip()
-                        
-                        # Limpar o resultado
-                        hospital_completo = limpar_unidade_executante(hospital_completo)
-                        if hospital_completo and hospital_completo != "NÃO ENCONTRADO":
-                            dados["unidade_executante"] = hospital_completo
-                            break
-                        
-        # Abordagens alternativas para data do exame
-        if dados["data_exame"] == "NÃO ENCONTRADO":
-            patterns = [            
-                # Busca por padrão de data e hora
-                r'(\d{2}/\d{2}/\d{4}\s*\d{2}:\d{2})',
-                
-                # Busca por data após "Data de Atendimento:"
-                r'Data\s*de\s*Atendimento\s*:?\s*([^\r\n]+)'
-            ]
-            
-            for pattern in patterns:
-                match = re.search(pattern, texto, re.IGNORECASE)
-                if match:
-                    data_encontrada = match.group(1).strip()
-                    dados["data_exame"] = data_encontrada
-                    break
+        return _extrair_dados_texto(texto, nome_arquivo, capturar_texto)
         
-        # Pós-processamento para garantir formato correto da data
-        if dados["data_exame"] != "NÃO ENCONTRADO":
-            # Verificar se a data está no formato DD/MM/AAAA
-            data_match = re.match(r'(\d{2}/\d{2}/\d{4})', dados["data_exame"])
-            if data_match:
-                dados["data_exame"] = data_match.group(1)
-            else:
-                # Tentar extrair qualquer data no formato DD/MM/AAAA do texto encontrado
-                data_match = re.search(r'(\d{2}/\d{2}/\d{4})', dados["data_exame"])
-                if data_match:
-                    dados["data_exame"] = data_match.group(1)
-
-
-        # Extrair e limpar procedimento
-        procedimento_bruto = "NÃO ENCONTRADO"
-        pattern = r'Procedimentos\s*Autorizados\s*:?[\s\S]*?([^\r\n]+?)(?:\s{2,}|\r|\n)'
-        match = re.search(pattern, texto, re.IGNORECASE)
-        if match:
-            procedimento_bruto = match.group(1).strip()
-            
-        # Limpar procedimento
-        def limpar_procedimento(texto):
-            if not texto or texto == "NÃO ENCONTRADO":
-                return texto
-                
-            # Verificar se o texto contém "CONSULTA EM" e extrair o procedimento completo
-            consulta_match = re.search(r'(CONSULTA\s+EM\s+[A-ZÀ-Úa-zà-ú\s\-]+)', texto, flags=re.IGNORECASE)
-            if consulta_match:
-                return consulta_match.group(1).strip()
-                
-            # Verificar outros tipos de procedimentos
-            outros_procedimentos = [
-                r'(TOMOGRAFIA\s+[A-ZÀ-Úa-zà-ú\s\-]+)',
-                r'(RESSONANCIA\s+[A-ZÀ-Úa-zà-ú\s\-]+)',
-                r'(EXAME\s+[A-ZÀ-Úa-zà-ú\s\-]+)'
-            ]
-            
-            for pattern in outros_procedimentos:
-                match = re.search(pattern, texto, flags=re.IGNORECASE)
-                if match:
-                    return match.group(1).strip()
-            
-            # Remover "Cod. Unificado:", "Cod. Interno:" e variações
-            texto = re.sub(r'Cod\.\s*Unificado\s*:?', '', texto, flags=re.IGNORECASE)
-            texto = re.sub(r'Cod\.\s*Interno\s*:?', '', texto, flags=re.IGNORECASE)
-            
-            # Extrair apenas palavras e hífens (sem números)
-            palavras = re.findall(r'[A-ZÀ-Úa-zà-ú\s\-]+', texto)
-            texto = ' '.join(palavras)
-            
-            # Normalizar espaços e remover espaços extras
-            texto = re.sub(r'\s+', ' ', texto).strip()
-            
-            # Se o resultado for muito curto (menos de 3 caracteres), considerar como não encontrado
-            if len(texto) < 3:
-                return "NÃO ENCONTRADO"
-                
-            return texto
+    except MemoryError:
+        # Tratada pelo processo isolado, que é descartado (ver isolamento.py)
+        raise
+    except Exception as e:
+        logger.exception("Erro ao processar o PDF %s", nome_arquivo)
+        metricas.incrementar("sisreg_documentos_total", resultado="erro")
+        return {"erro": str(e), "arquivo": nome_arquivo}, None
+    finally:
+        metricas.observar("sisreg_pdf_segundos", time.perf_counter() - inicio, etapa="documento")
 
+def _paginas_para_ocr(texto, textos_paginas):
+    """
+    Escolhe as páginas a reconhecer: todas as páginas sem texto quando o PDF não tem
+    texto nenhum, ou quando o texto das demais páginas não tem todos os campos
+    """
+    paginas_sem_texto = [num_pagina for num_pagina, texto_pagina in enumerate(textos_paginas, 1)
+                         if not texto_pagina.strip()]
+    if not paginas_sem_texto:
+        return []
+    if texto.strip() and parar_leitura(texto):
+        return []
+    return paginas_sem_texto
+
+def _extrair_dados_texto(texto, nome_arquivo, capturar_texto=False):
+    """
+    Identifica o layout e extrai os campos do texto completo de um PDF
+    
+    Returns:
+        Tupla (dados, texto) no formato de `_extrair_pdf`
+    """
+    texto_capturado = texto if capturar_texto else None
+    
+    # Verificar se conseguiu extrair texto
+    if not texto.strip():
+        metricas.incrementar("sisreg_documentos_total", resultado="sem_texto")
+        return {"erro": f"Não foi possível extrair texto do PDF {nome_arquivo}", "arquivo": nome_arquivo}, texto_capturado
+    
+    # Identificar o layout pela assinatura do texto, antes da extração completa
+    assinatura = assinatura_layout(texto)
+    layout = classificar_layout(assinatura)
+    if layout is None:
+        metricas.incrementar("sisreg_documentos_total", resultado="nao_sisreg")
+        logger.warning("PDF %s recusado: não tem os rótulos de um documento do SISREG III", nome_arquivo)
+        return {"erro": f"O PDF {nome_arquivo} não parece ser um documento do SISREG III",
+                "arquivo": nome_arquivo}, texto_capturado
+    metricas.incrementar("sisreg_layout_total", layout=layout.nome)
+    if layout is LAYOUT_DESCONHECIDO:
+        # Extraído com a cascata completa; a assinatura fica no log para catalogar o layout
+        ordem, marcadores = assinatura
+        logger.warning("Layout desconhecido em %s (rótulos: %s; marcadores: %s)",
+                       nome_arquivo, ", ".join(ordem), ", ".join(marcadores) or "nenhum")
+    
+    # Extrair dados do texto
+    dados = extrair_dados(texto, nome_arquivo, layout)
+    
+    # Adicionar o nome do arquivo aos dados
+    dados["arquivo"] = nome_arquivo
+    
+    metricas.incrementar("sisreg_documentos_total", resultado="sucesso")
+    return dados, texto_capturado
+
+def _concluir_ocr(futuro, pendente, nome_arquivo, capturar_texto):
+    """
+    Conclui, no processo da requisição, a extração adiada por um processo do pool
+    
+    O texto reconhecido volta para a posição da sua página: a busca dos rótulos depende
+    da ordem das seções do documento.
+    
+    Args:
+        futuro: Future de `motor_ocr.submeter` com o texto reconhecido de cada página
+        pendente: OcrPendente devolvido por `_extrair_pdf`
         
-        # Aplicar a função de limpeza ao procedimento bruto
-        dados["procedimento"] = limpar_procedimento(procedimento_bruto)
-        
-        # Se ainda não encontrou o procedimento, tentar padrões alternativos
-        if dados["procedimento"] == "NÃO ENCONTRADO":
-            patterns = [
-                # Busca por CONSULTA EM seguido de texto
-                r'CONSULTA\s+EM\s+([A-ZÀ-Úa-zà-ú\s\-]+)',
-                
-                # Busca por TOMOGRAFIA seguido de texto
-                r'TOMOGRAFIA\s+([A-ZÀ-Úa-zà-ú\s\-]+)',
-                
-                # Busca por EXAME seguido de texto
-                r'EXAME\s+([A-ZÀ-Úa-zà-ú\s\-]+)'
-            ]
-            
-            for pattern in patterns:
-                match = re.search(pattern, texto, re.IGNORECASE)
-                if match:
-                    # Capturar o texto completo, não apenas o grupo
-                    inicio = match.start()
-                    fim = match.end()
-                    procedimento_completo = texto[inicio:fim].strip()
-                    dados["procedimento"] = procedimento_completo
-                    break
-                
-                 # NOVO TRECHO: Pegar Município de Residência e colocar como Unidade Solicitante
-                 # NOVO TRECHO: Pegar Município de Residência e colocar como Unidade Solicitante
-        try:
-            municipio_residencia = "" 
-            
-            # Padrão principal: Captura o texto após "Município de Residência:"
-            # (mantido o padrão que funcionou para o caso anterior)
-            padrao_municipio = r'Município\s*(?:de)?\s*Resid[êe]ncia\s*:\s*([^\r\n]+?)(?:\s*\d{5}-\d{3}|\s*Telefone\(s\):|\s*Laudo\s*/\s*Justificativa:|\s*DADOS\s*DA\s*SOLICITA[ÇC][ÃA]O|$)'
-            
-            match = re.search(padrao_municipio, texto, re.IGNORECASE)
-            if match:
-                municipio_residencia = match.group(1).strip()
-                
-                # REMOÇÃO DE "BRASILEIRA": Adicione esta linha
-                municipio_residencia = re.sub(r'BRASILEIRA\s*', '', municipio_residencia, flags=re.IGNORECASE).strip()
-                
-                # Remover a palavra "BRASIL" (se ainda estiver presente por algum motivo)
-                municipio_residencia = re.sub(r'BRASIL\s*', '', municipio_residencia, flags=re.IGNORECASE).strip()
-                
-                # Remover "PB" se estiver grudado no final (ex: "JOAO PESSOA - PB")
-                municipio_residencia = re.sub(r'\s*-\s*PB\s*$', '', municipio_residencia, flags=re.IGNORECASE).strip()
-                
-                # Normalizar espaços após as remoções
-                municipio_residencia = re.sub(r'\s+', ' ', municipio_residencia).strip()
-
-            # Se o primeiro padrão não encontrar, tentar o padrão de fallback
-            if not municipio_residencia: 
-                trecho_pos_municipio = re.search(r'Município\s*de\s*Residência\s*:?(.*?)(?:\d{5}-\d{3}|Telefone\(s\):)', texto, re.IGNORECASE)
-                if trecho_pos_municipio:
-                    trecho = trecho_pos_municipio.group(1)
-                    municipio = re.search(r'([A-ZÀ-Úa-zà-ú\s]+(?:\s*-\s*[A-Z]{2})?)', trecho)
-                    if municipio:
-                        municipio_residencia = municipio.group(1).strip()
-                        # Aplicar as mesmas limpezas ao resultado do fallback
-                        municipio_residencia = re.sub(r'BRASILEIRA\s*', '', municipio_residencia, flags=re.IGNORECASE).strip() # Adicionar aqui também
-                        municipio_residencia = re.sub(r'BRASIL\s*', '', municipio_residencia, flags=re.IGNORECASE).strip()
-                        municipio_residencia = re.sub(r'\s*-\s*PB\s*$', '', municipio_residencia, flags=re.IGNORECASE).strip()
-                        municipio_residencia = re.sub(r'\s+', ' ', municipio_residencia).strip()
-            
-            # Depois de encontrar e limpar o municipio_residencia no texto:
-            # Validar o município usando CidadesParaiba.validar_municipio
-            municipio_validado = CidadesParaiba.validar_municipio(municipio_residencia)
+    Returns:
+        Tupla (dados, texto) no formato de `_extrair_pdf`
+    """
+    try:
+        textos_paginas = list(pendente.textos_paginas)
+        for pagina, texto_pagina in futuro.result().items():
+            textos_paginas[pagina - 1] = texto_pagina
+        texto = "".join(texto_pagina + "\n" for texto_pagina in textos_paginas)
+        return _extrair_dados_texto(texto, nome_arquivo, capturar_texto)
+    except Exception as e:
+        logger.exception("Erro no OCR do PDF %s", nome_arquivo)
+        metricas.incrementar("sisreg_documentos_total", resultado="erro")
+        return {"erro": str(e), "arquivo": nome_arquivo}, None
+
+def _extrair_pdf_em_processo(pdf, nome_arquivo=None, capturar_texto=False):
+    """
+    Executa `_extrair_pdf` em um processo do pool
+    
+    Returns:
+        Tupla ((dados, texto), metricas): resultado de `_extrair_pdf` e as métricas
+        registradas durante a extração, somadas pelo processo da requisição
+    """
+    return _extrair_pdf(pdf, nome_arquivo, capturar_texto), metricas.extrair_e_zerar()
+
+def _chave_cache(pdf):
+    """Calcula a chave do cache a partir do conteúdo do PDF (None se não for possível lê-lo)"""
+    try:
+        return CacheResultados.chave(ler_bytes_pdf(pdf))
+    except OSError:
+        return None
+
+def obter_pool():
+    """
+    Retorna o pool de processos isolados do processo atual, criando-o na primeira chamada.
+    
+    O pool é reutilizado entre requisições. Cada worker do gunicorn cria o seu
+    próprio pool após o fork, por isso o PID de quem criou o pool é verificado.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        # Verificado antes do fork, para que os processos isolados herdem a resposta
+        motor_ocr.disponivel()
+        _pool = PoolIsolado(app.config['MAX_PROCESSOS'], app.config['EXTRACAO_TIMEOUT'],
+                            app.config['EXTRACAO_MEMORIA_MB'])
+        _pool_pid = os.getpid()
+    return _pool
+
+def _extrair_pdfs_em_andamento(pdfs, nomes_arquivos, capturas):
+    """
+    Executa `_extrair_pdf` em paralelo usando o pool de processos isolados.
+    
+    Um PDF que excede o tempo ou a memória, ou derruba o processo que o lia, termina com
+    erro; os demais PDFs do lote continuam normalmente.
+    
+    Yields:
+        Tuplas (indice, (dados, texto)) na ordem em que cada PDF termina
+    """
+    # Objetos de arquivo não podem ser enviados a outro processo: enviar o conteúdo
+    pdfs = [pdf if isinstance(pdf, (bytes, str, os.PathLike)) else ler_bytes_pdf(pdf) for pdf in pdfs]
+    pool = obter_pool()
+    futuros = {pool.submit(_extrair_pdf_em_processo, pdf, nome, capturar): indice
+               for indice, (pdf, nome, capturar) in enumerate(zip(pdfs, nomes_arquivos, capturas))}
+    # PDFs digitalizados voltam do pool como OcrPendente e seguem para o pool de OCR,
+    # sem ocupar um processo de extração enquanto esperam
+    futuros_ocr = {}
+    em_andamento = set(futuros)
+    while em_andamento:
+        concluidos, em_andamento = wait(em_andamento, return_when=FIRST_COMPLETED)
+        for futuro in concluidos:
+            if futuro in futuros_ocr:
+                indice, pendente = futuros_ocr.pop(futuro)
+                resultado = _concluir_ocr(futuro, pendente, nomes_arquivos[indice], capturas[indice])
+                yield indice, resultado
+                continue
             
-            # Atribui o valor validado ou "NÃO ENCONTRADO" se a validação falhar
-            dados["unidade_solicitante"] = municipio_validado if municipio_validado else "NÃO ENCONTRADO"
+            indice = futuros[futuro]
+            try:
+                resultado, metricas_processo = futuro.result()
+            except Exception as e:
+                # FalhaIsolamento: o processo foi descartado e será substituído no próximo PDF
+                nome = nome_pdf(pdfs[indice], nomes_arquivos[indice])
+                if not isinstance(e, FalhaIsolamento):
+                    logger.error("Erro ao processar o PDF %s no processo isolado: %s", nome, e)
+                metricas.incrementar("sisreg_documentos_total", resultado="erro")
+                yield indice, ({"erro": f"{e}: {nome}", "arquivo": nome}, None)
+                continue
+            metricas.mesclar(metricas_processo)
+            pendente = resultado[0]
+            if isinstance(pendente, OcrPendente):
+                futuro_ocr = motor_ocr.submeter(ler_bytes_pdf(pdfs[indice]), pendente.paginas)
+                futuros_ocr[futuro_ocr] = (indice, pendente)
+                em_andamento.add(futuro_ocr)
+                continue
+            yield indice, resultado
 
-        except Exception as e:
-            print(f"Erro ao extrair município para unidade solicitante: {str(e)}")
-            dados["unidade_solicitante"] = "NÃO ENCONTRADO"
+def processar_pdfs_em_andamento(pdfs, nomes_arquivos=None):
+    """
+    Processa vários arquivos PDF, consultando o cache de resultados e enviando
+    apenas os arquivos ainda não processados para o pool de processos.
+    
+    Args:
+        pdfs: Lista de PDFs (caminhos, bytes ou objetos de arquivo binário)
+        nomes_arquivos: Lista opcional com o nome de cada arquivo
+        
+    Yields:
+        Tuplas (posicao, resultado) assim que cada arquivo termina (primeiro os
+        encontrados no cache)
+    """
+    if nomes_arquivos is None:
+        nomes_arquivos = [None] * len(pdfs)
+    nomes_arquivos = [nome_pdf(pdf, nome) for pdf, nome in zip(pdfs, nomes_arquivos)]
+    
+    chaves = [_chave_cache(pdf) for pdf in pdfs]
+    pendentes = []
+    for posicao, chave in enumerate(chaves):
+        resultado = cache_pdfs.obter(chave) if chave else None
+        if resultado is None:
+            metricas.incrementar("sisreg_cache_total", resultado="falha")
+            pendentes.append(posicao)
+            continue
+        metricas.incrementar("sisreg_cache_total", resultado="acerto")
+        # O mesmo conteúdo pode ter sido enviado com outro nome
+        resultado["arquivo"] = nomes_arquivos[posicao]
+        yield posicao, resultado
+    
+    processados = _extrair_pdfs_em_andamento([pdfs[posicao] for posicao in pendentes],
+                                             [nomes_arquivos[posicao] for posicao in pendentes],
+                                             [captura_texto.deve_capturar() for _ in pendentes])
+    for indice, (resultado, texto) in processados:
+        posicao = pendentes[indice]
+        # Captura amostrada do texto completo, feita no processo da requisição
+        if texto is not None:
+            captura_texto.registrar(nomes_arquivos[posicao], texto, resultado)
+        # Erros não são guardados, para que uma falha transitória possa ser refeita
+        if chaves[posicao] and "erro" not in resultado:
+            cache_pdfs.guardar(chaves[posicao], resultado)
+        resultado["arquivo"] = nomes_arquivos[posicao]
+        if chaves[posicao] and "erro" not in resultado:
+            guardar_resultado(chaves[posicao], resultado)
+        yield posicao, resultado
 
+def guardar_resultado(chave, resultado):
+    """Grava o registro extraído na base local (falhas na gravação não interrompem a extração)"""
+    if base_resultados is None:
+        return
+    try:
+        # A chave do cache é "<versão do extrator>:<SHA-256 do conteúdo>"
+        base_resultados.guardar(chave.partition(':')[2], resultado)
+    except Exception:
+        logger.exception("Erro ao gravar o resultado de %s na base local", resultado.get("arquivo"))
 
-        # Mostrar os campos extraídos no console
-        print("\nCAMPOS EXTRAÍDOS PARA PLANILHA:")
-        print(f"Código de Solicitação: {dados['codigo_solicitacao']}")
-        print(f"CNS do Paciente: {dados['cns']}")
-        print(f"Unidade Executante: {dados['unidade_executante']}")
-        print(f"Unidade Solicitante: {dados['unidade_solicitante']}")
-        print(f"Data do Exame: {dados['data_exame']}")
-        print(f"Procedimento: {dados['procedimento']}")
-        print("\n")
+def processar_pdfs(pdfs, nomes_arquivos=None):
+    """
+    Processa vários arquivos PDF em paralelo (ver `processar_pdfs_em_andamento`).
     
-        return dados
+    Args:
+        pdfs: Lista de PDFs (caminhos, bytes ou objetos de arquivo binário)
+        nomes_arquivos: Lista opcional com o nome de cada arquivo
         
-    except Exception as e:
-        print(f"Erro ao extrair dados: {str(e)}")
-        # Retornar o dicionário com valores padrão em caso de erro
-        return dados
+    Returns:
+        Lista com os dados extraídos de cada arquivo, na mesma ordem
+    """
+    resultados = [None] * len(pdfs)
+    for posicao, resultado in processar_pdfs_em_andamento(pdfs, nomes_arquivos):
+        resultados[posicao] = resultado
+    return resultados
 
-def processar_pdf(pdf_path):
+def processar_pdf(pdf, nome_arquivo=None):
     """
     Processa um único arquivo PDF.
     
+    Se o mesmo conteúdo já tiver sido processado, retorna imediatamente o registro em cache.
+    
     Args:
-        pdf_path: Caminho para o arquivo PDF
+        pdf: Caminho, bytes ou objeto de arquivo binário do PDF
+        nome_arquivo: Nome do arquivo (opcional quando `pdf` é um caminho)
         
     Returns:
-        Dicionário com os dados extraídos ou None em caso de erro
+        Dicionário com os dados extraídos ou com a chave "erro"
     """
-    try:
-        nome_arquivo = os.path.basename(pdf_path)
-        
-        # Extrair texto do PDF
-        texto = extrair_texto_pdf(pdf_path)
-        
-        # Verificar se conseguiu extrair texto
-        if not texto.strip():
-            return {"erro": f"Não foi possível extrair texto do PDF {nome_arquivo}", "arquivo": nome_arquivo}
-        
-        # Extrair dados do texto
-        dados = extrair_dados(texto, nome_arquivo)
-        
-        # Adicionar o nome do arquivo aos dados
-        dados["arquivo"] = nome_arquivo
-        
-        return dados
+    return processar_pdfs([pdf], [nome_arquivo])[0]
+
+# Dependências importadas sob demanda pelas rotas, carregadas antecipadamente por `aquecer`
+MODULOS_PRECARREGADOS = ("PyPDF2", "openpyxl", "gspread", "gspread.utils", "google.oauth2.service_account")
+
+def aquecer():
+    """
+    Importa as dependências carregadas sob demanda (PyPDF2, openpyxl, gspread e
+    google-auth) e prepara o motor de extração (autômato de municípios e cascatas).
+    
+    Com PRECARREGAR_APP=1 é chamada uma única vez no processo mestre do gunicorn, antes
+    do fork (ver gunicorn.conf.py): os workers herdam tudo pronto e compartilham essas
+    páginas de memória com o mestre (copy-on-write).
+    """
+    for modulo in MODULOS_PRECARREGADOS:
+        importlib.import_module(modulo)
+    
+    CidadesParaiba.automato()
+    extrair_campos("")
+    logger.info("Aplicação pré-carregada no processo %s", os.getpid())
+
+# Jobs assíncronos: cada lote usa o cache e o pool de processos de processar_pdfs
+gerenciador_jobs = GerenciadorJobs(JOBS_DB, processar_pdfs, max_simultaneos=JOBS_SIMULTANEOS,
+                                   tamanho_lote=MAX_PROCESSOS, ttl=JOBS_TTL)
+
+def ler_upload(file, tamanho):
+    """
+    Lê um arquivo enviado pelo formulário sem gravá-lo na pasta de uploads.
+    
+    Arquivos de até MAX_UPLOAD_EM_MEMORIA bytes são mantidos em memória; os maiores
+    são gravados em um arquivo temporário exclusivo, que deve ser removido pelo chamador.
+    
+    Args:
+        file: FileStorage recebido pelo Flask
+        tamanho: Tamanho do arquivo em bytes
         
-    except Exception as e:
-        return {"erro": str(e), "arquivo": os.path.basename(pdf_path)}
+    Returns:
+        Tupla (pdf, caminho_temporario): bytes do PDF ou caminho do arquivo temporário,
+        e o caminho a ser removido (None quando o arquivo ficou em memória)
+    """
+    if tamanho <= app.config['MAX_UPLOAD_EM_MEMORIA']:
+        return file.read(), None
+    
+    fd, caminho_temporario = tempfile.mkstemp(suffix='.pdf')
+    with os.fdopen(fd, 'wb') as destino:
+        file.save(destino)
+    return caminho_temporario, caminho_temporario
+
+@app.before_request
+def iniciar_cronometro():
+    g.inicio_requisicao = time.perf_counter()
+
+@app.before_request
+def retomar_caixa_saida():
+    # Envios pendentes de execuções anteriores (ou de um worker reciclado) são retomados
+    # pelo remetente do primeiro worker que receber uma requisição
+    if os.path.exists(app.config['CAIXA_SAIDA_DB']):
+        caixa_saida.garantir_remetente()
+
+@app.after_request
+def registrar_requisicao(response):
+    """Registra a duração e o status da requisição e grava periodicamente as métricas do worker"""
+    inicio = g.pop('inicio_requisicao', None)
+    # Rotas inexistentes ficam agrupadas, para não criar uma série por URL
+    rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+    metricas.incrementar("sisreg_requisicoes_total", rota=rota, status=str(response.status_code))
+    if inicio is not None:
+        metricas.observar("sisreg_requisicao_segundos", time.perf_counter() - inicio, rota=rota)
+    metricas.gravar_periodicamente()
+    return response
 
 @app.route('/')
 def index():
     """Rota principal que renderiza a página de upload"""
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
+def obter_arquivos_enviados(limite):
     """
-    Rota para processar o upload de arquivos PDF
+    Obtém a lista de arquivos do campo "files[]" da requisição
     
-    Recebe arquivos PDF via formulário, processa-os e retorna os dados extraídos
+    Args:
+        limite: Número máximo de arquivos aceitos
+        
+    Returns:
+        Tupla (files, erro): lista de FileStorage e a resposta de erro (400) quando a
+        requisição não puder ser processada
     """
     # Verificar se a requisição contém arquivos
     if 'files[]' not in request.files:
-        return jsonify({"erro": "Nenhum arquivo enviado"}), 400
+        return None, (jsonify({"erro": "Nenhum arquivo enviado"}), 400)
     
     files = request.files.getlist('files[]')
     
     # Verificar se há arquivos
     if not files or files[0].filename == '':
-        return jsonify({"erro": "Nenhum arquivo selecionado"}), 400
+        return None, (jsonify({"erro": "Nenhum arquivo selecionado"}), 400)
     
     # Verificar o número de arquivos
-    if len(files) > MAX_FILES:
-        return jsonify({"erro": f"Número máximo de arquivos excedido. Limite: {MAX_FILES}"}), 400
-    
-    # Processar cada arquivo
-    resultados = []
-    sucessos = 0
-    falhas = 0
-    
-    for file in files:
-        # Verificar se é um arquivo permitido
-        if not allowed_file(file.filename):
-            resultados.append({"erro": f"Tipo de arquivo não permitido: {file.filename}", "arquivo": file.filename})
-            falhas += 1
-            continue
-        
-        # Verificar o tamanho do arquivo
-        file.seek(0, os.SEEK_END)
-        file_size = file.tell()
-        file.seek(0)
-        
-        if file_size > MAX_FILE_SIZE:
-            resultados.append({
-                "erro": f"Tamanho do arquivo excede o limite de {MAX_FILE_SIZE/1024/1024:.1f}MB: {file.filename}", 
-                "arquivo": file.filename
-            })
-            falhas += 1
-            continue
-        
-        # Salvar o arquivo
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        
-        # Processar o arquivo
-        resultado = processar_pdf(file_path)
-        
-        # Verificar se houve erro no processamento
-        if "erro" in resultado:
-            falhas += 1
-        else:
-            sucessos += 1
+    if len(files) > limite:
+        return None, (jsonify({"erro": f"Número máximo de arquivos excedido. Limite: {limite}"}), 400)
+    
+    return files, None
+
+def ler_arquivos_enviados(files):
+    """
+    Valida e lê cada arquivo enviado, guardando a posição dos que serão processados
+    
+    Returns:
+        Tupla (resultados, pendentes, temporarios): lista com os erros de validação
+        (None para os arquivos aceitos), tuplas (posicao, pdf, nome_arquivo) a processar
+        e os arquivos temporários a serem removidos pelo chamador
+    """
+    resultados = [None] * len(files)
+    pendentes = []
+    temporarios = []
+    
+    try:
+        for posicao, file in enumerate(files):
+            # Verificar a extensão e o tamanho do arquivo
+            erro, file_size = validar_arquivo(file)
+            if erro:
+                resultados[posicao] = erro
+                continue
+            
+            # Ler o arquivo em memória (ou em um arquivo temporário, se for muito grande)
+            pdf, caminho_temporario = ler_upload(file, file_size)
+            if caminho_temporario:
+                temporarios.append(caminho_temporario)
+            pendentes.append((posicao, pdf, secure_filename(file.filename)))
+    except Exception:
+        remover_temporarios(temporarios)
+        raise
+    return resultados, pendentes, temporarios
+
+def servidor_ocupado(erro):
+    """Resposta 503 para uma requisição recusada pela fila de extração"""
+    logger.warning("Requisição recusada (%s); nova tentativa sugerida em %ss", erro.motivo, erro.retry_after)
+    resposta = jsonify({
+        "erro": f"Servidor ocupado processando outros arquivos. Tente novamente em {erro.retry_after} segundos.",
+        "retry_after": erro.retry_after
+    })
+    resposta.status_code = 503
+    resposta.headers['Retry-After'] = str(erro.retry_after)
+    return resposta
+
+def remover_temporarios(temporarios):
+    for caminho_temporario in temporarios:
+        os.remove(caminho_temporario)
+
+def calcular_estatisticas(resultados, total):
+    """Retorna o bloco "estatisticas" das respostas a partir dos resultados já concluídos"""
+    falhas = sum(1 for resultado in resultados if resultado is not None and "erro" in resultado)
+    sucessos = sum(1 for resultado in resultados if resultado is not None) - falhas
+    return {
+        "total": total,
+        "sucessos": sucessos,
+        "falhas": falhas
+    }
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    """
+    Rota para processar o upload de arquivos PDF
+    
+    Recebe arquivos PDF via formulário, processa-os e retorna os dados extraídos.
+    Com a fila de extração cheia, responde 503 com Retry-After sem ler os arquivos.
+    """
+    try:
+        vaga = fila_extracao.admitir()
+    except FilaCheia as e:
+        return servidor_ocupado(e)
+    
+    with vaga:
+        files, erro = obter_arquivos_enviados(MAX_FILES)
+        if erro:
+            return erro
         
-        resultados.append(resultado)
+        resultados, pendentes, temporarios = ler_arquivos_enviados(files)
+        try:
+            # Processar os arquivos em paralelo, mantendo a ordem do upload
+            processados = processar_pdfs([pdf for _, pdf, _ in pendentes], [nome for _, _, nome in pendentes])
+        finally:
+            remover_temporarios(temporarios)
+    for (posicao, _, _), resultado in zip(pendentes, processados):
+        resultados[posicao] = resultado
     
     # Retornar os resultados
     return jsonify({
         "resultados": resultados,
-        "estatisticas": {
-            "total": len(files),
-            "sucessos": sucessos,
-            "falhas": falhas
-        }
+        "estatisticas": calcular_estatisticas(resultados, len(files))
     })
 
+@app.route('/upload/stream', methods=['POST'])
+def upload_stream():
+    """
+    Variante de /upload que envia o resultado de cada arquivo assim que ele termina
+    
+    A resposta é NDJSON (um objeto JSON por linha) ou, se o cliente enviar
+    "Accept: text/event-stream", Server-Sent Events. Cada arquivo gera um quadro
+    {"tipo": "resultado", "posicao": ..., "resultado": {...}} (na ordem em que termina,
+    com a posição no envio) e o último quadro é {"tipo": "estatisticas", "estatisticas": {...}}.
+    Com a fila de extração cheia, responde 503 com Retry-After, como /upload.
+    """
+    try:
+        vaga = fila_extracao.admitir()
+    except FilaCheia as e:
+        return servidor_ocupado(e)
+    
+    try:
+        files, erro = obter_arquivos_enviados(MAX_FILES)
+        if erro:
+            vaga.liberar()
+            return erro
+        
+        # Os arquivos são lidos antes de a resposta começar, enquanto a requisição está aberta
+        resultados, pendentes, temporarios = ler_arquivos_enviados(files)
+    except BaseException:
+        vaga.liberar()
+        raise
+    sse = request.accept_mimetypes.best == 'text/event-stream'
+    
+    def quadro(dados):
+        linha = json.dumps(dados, ensure_ascii=False)
+        if sse:
+            return f"event: {dados['tipo']}\ndata: {linha}\n\n"
+        return linha + "\n"
+    
+    def gerar():
+        try:
+            # Arquivos rejeitados na validação saem primeiro
+            for posicao, resultado in enumerate(resultados):
+                if resultado is not None:
+                    yield quadro({"tipo": "resultado", "posicao": posicao, "resultado": resultado})
+            
+            processados = processar_pdfs_em_andamento([pdf for _, pdf, _ in pendentes],
+                                                      [nome for _, _, nome in pendentes])
+            for indice, resultado in processados:
+                posicao = pendentes[indice][0]
+                resultados[posicao] = resultado
+                yield quadro({"tipo": "resultado", "posicao": posicao, "resultado": resultado})
+            
+            yield quadro({"tipo": "estatisticas", "estatisticas": calcular_estatisticas(resultados, len(files))})
+        finally:
+            remover_temporarios(temporarios)
+    
+    resposta = Response(gerar(), mimetype='text/event-stream' if sse else 'application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # A vaga é liberada quando a resposta termina (ou o cliente desconecta)
+    resposta.call_on_close(vaga.liberar)
+    return resposta
+
+@app.route('/jobs', methods=['POST'])
+def criar_job():
+    """
+    Rota para enviar um lote grande de arquivos PDF para processamento em segundo plano
+    
+    Recebe os arquivos como em /upload (campo "files[]"), grava-os em uma pasta
+    temporária e retorna imediatamente o ID do job (202)
+    """
+    files, erro = obter_arquivos_enviados(MAX_FILES_JOB)
+    if erro:
+        return erro
+    
+    resultados = [None] * len(files)
+    pendentes = []
+    pasta_temporaria = tempfile.mkdtemp(prefix='job_')
+    
+    try:
+        for posicao, file in enumerate(files):
+            erro, _ = validar_arquivo(file)
+            if erro:
+                resultados[posicao] = erro
+                continue
+            
+            # Os arquivos ficam em disco até o job terminar (a pasta é removida pelo job)
+            caminho = os.path.join(pasta_temporaria, f'{posicao:05d}.pdf')
+            file.save(caminho)
+            pendentes.append((posicao, caminho, secure_filename(file.filename)))
+        
+        job = gerenciador_jobs.submeter(resultados, pendentes, pasta_temporaria)
+    except Exception:
+        shutil.rmtree(pasta_temporaria, ignore_errors=True)
+        raise
+    
+    resumo = job.resumo()
+    resumo["url"] = url_for('consultar_job', id_job=job.id)
+    return jsonify(resumo), 202
+
+@app.route('/jobs/<id_job>', methods=['GET'])
+def consultar_job(id_job):
+    """
+    Rota que retorna o progresso e os resultados parciais de um job
+    
+    Os resultados seguem o formato `resultados`/`estatisticas` da rota /upload
+    """
+    job = gerenciador_jobs.obter(id_job)
+    resumo = job.resumo() if job is not None else None
+    if resumo is None:
+        return jsonify({"erro": f"Job não encontrado: {id_job}"}), 404
+    return jsonify(resumo)
+
+@app.route('/resultados', methods=['GET'])
+def consultar_resultados():
+    """
+    Rota de consulta aos registros já extraídos (base local, ver base_resultados.py)
+    
+    Parâmetros (todos opcionais): codigo_solicitacao, cns, unidade_solicitante e
+    unidade_executante (igualdade), data_inicio e data_fim (DD/MM/AAAA, inclusivas),
+    limite, deslocamento e formato=csv para baixar o resultado em CSV
+    """
+    if base_resultados is None:
+        return jsonify({"erro": "Base de resultados desativada (RESULTADOS_DB vazio)"}), 404
+    filtros = {campo: request.args[campo] for campo in FILTROS_RESULTADOS if request.args.get(campo)}
+    data_inicio, data_fim = request.args.get('data_inicio'), request.args.get('data_fim')
+    try:
+        registros = base_resultados.buscar(filtros, data_inicio, data_fim,
+                                           limite=request.args.get('limite', 100, type=int),
+                                           deslocamento=request.args.get('deslocamento', 0, type=int))
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    
+    if request.args.get('formato') == 'csv':
+        return Response(gerar_csv(registros, colunas_exportacao(registros)), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=resultados.csv'})
+    # "total" conta todos os registros dos filtros; "quantidade", os desta página
+    return jsonify({"resultados": registros, "quantidade": len(registros),
+                    "total": base_resultados.contar(filtros, data_inicio, data_fim)})
+
+@app.route('/resultados/existentes', methods=['POST'])
+def resultados_existentes():
+    """
+    Rota que informa quais códigos de solicitação já foram processados
+    
+    Recebe {"codigos": [...]} e retorna {"existentes": {codigo: {"arquivo", "processado_em"}},
+    "novos": [...]}
+    """
+    if base_resultados is None:
+        return jsonify({"erro": "Base de resultados desativada (RESULTADOS_DB vazio)"}), 404
+    codigos = (request.get_json(silent=True) or {}).get('codigos', [])
+    if not isinstance(codigos, list):
+        return jsonify({"erro": "Envie os códigos como uma lista em \"codigos\""}), 400
+    existentes = base_resultados.existentes(str(codigo) for codigo in codigos)
+    return jsonify({"existentes": existentes,
+                    "novos": [codigo for codigo in codigos if str(codigo) not in existentes]})
+
+@app.route('/fila', methods=['GET'])
+def estado_fila():
+    """
+    Rota com a ocupação da fila de extração (ver admissao.py) e do pool de OCR
+    (ver ocr_paginas.py) deste worker
+    """
+    estado = fila_extracao.estado()
+    estado["ocr"] = motor_ocr.estado()
+    return jsonify(estado)
+
+@app.route('/cache', methods=['GET'])
+def estatisticas_cache():
+    """Rota que retorna os contadores de acertos/falhas do cache de resultados"""
+    return jsonify(cache_pdfs.estatisticas())
+
+@app.route('/metrics', methods=['GET'])
+def exportar_metricas():
+    """
+    Rota com as métricas no formato de texto do Prometheus, somadas entre todos os
+    workers do gunicorn (ver metricas.py)
+    """
+    return Response(metricas.agregar().prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/diagnostico/textos', methods=['GET'])
+def textos_capturados():
+    """
+    Rota que retorna os textos completos capturados por amostragem
+    
+    Aceita o parâmetro opcional "arquivo" para filtrar pelo nome do arquivo
+    """
+    return jsonify(captura_texto.listar(request.args.get('arquivo')))
+
+def colunas_exportacao(dados):
+    """Colunas dos arquivos exportados: todas as chaves dos registros, na ordem em que aparecem"""
+    colunas = {}
+    for dado in dados:
+        colunas.update(dict.fromkeys(dado))
+    return list(colunas)
+
+def gerar_csv(dados, colunas):
+    """
+    Gera o CSV linha a linha, sem montar o arquivo inteiro em memória
+    
+    Yields:
+        Trechos do CSV (o cabeçalho e depois um registro por vez)
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=colunas, restval='', extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    for dado in dados:
+        writer.writerow(dado)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Cabeçalho, quando não há registros
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gerar_excel(dados, colunas):
+    """
+    Gera a planilha Excel com o openpyxl em modo somente escrita (as linhas não ficam
+    guardadas como células em memória)
+    
+    Returns:
+        BytesIO com o arquivo .xlsx, posicionado no início
+    """
+    from openpyxl import Workbook
+    
+    workbook = Workbook(write_only=True)
+    planilha = workbook.create_sheet("Sheet1")
+    planilha.append(colunas)
+    for dado in dados:
+        planilha.append([valor if valor is None or isinstance(valor, (str, int, float)) else str(valor)
+                         for valor in (dado.get(coluna) for coluna in colunas)])
+    
+    arquivo = io.BytesIO()
+    workbook.save(arquivo)
+    arquivo.seek(0)
+    return arquivo
+
 @app.route('/download/csv', methods=['POST'])
 def download_csv():
     """
     Rota para gerar e baixar um arquivo CSV com os dados extraídos
     
-    Recebe os dados extraídos via JSON e retorna um arquivo CSV
+    Recebe os dados extraídos via JSON e envia o CSV à medida que as linhas são geradas
     """
     # Obter os dados do corpo da requisição
     dados = request.json.get('dados', [])
@@ -614,22 +1064,16 @@ def download_csv():
     if not dados:
         return jsonify({"erro": "Nenhum dado fornecido"}), 400
     
-    # Criar DataFrame com os dados
-    df = pd.DataFrame(dados)
-    
-    # Salvar DataFrame como CSV
-    csv_file = os.path.join(app.config['UPLOAD_FOLDER'], 'dados_extraidos.csv')
-    df.to_csv(csv_file, index=False)
-    
-    # Retornar o arquivo CSV
-    return send_from_directory(app.config['UPLOAD_FOLDER'], 'dados_extraidos.csv', as_attachment=True)
+    # Cada requisição gera o seu próprio arquivo, sem passar pela pasta de uploads
+    return Response(gerar_csv(dados, colunas_exportacao(dados)), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=dados_extraidos.csv'})
 
 @app.route('/download/excel', methods=['POST'])
 def download_excel():
     """
     Rota para gerar e baixar um arquivo Excel com os dados extraídos
     
-    Recebe os dados extraídos via JSON e retorna um arquivo Excel
+    Recebe os dados extraídos via JSON e retorna um arquivo Excel gerado em memória
     """
     # Obter os dados do corpo da requisição
     dados = request.json.get('dados', [])
@@ -637,31 +1081,63 @@ def download_excel():
     if not dados:
         return jsonify({"erro": "Nenhum dado fornecido"}), 400
     
-    # Criar DataFrame com os dados
-    df = pd.DataFrame(dados)
-    
-    # Salvar DataFrame como Excel
-    excel_file = os.path.join(app.config['UPLOAD_FOLDER'], 'dados_extraidos.xlsx')
-    df.to_excel(excel_file, index=False)
-    
-    # Retornar o arquivo Excel
-    return send_from_directory(app.config['UPLOAD_FOLDER'], 'dados_extraidos.xlsx', as_attachment=True)
+    arquivo = gerar_excel(dados, colunas_exportacao(dados))
+    return send_file(arquivo, as_attachment=True, download_name='dados_extraidos.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
 @app.route('/planilha', methods=['POST'])
 def adicionar_planilha():
-      # Obter os dados do corpo da requisição
+    """
+    Rota que grava os dados na caixa de saída da planilha e retorna imediatamente o ID
+    do envio (202); a entrega ao Google Sheets é feita em segundo plano e acompanhada
+    em /planilha/envios/<id> (ver caixa_saida.py)
+    """
+    # Obter os dados do corpo da requisição
     dados = request.json.get('dados', [])
     id_planilha = request.json.get('id_planilha', '')
     
-    # Usar a função de integração
-    resultado = adicionar_dados_planilha(id_planilha, dados)
+    if not id_planilha:
+        return jsonify({"erro": "ID da planilha não fornecido"}), 400
+    if not dados:
+        return jsonify({
+            "mensagem": "Nenhum dado fornecido para adicionar à planilha",
+            "id_planilha": id_planilha,
+            "registros_adicionados": 0
+        })
     
-    # Verificar se houve erro
-    if "erro" in resultado:
-        return jsonify(resultado), 500
+    envio = caixa_saida.registrar(id_planilha, dados)
+    duplicados = envio["codigos_duplicados"]
     
-    return jsonify(resultado)
+    if envio["id"] is None:
+        # Nada entrou na fila: os códigos já foram enviados para esta planilha (ou são inválidos)
+        mensagem = "Nenhum novo registro para adicionar à planilha"
+        if duplicados:
+            mensagem = f"Documento {', '.join(duplicados)} já foi enviado para a planilha. Registros adicionados: 0"
+        return jsonify({
+            "mensagem": mensagem,
+            "id_planilha": id_planilha,
+            "registros_adicionados": 0,
+            "codigos_duplicados": duplicados
+        })
+    
+    mensagem = f"Registros na fila de envio: {envio['registros_na_fila']}"
+    if duplicados:
+        mensagem = f"Documento {', '.join(duplicados)} já foi enviado para a planilha. {mensagem}"
+    return jsonify(dict(envio, estado=PENDENTE, mensagem=mensagem, id_planilha=id_planilha,
+                        url=url_for('consultar_envio', id_envio=envio["id"]))), 202
+
+@app.route('/planilha/envios/<id_envio>', methods=['GET'])
+def consultar_envio(id_envio):
+    """
+    Rota que retorna o estado da entrega de um envio à planilha (pendente, enviando,
+    entregue ou falhou), com o resultado do Google Sheets quando entregue
+    """
+    envio = caixa_saida.consultar(id_envio)
+    if envio is None:
+        return jsonify({"erro": f"Envio não encontrado: {id_envio}"}), 404
+    return jsonify(envio)
 
 if __name__ == '__main__':
+    limpar_retratos()
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
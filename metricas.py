@@ -0,0 +1,335 @@
+"""
+Métricas da aplicação (contadores e histogramas) no formato de texto do Prometheus.
+
+Cada processo acumula as suas métricas em memória; registrar uma observação custa um
+`time.perf_counter()` e uma soma sob um lock. A agregação entre processos funciona assim:
+
+- os processos do pool de extração devolvem, junto com cada resultado, o que mediram
+  (`extrair_e_zerar`), e o processo da requisição soma ao seu registro (`mesclar`);
+- cada worker do gunicorn grava periodicamente um retrato das suas métricas em
+  METRICAS_DIR (um arquivo por processo), e a rota /metrics soma todos os arquivos.
+
+Os retratos de workers que já terminaram são somados em um único arquivo
+(ARQUIVO_ENCERRADOS) e removidos, para que os contadores não diminuam quando o gunicorn
+recicla um worker sem que o diretório cresça a cada reciclagem; os medidores (valores
+instantâneos, como o tamanho de uma fila) só são somados entre os processos vivos. O
+mestre do gunicorn apaga os retratos ao iniciar (`limpar_retratos`): os contadores
+recomeçam do zero a cada início da aplicação.
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: os retratos dos workers encerrados não são compactados
+    fcntl = None
+
+# Diretório compartilhado pelos workers e intervalo mínimo (em segundos) entre gravações
+METRICAS_DIR = os.environ.get("METRICAS_DIR", os.path.join(tempfile.gettempdir(), "sisreg_metricas"))
+METRICAS_INTERVALO = float(os.environ.get("METRICAS_INTERVALO", 5))
+# Soma dos retratos dos workers que já terminaram
+ARQUIVO_ENCERRADOS = "encerrados.json"
+
+# Limites (em segundos) dos buckets dos histogramas
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Nome -> (tipo, descrição)
+DEFINICOES = {
+    "sisreg_requisicoes_total": ("counter", "Requisições HTTP por rota e status"),
+    "sisreg_requisicao_segundos": ("histogram", "Duração das requisições HTTP por rota"),
+    "sisreg_documentos_total": ("counter", "PDFs processados por resultado"),
+    "sisreg_cache_total": ("counter", "Consultas ao cache de resultados"),
+    "sisreg_layout_total": ("counter", "Documentos por layout identificado"),
+    "sisreg_uploads_recusados_total": ("counter", "Arquivos enviados recusados na triagem, por motivo"),
+    "sisreg_pdf_segundos": ("histogram", "Duração das etapas de leitura do PDF (abrir, página)"),
+    "sisreg_isolamento_total": ("counter", "Processos isolados descartados por motivo (tempo, memoria, encerrado)"),
+    "sisreg_ocr_segundos": ("histogram", "Duração do OCR por etapa (renderizar, reconhecer, documento)"),
+    "sisreg_ocr_paginas_total": ("counter", "Páginas enviadas ao OCR por resultado"),
+    "sisreg_ocr_documentos_total": ("counter", "Documentos enviados ao pool de OCR por resultado"),
+    "sisreg_campo_segundos": ("histogram", "Duração da cascata de cada campo"),
+    "sisreg_campo_total": ("counter", "Campos extraídos por resultado (encontrado/nao_encontrado)"),
+    "sisreg_padrao_total": ("counter", "Padrão da cascata que encontrou o campo"),
+    "sisreg_sheets_segundos": ("histogram", "Duração das chamadas ao Google Sheets"),
+    "sisreg_sheets_erros_total": ("counter", "Erros nas chamadas ao Google Sheets"),
+    "sisreg_fila_extracao": ("gauge", "Requisições de extração em execução e na fila, por estado"),
+    "sisreg_fila_espera_segundos": ("histogram", "Espera das requisições na fila de extração"),
+    "sisreg_fila_recusas_total": ("counter", "Requisições de extração recusadas (503) por motivo"),
+    "sisreg_sheets_retentativas_total": ("counter", "Chamadas ao Google Sheets repetidas após 429/5xx"),
+    "sisreg_saida_envios_total": ("counter", "Tentativas de entrega da caixa de saída por resultado"),
+    "sisreg_saida_atraso_segundos": ("histogram", "Tempo entre o registro de um envio e a entrega na planilha"),
+    "sisreg_sheets_espera_segundos": ("histogram", "Espera pelo balde de tokens antes das chamadas ao Google Sheets"),
+}
+
+
+def _chave(nome, labels):
+    return nome, tuple(sorted(labels.items()))
+
+
+class Metricas:
+    """Registro de contadores e histogramas de um processo"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+        self._medidores = {}
+        self._ultima_gravacao = 0.0
+        self._arquivo = None
+
+    def incrementar(self, nome, valor=1, **labels):
+        chave = _chave(nome, labels)
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **labels):
+        chave = _chave(nome, labels)
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, limite in enumerate(BUCKETS):
+                if valor <= limite:
+                    histograma[0][i] += 1
+                    break
+            histograma[1] += valor
+            histograma[2] += 1
+
+    def definir(self, nome, valor, **labels):
+        """Define o valor atual de um medidor"""
+        chave = _chave(nome, labels)
+        with self._lock:
+            self._medidores[chave] = valor
+
+    @contextmanager
+    def cronometrar(self, nome, erros=None, **labels):
+        """
+        Mede a duração do bloco no histograma `nome`; se o bloco lançar uma exceção e
+        `erros` for informado, incrementa também esse contador (com os mesmos labels)
+        """
+        inicio = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if erros:
+                self.incrementar(erros, **labels)
+            raise
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **labels)
+
+    def _retrato(self):
+        return {
+            "contadores": [[nome, list(labels), valor] for (nome, labels), valor in self._contadores.items()],
+            "histogramas": [[nome, list(labels), list(h[0]), h[1], h[2]]
+                            for (nome, labels), h in self._histogramas.items()],
+            "medidores": [[nome, list(labels), valor] for (nome, labels), valor in self._medidores.items()],
+        }
+
+    def exportar(self):
+        """Retrato serializável (JSON) das métricas"""
+        with self._lock:
+            return self._retrato()
+
+    def mesclar(self, retrato):
+        """Soma ao registro um retrato produzido por `exportar` em outro processo"""
+        if not retrato:
+            return
+        with self._lock:
+            for nome, labels, valor in retrato["contadores"]:
+                chave = (nome, tuple(tuple(label) for label in labels))
+                self._contadores[chave] = self._contadores.get(chave, 0) + valor
+            for nome, labels, buckets, soma, contagem in retrato["histogramas"]:
+                chave = (nome, tuple(tuple(label) for label in labels))
+                histograma = self._histogramas.get(chave)
+                if histograma is None:
+                    histograma = self._histogramas[chave] = [[0] * len(BUCKETS), 0.0, 0]
+                for i, quantidade in enumerate(buckets):
+                    histograma[0][i] += quantidade
+                histograma[1] += soma
+                histograma[2] += contagem
+            for nome, labels, valor in retrato.get("medidores", ()):
+                chave = (nome, tuple(tuple(label) for label in labels))
+                self._medidores[chave] = self._medidores.get(chave, 0) + valor
+
+    def extrair_e_zerar(self):
+        """Retorna o retrato das métricas e zera o registro (usado nos processos do pool)"""
+        with self._lock:
+            retrato = self._retrato()
+            self._contadores.clear()
+            self._histogramas.clear()
+            self._medidores.clear()
+        return retrato
+
+    def _caminho_arquivo(self):
+        if self._arquivo is None:
+            self._arquivo = os.path.join(METRICAS_DIR, f"{os.getpid()}_{time.time_ns()}.json")
+        return self._arquivo
+
+    def gravar(self):
+        """Grava o retrato do processo em METRICAS_DIR (substituição atômica do arquivo)"""
+        self._ultima_gravacao = time.monotonic()
+        try:
+            os.makedirs(METRICAS_DIR, exist_ok=True)
+            _gravar_retrato(self._caminho_arquivo(), self.exportar())
+        except OSError:
+            pass  # Sem diretório compartilhado, /metrics mostra apenas o próprio worker
+
+    def gravar_periodicamente(self):
+        """Grava o retrato se a última gravação tiver mais de METRICAS_INTERVALO segundos"""
+        if time.monotonic() - self._ultima_gravacao >= METRICAS_INTERVALO:
+            self.gravar()
+
+    def agregar(self):
+        """
+        Returns:
+            Registro com a soma das métricas de todos os workers (incluindo este processo)
+        """
+        self.gravar()
+        total = Metricas()
+        try:
+            arquivos = [arquivo for arquivo in os.listdir(METRICAS_DIR) if arquivo.endswith(".json")]
+        except OSError:
+            arquivos = []
+        if not arquivos:
+            total.mesclar(self.exportar())
+        encerrados = [arquivo for arquivo in arquivos
+                      if arquivo != ARQUIVO_ENCERRADOS and not _processo_vivo(arquivo.split("_", 1)[0])]
+        if encerrados and fcntl is not None:
+            _compactar(encerrados)
+            arquivos = [arquivo for arquivo in arquivos if arquivo not in encerrados and arquivo != ARQUIVO_ENCERRADOS]
+            arquivos.append(ARQUIVO_ENCERRADOS)
+        for arquivo in arquivos:
+            retrato = _ler_retrato(os.path.join(METRICAS_DIR, arquivo))
+            if retrato is None:
+                continue
+            if arquivo == ARQUIVO_ENCERRADOS or not _processo_vivo(arquivo.split("_", 1)[0]):
+                retrato.pop("medidores", None)
+            total.mesclar(retrato)
+        return total
+
+    def prometheus(self):
+        """Texto no formato de exposição do Prometheus"""
+        with self._lock:
+            contadores = dict(self._contadores)
+            contadores.update(self._medidores)
+            histogramas = {chave: (list(h[0]), h[1], h[2]) for chave, h in self._histogramas.items()}
+
+        def formatar_labels(labels, extra=()):
+            pares = list(labels) + list(extra)
+            if not pares:
+                return ""
+            return "{" + ",".join(f'{chave}="{_escapar(valor)}"' for chave, valor in pares) + "}"
+
+        linhas = []
+        nomes = sorted({nome for nome, _ in contadores} | {nome for nome, _ in histogramas})
+        for nome in nomes:
+            tipo, descricao = DEFINICOES.get(nome, ("untyped", nome))
+            linhas.append(f"# HELP {nome} {descricao}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+            for (nome_contador, labels), valor in sorted(contadores.items()):
+                if nome_contador == nome:
+                    linhas.append(f"{nome}{formatar_labels(labels)} {valor}")
+            for (nome_histograma, labels), (buckets, soma, contagem) in sorted(histogramas.items()):
+                if nome_histograma != nome:
+                    continue
+                acumulado = 0
+                for limite, quantidade in zip(BUCKETS, buckets):
+                    acumulado += quantidade
+                    linhas.append(f"{nome}_bucket{formatar_labels(labels, [('le', repr(limite))])} {acumulado}")
+                linhas.append(f"{nome}_bucket{formatar_labels(labels, [('le', '+Inf')])} {contagem}")
+                linhas.append(f"{nome}_sum{formatar_labels(labels)} {soma}")
+                linhas.append(f"{nome}_count{formatar_labels(labels)} {contagem}")
+        return "\n".join(linhas) + "\n"
+
+
+def _ler_retrato(caminho):
+    try:
+        with open(caminho, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _gravar_retrato(caminho, retrato):
+    # Substituição atômica: quem lê nunca encontra um arquivo pela metade
+    temporario = caminho + ".tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump(retrato, f)
+    os.replace(temporario, caminho)
+
+
+def _compactar(arquivos):
+    """
+    Soma os retratos de workers encerrados em ARQUIVO_ENCERRADOS e os remove
+
+    A trava impede que dois workers somem o mesmo retrato; um retrato que já não existe
+    foi compactado por outro worker.
+    """
+    try:
+        with open(os.path.join(METRICAS_DIR, ".trava"), "a") as trava:
+            fcntl.flock(trava, fcntl.LOCK_EX)
+            caminho_encerrados = os.path.join(METRICAS_DIR, ARQUIVO_ENCERRADOS)
+            acumulado = Metricas()
+            acumulado.mesclar(_ler_retrato(caminho_encerrados))
+            compactados = []
+            for arquivo in arquivos:
+                retrato = _ler_retrato(os.path.join(METRICAS_DIR, arquivo))
+                if retrato is None:
+                    continue
+                retrato.pop("medidores", None)
+                acumulado.mesclar(retrato)
+                compactados.append(arquivo)
+            if compactados:
+                _gravar_retrato(caminho_encerrados, acumulado.exportar())
+                for arquivo in compactados:
+                    os.remove(os.path.join(METRICAS_DIR, arquivo))
+    except OSError:
+        pass
+
+
+def limpar_retratos():
+    """Apaga os retratos de execuções anteriores (chamada pelo mestre do gunicorn ao iniciar)"""
+    try:
+        arquivos = os.listdir(METRICAS_DIR)
+    except OSError:
+        return
+    for arquivo in arquivos:
+        if arquivo.endswith((".json", ".tmp")):
+            try:
+                os.remove(os.path.join(METRICAS_DIR, arquivo))
+            except OSError:
+                pass
+
+
+def _processo_vivo(pid):
+    try:
+        os.kill(int(pid), 0)
+    except PermissionError:
+        return True  # O processo existe, mas pertence a outro usuário
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+metricas = Metricas()
+
+
+def _reiniciar_apos_fork():
+    # O processo filho começa sem as métricas do pai e com o seu próprio arquivo
+    metricas._lock = threading.Lock()
+    metricas._contadores = {}
+    metricas._histogramas = {}
+    metricas._medidores = {}
+    metricas._arquivo = None
+    metricas._ultima_gravacao = 0.0
+
+
+os.register_at_fork(after_in_child=_reiniciar_apos_fork)
@@ -0,0 +1,225 @@
+"""
+OCR das páginas sem camada de texto (guias digitalizadas).
+
+As páginas são renderizadas com pdf2image (poppler) e reconhecidas com pytesseract em um
+pool de processos próprio, separado do pool de extração de main.py e limitado a
+`processos` processos e `fila` documentos aguardando: guias digitalizadas não ocupam os
+processos que extraem os PDFs com texto. Cada página tem um tempo máximo de renderização
+e de reconhecimento; uma página que excede o tempo fica sem texto.
+
+O texto reconhecido é guardado em um cache LRU por SHA-256 do conteúdo, número da página,
+DPI e idioma, de modo que reenvios da mesma guia não passam de novo pelo OCR.
+
+O OCR fica desativado (e a extração se comporta como antes) quando os executáveis
+`tesseract` e `pdftoppm` não estão instalados.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cache_resultados import CacheResultados
+from diagnostico import obter_logger
+from metricas import metricas
+
+logger = obter_logger("sisreg.ocr")
+
+
+class OcrPendente:
+    """
+    Resultado de uma extração cujas páginas sem texto ainda precisam de OCR
+
+    Args:
+        textos_paginas: Texto de cada página lida, na ordem (vazio nas páginas sem camada de texto)
+        paginas: Números (a partir de 1) das páginas a reconhecer
+    """
+
+    __slots__ = ("textos_paginas", "paginas")
+
+    def __init__(self, textos_paginas, paginas):
+        self.textos_paginas = textos_paginas
+        self.paginas = paginas
+
+
+def _reconhecer_paginas(conteudo, paginas, dpi, idioma, timeout):
+    """
+    Renderiza e reconhece as páginas em um processo do pool de OCR
+
+    Returns:
+        Tupla (textos, metricas): dicionário {pagina: texto} (None nas páginas que
+        excederam o tempo ou falharam) e as métricas registradas no processo
+    """
+    from pdf2image import convert_from_bytes
+    import pytesseract
+
+    textos = {}
+    for pagina in paginas:
+        try:
+            with metricas.cronometrar("sisreg_ocr_segundos", etapa="renderizar"):
+                imagens = convert_from_bytes(conteudo, dpi=dpi, first_page=pagina, last_page=pagina,
+                                             grayscale=True, timeout=timeout)
+            with metricas.cronometrar("sisreg_ocr_segundos", etapa="reconhecer"):
+                texto = pytesseract.image_to_string(imagens[0], lang=idioma, timeout=timeout) if imagens else ""
+        except Exception as e:
+            # pdf2image e pytesseract encerram o poppler/tesseract ao exceder o tempo
+            resultado = "timeout" if "timeout" in type(e).__name__.lower() or "timeout" in str(e).lower() else "erro"
+            logger.warning("OCR da página %s falhou (%s): %s", pagina, resultado, e)
+            metricas.incrementar("sisreg_ocr_paginas_total", resultado=resultado)
+            textos[pagina] = None
+            continue
+        metricas.incrementar("sisreg_ocr_paginas_total", resultado="reconhecida" if texto.strip() else "vazia")
+        textos[pagina] = texto
+    return textos, metricas.extrair_e_zerar()
+
+
+class MotorOcr:
+    """
+    Pool de OCR de um processo (criado sob demanda, como o pool de extração).
+
+    Args:
+        processos: Processos do pool de OCR
+        fila: Documentos que podem aguardar OCR ao mesmo tempo
+        dpi: Resolução da renderização das páginas
+        idioma: Idioma do tesseract (ex.: "por")
+        timeout_pagina: Tempo máximo (em segundos) de renderização e de reconhecimento de cada página
+        max_paginas: Páginas sem texto reconhecidas por documento
+        cache_paginas: Páginas mantidas no cache de texto reconhecido
+        ativo: Se False, o OCR nunca é usado
+    """
+
+    def __init__(self, processos=1, fila=8, dpi=300, idioma="por", timeout_pagina=30.0, max_paginas=4,
+                 cache_paginas=256, ativo=True):
+        self.processos = max(processos, 1)
+        self.fila = max(fila, 1)
+        self.dpi = dpi
+        self.idioma = idioma
+        self.timeout_pagina = timeout_pagina
+        self.max_paginas = max(max_paginas, 1)
+        self.ativo = ativo
+        self.cache = CacheResultados(cache_paginas)
+        self._disponivel = None
+        self._pool = None
+        self._pool_pid = None
+        self._pendentes = 0
+        self._lock = threading.Lock()
+
+    def disponivel(self):
+        """Indica se o OCR está ativo e os executáveis do tesseract e do poppler foram encontrados"""
+        if self._disponivel is None:
+            faltando = [programa for programa in ("tesseract", "pdftoppm") if shutil.which(programa) is None]
+            if self.ativo and faltando:
+                logger.warning("OCR desativado: %s não encontrado(s) no PATH", ", ".join(faltando))
+            self._disponivel = self.ativo and not faltando
+        return self._disponivel
+
+    def _obter_pool(self):
+        # Cada worker do gunicorn cria o seu próprio pool após o fork
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ProcessPoolExecutor(max_workers=self.processos)
+            self._pool_pid = os.getpid()
+            self._pendentes = 0
+        return self._pool
+
+    def _chave(self, sha, pagina):
+        return f"{sha}:{pagina}:{self.dpi}:{self.idioma}"
+
+    def submeter(self, conteudo, paginas):
+        """
+        Envia as páginas ao pool de OCR, consultando antes o cache
+
+        Args:
+            conteudo: Bytes do PDF
+            paginas: Números (a partir de 1) das páginas a reconhecer
+
+        Returns:
+            Future cujo resultado é um dicionário {pagina: texto reconhecido} com as
+            páginas reconhecidas (até `max_paginas`; texto vazio nas que falharam). Falha
+            com RuntimeError se houver `fila` documentos aguardando OCR
+        """
+        paginas = list(paginas)[:self.max_paginas]
+        sha = hashlib.sha256(conteudo).hexdigest()
+        textos = {}
+        for pagina in paginas:
+            registro = self.cache.obter(self._chave(sha, pagina))
+            if registro is not None:
+                metricas.incrementar("sisreg_ocr_paginas_total", resultado="cache")
+                textos[pagina] = registro["texto"]
+        faltando = [pagina for pagina in paginas if pagina not in textos]
+
+        resultado = Future()
+        resultado.set_running_or_notify_cancel()
+
+        def concluir():
+            resultado.set_result({pagina: textos.get(pagina) or "" for pagina in paginas})
+
+        if not faltando:
+            concluir()
+            return resultado
+
+        with self._lock:
+            pool = self._obter_pool()
+            if self._pendentes >= self.fila:
+                metricas.incrementar("sisreg_ocr_documentos_total", resultado="fila_cheia")
+                resultado.set_exception(RuntimeError("Fila de OCR cheia, tente novamente mais tarde"))
+                return resultado
+            pid = self._pool_pid
+            inicio = time.perf_counter()
+            try:
+                futuro = pool.submit(_reconhecer_paginas, conteudo, faltando, self.dpi, self.idioma,
+                                     self.timeout_pagina)
+            except BrokenProcessPool as e:
+                self._pool = None
+                metricas.incrementar("sisreg_ocr_documentos_total", resultado="erro")
+                resultado.set_exception(RuntimeError(f"Falha no processo de OCR: {e}"))
+                return resultado
+            self._pendentes += 1
+
+        def receber(futuro):
+            with self._lock:
+                if self._pool_pid == pid:
+                    self._pendentes -= 1
+            try:
+                reconhecidos, metricas_processo = futuro.result()
+            except BrokenProcessPool as e:
+                # O processo de OCR morreu: o próximo documento cria um novo pool
+                with self._lock:
+                    if self._pool_pid == pid:
+                        self._pool = None
+                metricas.incrementar("sisreg_ocr_documentos_total", resultado="erro")
+                resultado.set_exception(RuntimeError(f"Falha no processo de OCR: {e}"))
+                return
+            except Exception as e:
+                metricas.incrementar("sisreg_ocr_documentos_total", resultado="erro")
+                resultado.set_exception(e)
+                return
+            metricas.mesclar(metricas_processo)
+            for pagina, texto in reconhecidos.items():
+                # Páginas que excederam o tempo não são guardadas, para serem tentadas de novo
+                if texto is not None:
+                    self.cache.guardar(self._chave(sha, pagina), {"texto": texto})
+                textos[pagina] = texto
+            metricas.incrementar("sisreg_ocr_documentos_total", resultado="reconhecido")
+            # Tempo do documento no OCR, incluindo a espera por um processo livre
+            metricas.observar("sisreg_ocr_segundos", time.perf_counter() - inicio, etapa="documento")
+            concluir()
+
+        futuro.add_done_callback(receber)
+        return resultado
+
+    def estado(self):
+        """Ocupação do pool de OCR e do cache de páginas"""
+        with self._lock:
+            pendentes = self._pendentes
+        return {
+            "disponivel": self.disponivel(),
+            "processos": self.processos,
+            "documentos_pendentes": pendentes,
+            "fila": self.fila,
+            "dpi": self.dpi,
+            "timeout_pagina": self.timeout_pagina,
+            "cache": self.cache.estatisticas(),
+        }
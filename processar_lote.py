@@ -0,0 +1,254 @@
+"""
+Processamento em lote dos PDFs da pasta configurada em config.json (pasta_pdfs)
+
+Os PDFs são processados em paralelo pelo pool de processos isolados de main.py (um
+processo por núcleo, com o mesmo tempo máximo e limite de memória da aplicação), em lotes
+enviados por este processo, que é o único a gravar os resultados: cada resultado é
+gravado assim que fica pronto, em CSV ou JSONL, e na base local (RESULTADOS_DB). Um manifesto (caminho, tamanho, mtime, hash) é
+atualizado a cada arquivo concluído: se a execução for interrompida, a próxima pula os
+arquivos já processados e que não mudaram desde então.
+
+Uso:
+    python processar_lote.py [--pasta PASTA] [--saida resultados.csv|resultados.jsonl]
+                             [--processos N] [--refazer-erros] [--reiniciar]
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import signal
+import threading
+import hashlib
+import argparse
+
+from main import app, processar_pdfs_em_andamento
+from extrator_sisreg import CAMPOS
+
+COLUNAS_CSV = ["arquivo", *CAMPOS, "erro"]
+
+
+def carregar_config(arquivo_config='config.json'):
+    """Carrega o config.json (dicionário vazio se o arquivo não existir)"""
+    if not os.path.exists(arquivo_config):
+        return {}
+    with open(arquivo_config, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def listar_pdfs(pasta):
+    """
+    Returns:
+        Caminhos relativos à pasta de todos os PDFs (incluindo subpastas), em ordem
+    """
+    caminhos = []
+    for raiz, _, arquivos in os.walk(pasta):
+        for arquivo in arquivos:
+            if arquivo.lower().endswith('.pdf'):
+                caminhos.append(os.path.relpath(os.path.join(raiz, arquivo), pasta))
+    return sorted(caminhos)
+
+
+def calcular_hash(caminho):
+    sha256 = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(bloco)
+    return sha256.hexdigest()
+
+
+class Manifesto:
+    """
+    Registro dos arquivos já processados, gravado em JSONL (uma linha por arquivo
+    concluído; a última linha de cada caminho prevalece)
+
+    Args:
+        caminho: Arquivo do manifesto
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.entradas = {}
+        if os.path.exists(caminho):
+            with open(caminho, 'r', encoding='utf-8') as f:
+                for linha in f:
+                    try:
+                        entrada = json.loads(linha)
+                    except json.JSONDecodeError:
+                        continue  # Última linha incompleta de uma execução interrompida
+                    self.entradas[entrada["caminho"]] = entrada
+        self._arquivo = open(caminho, 'a', encoding='utf-8')
+
+    def concluido(self, caminho_relativo, caminho, refazer_erros=False):
+        """
+        Verifica se o arquivo já foi processado e não mudou desde então. Tamanho e mtime
+        iguais bastam; se algum mudou, o hash do conteúdo decide.
+        """
+        entrada = self.entradas.get(caminho_relativo)
+        if entrada is None or (refazer_erros and entrada.get("erro")):
+            return False
+        info = os.stat(caminho)
+        if info.st_size == entrada["tamanho"] and info.st_mtime == entrada["mtime"]:
+            return True
+        if info.st_size != entrada["tamanho"] or calcular_hash(caminho) != entrada["sha256"]:
+            return False
+        # Mesmo conteúdo com outro mtime (ex.: arquivo copiado): atualizar o manifesto
+        self.registrar(dict(entrada, mtime=info.st_mtime))
+        return True
+
+    def registrar(self, entrada):
+        self.entradas[entrada["caminho"]] = entrada
+        self._arquivo.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+        self._arquivo.flush()
+
+    def fechar(self):
+        self._arquivo.close()
+
+
+class SaidaResultados:
+    """
+    Grava os resultados incrementalmente em CSV ou JSONL (pela extensão do arquivo)
+
+    Args:
+        caminho: Arquivo de saída (.csv ou .jsonl)
+    """
+
+    def __init__(self, caminho):
+        self.formato = 'jsonl' if caminho.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+        novo = not os.path.exists(caminho) or os.path.getsize(caminho) == 0
+        self._arquivo = open(caminho, 'a', encoding='utf-8', newline='')
+        if self.formato == 'csv':
+            self._writer = csv.DictWriter(self._arquivo, fieldnames=COLUNAS_CSV, extrasaction='ignore')
+            if novo:
+                self._writer.writeheader()
+
+    def gravar(self, dados):
+        if self.formato == 'csv':
+            self._writer.writerow(dados)
+        else:
+            self._arquivo.write(json.dumps(dados, ensure_ascii=False) + "\n")
+        self._arquivo.flush()
+
+    def fechar(self):
+        self._arquivo.close()
+
+
+def processar_lote(pasta, saida, processos=None, refazer_erros=False, reiniciar=False):
+    """
+    Processa todos os PDFs da pasta, retomando uma execução anterior se houver manifesto
+
+    Args:
+        pasta: Pasta com os PDFs
+        saida: Arquivo de resultados (.csv ou .jsonl)
+        processos: Número de processos (padrão: MAX_PROCESSOS, o número de núcleos)
+        refazer_erros: Se True, processa de novo os arquivos que terminaram com erro
+        reiniciar: Se True, ignora o manifesto e a saída anteriores
+
+    Returns:
+        Dicionário com os contadores da execução
+    """
+    arquivo_manifesto = saida + '.manifesto.jsonl'
+    # Sem a saída anterior, os resultados do manifesto teriam se perdido: começar do zero
+    if reiniciar or not os.path.exists(saida):
+        for arquivo in (saida, arquivo_manifesto):
+            if os.path.exists(arquivo):
+                os.remove(arquivo)
+
+    if processos:
+        # Tamanho do pool de processos isolados de main.py (criado no primeiro lote)
+        app.config['MAX_PROCESSOS'] = processos
+
+    manifesto = Manifesto(arquivo_manifesto)
+    resultados = SaidaResultados(saida)
+    contadores = {"total": 0, "pulados": 0, "processados": 0, "sucessos": 0, "falhas": 0}
+    inicio = time.perf_counter()
+
+    try:
+        pendentes = []
+        for caminho_relativo in listar_pdfs(pasta):
+            contadores["total"] += 1
+            if manifesto.concluido(caminho_relativo, os.path.join(pasta, caminho_relativo), refazer_erros):
+                contadores["pulados"] += 1
+            else:
+                pendentes.append(caminho_relativo)
+        print(f"PDFs encontrados: {contadores['total']} ({contadores['pulados']} já processados)")
+
+        def registrar(caminho_relativo, caminho, dados):
+            info = os.stat(caminho)
+            entrada = {
+                "caminho": caminho_relativo,
+                "tamanho": info.st_size,
+                "mtime": info.st_mtime,
+                "sha256": calcular_hash(caminho),
+                "erro": "erro" in dados
+            }
+            # O resultado é gravado antes do manifesto: uma interrupção entre os dois
+            # faz o arquivo ser processado de novo, nunca perdido
+            resultados.gravar(dados)
+            manifesto.registrar(entrada)
+            contadores["processados"] += 1
+            contadores["falhas" if entrada["erro"] else "sucessos"] += 1
+            if contadores["processados"] % 50 == 0:
+                print(f"Processados: {contadores['processados']}/{len(pendentes)}")
+
+        # Ctrl+C apenas sinaliza a interrupção, verificada entre um lote e outro: os
+        # processos isolados ignoram o sinal e terminam os arquivos do lote em andamento
+        interrompido = threading.Event()
+
+        def interromper(*_):
+            if not interrompido.is_set():
+                print("Interrompido; aguardando os arquivos em andamento")
+            interrompido.set()
+
+        tratar_sinal = threading.current_thread() is threading.main_thread()
+        if tratar_sinal:
+            sinal_anterior = signal.signal(signal.SIGINT, interromper)
+        try:
+            # Lotes de alguns arquivos por processo mantêm o pool ocupado sem enfileirar a
+            # pasta inteira de uma vez
+            tamanho_lote = app.config['MAX_PROCESSOS'] * 4
+            for inicio_lote in range(0, len(pendentes), tamanho_lote):
+                if interrompido.is_set():
+                    break
+                lote = pendentes[inicio_lote:inicio_lote + tamanho_lote]
+                caminhos = [os.path.join(pasta, caminho_relativo) for caminho_relativo in lote]
+                for posicao, dados in processar_pdfs_em_andamento(caminhos, lote):
+                    registrar(lote[posicao], caminhos[posicao], dados)
+            if interrompido.is_set():
+                print("A próxima execução continua de onde parou")
+        finally:
+            if tratar_sinal:
+                signal.signal(signal.SIGINT, sinal_anterior)
+        contadores["interrompido"] = interrompido.is_set()
+    finally:
+        resultados.fechar()
+        manifesto.fechar()
+
+    contadores["duracao"] = round(time.perf_counter() - inicio, 2)
+    return contadores
+
+
+if __name__ == "__main__":
+    config = carregar_config()
+    parser = argparse.ArgumentParser(description="Processa em lote os PDFs do SISREG da pasta configurada")
+    parser.add_argument('--pasta', default=config.get('pasta_pdfs', 'pdfs'),
+                        help="Pasta com os PDFs (padrão: pasta_pdfs do config.json)")
+    parser.add_argument('--saida', default='resultados_lote.csv',
+                        help="Arquivo de resultados, .csv ou .jsonl (padrão: resultados_lote.csv)")
+    parser.add_argument('--processos', type=int, default=None,
+                        help="Número de processos (padrão: número de núcleos)")
+    parser.add_argument('--refazer-erros', action='store_true',
+                        help="Processa de novo os arquivos que terminaram com erro")
+    parser.add_argument('--reiniciar', action='store_true',
+                        help="Ignora o manifesto e começa do zero")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.pasta):
+        print(f"ERRO: Pasta não encontrada: {args.pasta}")
+        sys.exit(1)
+
+    contadores = processar_lote(args.pasta, args.saida, args.processos, args.refazer_erros, args.reiniciar)
+    print(f"{'Interrompido' if contadores['interrompido'] else 'Concluído'}: {contadores}")
+    if contadores["interrompido"]:
+        sys.exit(130)
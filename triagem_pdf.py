@@ -0,0 +1,308 @@
+"""
+Triagem dos PDFs enviados, feita enquanto o corpo da requisição chega.
+
+O Werkzeug grava cada arquivo do formulário multipart no stream devolvido por
+`Request._get_file_stream` (ver RequisicaoSisreg em main.py). ArquivoTriado é esse
+stream: conta os bytes recebidos, confere o cabeçalho %PDF- nos primeiros bytes e, assim
+que o arquivo excede o limite de tamanho, tem extensão não permitida ou não começa como
+um PDF, descarta o que já recebeu e ignora o restante da parte. Arquivos recusados não
+ocupam memória nem disco, mesmo que o restante do envio continue chegando.
+
+Depois do envio, `verificar_estrutura` lê o final do arquivo (startxref, tabela ou stream
+de referências e trailer) para recusar PDFs truncados (sem startxref/%%EOF) ou
+criptografados antes de qualquer PdfReader ser criado. A verificação tem a mesma
+tolerância do PyPDF2 fora do modo estrito: lixo antes do %PDF- ou depois do %%EOF e
+referências deslocadas não recusam o arquivo.
+
+`python triagem_pdf.py [PASTA]` confere a triagem com variações dos PDFs da pasta.
+"""
+
+import io
+import re
+import tempfile
+
+from metricas import metricas
+
+CABECALHO_PDF = b"%PDF-"
+# O cabeçalho pode vir depois de algum lixo, desde que dentro dos primeiros 1024 bytes
+JANELA_CABECALHO = 1024
+# Bytes do final do arquivo procurados primeiro pelo %%EOF/startxref (o PyPDF2 aceita lixo
+# depois do %%EOF); sem eles nessa janela, o arquivo inteiro é lido
+JANELA_FINAL = 64 * 1024
+JANELA_XREF = 4096
+
+_STARTXREF = re.compile(rb"startxref\s+(\d+)")
+_OBJETO = re.compile(rb"\d+\s+\d+\s+obj\b")
+_OBJETO_XREF = re.compile(rb"\d+\s+\d+\s+obj\s*<<[^>]*?/Type\s*/XRef")
+
+
+class Recusa:
+    """
+    Motivo da recusa de um arquivo enviado
+
+    Args:
+        motivo: Rótulo da métrica sisreg_uploads_recusados_total ("tamanho", "extensao",
+            "cabecalho", "estrutura" ou "criptografado")
+        mensagem: Descrição para o campo "erro" do resultado
+    """
+
+    __slots__ = ("motivo", "mensagem")
+
+    def __init__(self, motivo, mensagem):
+        self.motivo = motivo
+        self.mensagem = mensagem
+
+
+def verificar_cabecalho(inicio):
+    """
+    Confere a assinatura %PDF- nos primeiros bytes do arquivo
+
+    Returns:
+        Recusa, ou None se o cabeçalho estiver presente
+    """
+    if CABECALHO_PDF not in inicio[:JANELA_CABECALHO]:
+        return Recusa("cabecalho", "O arquivo não é um PDF (cabeçalho %PDF- ausente)")
+    return None
+
+
+def _ler_final(arquivo, tamanho):
+    # Trecho do arquivo que contém o último %%EOF e o seu startxref, e a posição do trecho
+    inicio = max(tamanho - JANELA_FINAL, 0)
+    arquivo.seek(inicio)
+    final = arquivo.read()
+    if inicio and (b"%%EOF" not in final or _STARTXREF.search(final) is None):
+        arquivo.seek(0)
+        return arquivo.read(), 0
+    return final, inicio
+
+
+def _dicionario_trailer(conteudo, referencia):
+    """
+    Dicionário que faz o papel de trailer a partir da posição `referencia`: o trailer
+    de uma tabela xref ou o dicionário de um stream de referências
+
+    Returns:
+        Bytes do dicionário, ou None se `referencia` não apontar para as referências
+    """
+    trecho = conteudo[referencia:referencia + JANELA_XREF].lstrip()
+    if trecho.startswith(b"xref"):
+        inicio_trailer = conteudo.find(b"trailer", referencia)
+        if inicio_trailer < 0:
+            return None
+        fim = conteudo.find(b"startxref", inicio_trailer)
+        return conteudo[inicio_trailer:fim if fim >= 0 else None]
+    if _OBJETO.match(trecho):
+        fim = trecho.find(b"stream")
+        dicionario = trecho[:fim] if fim >= 0 else trecho
+        if b"/XRef" in dicionario:
+            return dicionario
+    return None
+
+
+def _procurar_trailer(conteudo):
+    # Como o PyPDF2 fora do modo estrito: usa a última tabela xref ou o último stream de
+    # referências do arquivo quando o startxref não aponta para eles
+    posicoes = [conteudo.rfind(b"xref\n"), conteudo.rfind(b"xref\r")]
+    objetos = list(_OBJETO_XREF.finditer(conteudo))
+    if objetos:
+        posicoes.append(objetos[-1].start())
+    for posicao in sorted((posicao for posicao in posicoes if posicao >= 0), reverse=True):
+        # "startxref" também termina em "xref": só vale a palavra-chave isolada
+        if conteudo[posicao - 5:posicao] == b"start":
+            continue
+        dicionario = _dicionario_trailer(conteudo, posicao)
+        if dicionario is not None:
+            return dicionario
+    return None
+
+
+def verificar_estrutura(arquivo, tamanho, deslocamento=0):
+    """
+    Confere o final do PDF sem interpretá-lo e com a mesma tolerância do PyPDF2: o
+    startxref antes do último %%EOF é obrigatório e o trailer não pode ter /Encrypt.
+    Uma referência xref deslocada não recusa o arquivo; nesse caso as últimas referências
+    do arquivo são procuradas, como faz o PyPDF2
+
+    Args:
+        arquivo: Objeto de arquivo binário com o PDF completo
+        tamanho: Tamanho do arquivo em bytes
+        deslocamento: Posição do cabeçalho %PDF- (as referências contam a partir dele)
+
+    Returns:
+        Recusa, ou None se a estrutura parecer íntegra
+    """
+    final, inicio = _ler_final(arquivo, tamanho)
+    fim_arquivo = final.rfind(b"%%EOF")
+    posicao = final.rfind(b"startxref", 0, fim_arquivo if fim_arquivo >= 0 else None)
+    correspondencia = _STARTXREF.match(final, posicao) if posicao >= 0 else None
+    if fim_arquivo < 0 or correspondencia is None:
+        return Recusa("estrutura", "PDF incompleto ou corrompido (startxref/%%EOF ausente)")
+
+    referencia = int(correspondencia.group(1)) + deslocamento
+    dicionario = None
+    if referencia >= inicio:
+        # A referência cai no trecho já lido (o caso comum: tabela no final do arquivo)
+        dicionario = _dicionario_trailer(final, referencia - inicio)
+    elif referencia < tamanho:
+        arquivo.seek(referencia)
+        trecho = arquivo.read(JANELA_XREF)
+        if trecho.lstrip().startswith(b"xref"):
+            # O trailer de uma tabela longa fica logo antes do startxref final
+            inicio_trailer = final.rfind(b"trailer", 0, posicao)
+            dicionario = final[inicio_trailer:posicao] if inicio_trailer >= 0 else None
+        else:
+            dicionario = _dicionario_trailer(trecho, 0)
+    if dicionario is None:
+        arquivo.seek(0)
+        dicionario = _procurar_trailer(arquivo.read())
+
+    # Sem trailer reconhecível, o PyPDF2 ainda tenta reconstruir as referências
+    if dicionario is not None and b"/Encrypt" in dicionario:
+        return Recusa("criptografado", "PDF protegido por senha ou criptografado não é suportado")
+    return None
+
+
+def registrar_recusa(recusa):
+    """Conta a recusa na métrica sisreg_uploads_recusados_total"""
+    metricas.incrementar("sisreg_uploads_recusados_total", motivo=recusa.motivo)
+
+
+class ArquivoTriado:
+    """
+    Stream de um arquivo do formulário que aplica a triagem enquanto é gravado.
+
+    Os bytes aceitos vão para um SpooledTemporaryFile (em memória até `em_memoria` bytes,
+    depois em disco). Leitura, posicionamento e fechamento são repassados a ele.
+
+    Args:
+        limite: Tamanho máximo do arquivo em bytes
+        em_memoria: Bytes mantidos em memória antes de passar para um arquivo temporário
+            (0 grava direto em disco)
+        recusa: Recusa já conhecida ao abrir o stream (ex.: extensão não permitida)
+    """
+
+    def __init__(self, limite, em_memoria, recusa=None):
+        self.limite = limite
+        self.tamanho = 0
+        self.recusa = None
+        self.deslocamento = 0
+        self._inicio = b""
+        # SpooledTemporaryFile com max_size=0 nunca passaria para o disco
+        self._arquivo = tempfile.SpooledTemporaryFile(max_size=em_memoria) if em_memoria else tempfile.TemporaryFile()
+        if recusa is not None:
+            self._recusar(recusa)
+
+    def _recusar(self, recusa):
+        # Libera o que já foi recebido; o restante da parte é apenas contado
+        self.recusa = recusa
+        self._inicio = b""
+        self._arquivo.close()
+        self._arquivo = io.BytesIO()
+        registrar_recusa(recusa)
+
+    def write(self, dados):
+        self.tamanho += len(dados)
+        if self.recusa is not None:
+            return len(dados)
+        if self.tamanho > self.limite:
+            self._recusar(Recusa("tamanho", f"Tamanho do arquivo excede o limite de {self.limite/1024/1024:.1f}MB"))
+            return len(dados)
+        if self._inicio is not None:
+            # Cabeçalho conferido assim que a janela inicial estiver completa
+            self._inicio += dados[:JANELA_CABECALHO]
+            if len(self._inicio) >= JANELA_CABECALHO:
+                recusa = verificar_cabecalho(self._inicio)
+                if recusa is not None:
+                    self._recusar(recusa)
+                    return len(dados)
+                self.deslocamento = self._inicio.find(CABECALHO_PDF)
+                self._inicio = None
+        return self._arquivo.write(dados)
+
+    def verificar(self):
+        """
+        Conclui a triagem depois que o arquivo foi recebido por completo
+
+        Returns:
+            Recusa, ou None se o arquivo puder ser entregue ao PyPDF2
+        """
+        if self.recusa is None:
+            recusa = None
+            if self._inicio is not None:
+                recusa = verificar_cabecalho(self._inicio)
+                self.deslocamento = self._inicio.find(CABECALHO_PDF)
+                self._inicio = None
+            if recusa is None:
+                recusa = verificar_estrutura(self._arquivo, self.tamanho, self.deslocamento)
+            self._arquivo.seek(0)
+            if recusa is not None:
+                self._recusar(recusa)
+        return self.recusa
+
+    def __getattr__(self, nome):
+        return getattr(self._arquivo, nome)
+
+    def __iter__(self):
+        return iter(self._arquivo)
+
+
+def _verificar_regressoes(pasta="pdfs"):
+    """
+    Confere a triagem com variações dos PDFs de `pasta` que o PyPDF2 lê normalmente (e
+    que não podem ser recusadas) e com arquivos que devem ser recusados
+
+    Uso:
+        python triagem_pdf.py [PASTA]
+    """
+    import os
+    import PyPDF2
+
+    def triar(conteudo):
+        arquivo = ArquivoTriado(len(conteudo) + 1, len(conteudo) + 1)
+        arquivo.write(conteudo)
+        recusa = arquivo.verificar()
+        return recusa.motivo if recusa else None
+
+    falhas = 0
+    for nome in sorted(os.listdir(pasta)):
+        if not nome.lower().endswith(".pdf"):
+            continue
+        with open(os.path.join(pasta, nome), "rb") as arquivo:
+            original = arquivo.read()
+        texto_original = PyPDF2.PdfReader(io.BytesIO(original)).pages[0].extract_text()
+        posicao = original.rfind(b"startxref")
+        referencia = _STARTXREF.match(original, posicao)
+        deslocada = (original[:referencia.start(1)] + str(int(referencia.group(1)) + 5).encode()
+                     + original[referencia.end(1):])
+        variacoes = {
+            "original": (original, None),
+            "lixo antes do %PDF-": (b"lixo de um cliente de e-mail\r\n" * 10 + original, None),
+            "mais de 4 KB depois do %%EOF": (original + b"\0" * 8192, None),
+            "startxref deslocado 5 bytes": (deslocada, None),
+            "truncado": (original[:len(original) // 2], "estrutura"),
+        }
+        for descricao, (conteudo, esperado) in variacoes.items():
+            obtido = triar(conteudo)
+            if esperado is None and obtido is None:
+                # Aceito pela triagem: o PyPDF2 precisa ler o mesmo texto do original
+                texto = PyPDF2.PdfReader(io.BytesIO(conteudo)).pages[0].extract_text()
+                obtido = None if texto == texto_original else "texto diferente no PyPDF2"
+            if obtido != esperado:
+                falhas += 1
+                print(f"FALHA {nome} ({descricao}): esperado {esperado}, obtido {obtido}")
+
+        escritor = PyPDF2.PdfWriter()
+        escritor.append(PyPDF2.PdfReader(io.BytesIO(original)))
+        escritor.encrypt("senha")
+        criptografado = io.BytesIO()
+        escritor.write(criptografado)
+        if triar(criptografado.getvalue()) != "criptografado":
+            falhas += 1
+            print(f"FALHA {nome} (criptografado): não recusado")
+    print("Triagem: " + (f"{falhas} falha(s)" if falhas else "todas as verificações passaram"))
+    return falhas
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(1 if _verificar_regressoes(*sys.argv[1:2]) else 0)